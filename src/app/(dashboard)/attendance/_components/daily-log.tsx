@@ -11,6 +11,7 @@ import { useToast } from '@/components/ui/use-toast';
 import { useRouter } from 'next/navigation';
 import type { Attendance } from '@/lib/types';
 import Link from 'next/link';
+import { openEventStream } from '@/lib/event-stream';
 import { Dialog, DialogContent, DialogDescription, DialogHeader, DialogTitle, DialogTrigger } from '@/components/ui/dialog';
 
 interface DailyLogData {
@@ -148,6 +149,11 @@ export function DailyLog() {
         }
         fetchDailyLog();
     }, [router, toast]);
+
+    // KPI changes (device syncs, approved leaves) are pushed over SSE so the cards stay current
+    useEffect(() => openEventStream({
+        attendance_kpis: ({ kpis }) => setData(prev => prev ? { ...prev, kpis } : prev),
+    }), []);
     
     const getStatusVariant = (status: string) => {
         switch (status) {
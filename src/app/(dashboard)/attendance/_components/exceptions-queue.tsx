@@ -1,18 +1,180 @@
 'use client';
 
+import { useState, useEffect, useCallback } from 'react';
 import { Card, CardContent, CardHeader, CardTitle, CardDescription } from "@/components/ui/card";
+import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from '@/components/ui/table';
+import { Badge } from '@/components/ui/badge';
+import { Button } from "@/components/ui/button";
+import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
+import { Loader2, RefreshCw, Check, X } from 'lucide-react';
+import { useToast } from '@/components/ui/use-toast';
+import { useRouter } from 'next/navigation';
+import Link from 'next/link';
+
+interface AttendanceException {
+    id: number;
+    employee_id: number;
+    employee_name: string | null;
+    date: string;
+    type: 'no_show' | 'wrong_shift' | 'unrostered_punch';
+    shift_id: number | null;
+    status: 'Open' | 'Resolved' | 'Dismissed';
+    details: { expected?: [string, string]; punches?: string[] } | null;
+}
+
+const typeLabels: { [key: string]: string } = {
+    'no_show': 'عدم حضور',
+    'wrong_shift': 'مناوبة مختلفة',
+    'unrostered_punch': 'بصمة خارج الجدول',
+};
+
+const formatTime = (value: string) => value.slice(11, 16);
 
 export function ExceptionsQueue() {
+    const [exceptions, setExceptions] = useState<AttendanceException[]>([]);
+    const [typeFilter, setTypeFilter] = useState('all');
+    const [isLoading, setIsLoading] = useState(true);
+    const [isReconciling, setIsReconciling] = useState(false);
+    const { toast } = useToast();
+    const router = useRouter();
+
+    const fetchExceptions = useCallback(async () => {
+        setIsLoading(true);
+        try {
+            const token = localStorage.getItem('authToken');
+            if (!token) {
+                router.push('/login');
+                return;
+            }
+            const params = new URLSearchParams({ status: 'Open', per_page: '200' });
+            if (typeFilter !== 'all') params.set('type', typeFilter);
+            const response = await fetch(`/api/attendance/exceptions?${params}`, {
+                headers: { 'Authorization': `Bearer ${token}` }
+            });
+            if (!response.ok) throw new Error('فشل في جلب الاستثناءات');
+            const data = await response.json();
+            setExceptions(data.exceptions);
+        } catch (error: any) {
+            toast({ variant: "destructive", title: "خطأ", description: error.message });
+        } finally {
+            setIsLoading(false);
+        }
+    }, [router, toast, typeFilter]);
+
+    useEffect(() => {
+        fetchExceptions();
+    }, [fetchExceptions]);
+
+    const handleReconcile = async () => {
+        setIsReconciling(true);
+        try {
+            const token = localStorage.getItem('authToken');
+            const response = await fetch('/api/attendance/reconcile', {
+                method: 'POST',
+                headers: { 'Authorization': `Bearer ${token}`, 'Content-Type': 'application/json' },
+                body: JSON.stringify({})
+            });
+            const result = await response.json();
+            if (!response.ok) throw new Error(result.message || 'فشلت المطابقة');
+            toast({ title: "اكتملت المطابقة", description: `تم العثور على ${result.total} استثناء.` });
+            fetchExceptions();
+        } catch (error: any) {
+            toast({ variant: "destructive", title: "خطأ", description: error.message });
+        } finally {
+            setIsReconciling(false);
+        }
+    };
+
+    const handleUpdate = async (id: number, status: 'Resolved' | 'Dismissed') => {
+        try {
+            const token = localStorage.getItem('authToken');
+            const response = await fetch(`/api/attendance/exceptions/${id}`, {
+                method: 'PATCH',
+                headers: { 'Authorization': `Bearer ${token}`, 'Content-Type': 'application/json' },
+                body: JSON.stringify({ status })
+            });
+            if (!response.ok) throw new Error('فشل في تحديث الاستثناء');
+            setExceptions(prev => prev.filter(e => e.id !== id));
+        } catch (error: any) {
+            toast({ variant: "destructive", title: "خطأ", description: error.message });
+        }
+    };
+
     return (
         <Card>
-            <CardHeader>
-                <CardTitle>قائمة الاستثناءات</CardTitle>
-                <CardDescription>مراجعة ومعالجة استثناءات الحضور مثل نسيان البصمة. (قيد التطوير)</CardDescription>
+            <CardHeader className="flex flex-row items-start justify-between gap-4">
+                <div>
+                    <CardTitle>قائمة الاستثناءات</CardTitle>
+                    <CardDescription>مطابقة البصمات مع جدول المناوبات المنشور ومراجعة حالات عدم الحضور والمناوبات المختلفة.</CardDescription>
+                </div>
+                <div className="flex items-center gap-2">
+                    <Select value={typeFilter} onValueChange={setTypeFilter}>
+                        <SelectTrigger className="w-44">
+                            <SelectValue />
+                        </SelectTrigger>
+                        <SelectContent>
+                            <SelectItem value="all">كل الأنواع</SelectItem>
+                            {Object.entries(typeLabels).map(([value, label]) => (
+                                <SelectItem key={value} value={value}>{label}</SelectItem>
+                            ))}
+                        </SelectContent>
+                    </Select>
+                    <Button variant="outline" onClick={handleReconcile} disabled={isReconciling}>
+                        {isReconciling ? <Loader2 className="ml-2 h-4 w-4 animate-spin" /> : <RefreshCw className="ml-2 h-4 w-4" />}
+                        مطابقة الأمس
+                    </Button>
+                </div>
             </CardHeader>
             <CardContent>
-                 <div className="text-center text-muted-foreground p-8">
-                    سيتم هنا عرض قائمة بالاستثناءات التي تحتاج إلى مراجعة.
-                </div>
+                {isLoading ? (
+                    <div className="flex items-center justify-center p-8">
+                        <Loader2 className="h-8 w-8 animate-spin" />
+                    </div>
+                ) : (
+                    <Table>
+                        <TableHeader>
+                            <TableRow>
+                                <TableHead>الموظف</TableHead>
+                                <TableHead>التاريخ</TableHead>
+                                <TableHead>النوع</TableHead>
+                                <TableHead>الوقت المتوقع</TableHead>
+                                <TableHead>البصمات</TableHead>
+                                <TableHead>إجراءات</TableHead>
+                            </TableRow>
+                        </TableHeader>
+                        <TableBody>
+                            {exceptions.length > 0 ? exceptions.map(item => (
+                                <TableRow key={item.id}>
+                                    <TableCell className="font-medium">
+                                        <Link href={`/attendance/history/${item.employee_id}`} className="hover:underline">
+                                            {item.employee_name}
+                                        </Link>
+                                    </TableCell>
+                                    <TableCell>{item.date}</TableCell>
+                                    <TableCell>
+                                        <Badge variant={item.type === 'no_show' ? 'destructive' : 'secondary'}>{typeLabels[item.type] || item.type}</Badge>
+                                    </TableCell>
+                                    <TableCell dir="ltr" className="text-right">
+                                        {item.details?.expected ? `${formatTime(item.details.expected[0])} - ${formatTime(item.details.expected[1])}` : '-'}
+                                    </TableCell>
+                                    <TableCell dir="ltr" className="text-right">
+                                        {item.details?.punches?.length ? item.details.punches.map(formatTime).join(', ') : '-'}
+                                    </TableCell>
+                                    <TableCell className="flex gap-1">
+                                        <Button variant="ghost" size="icon" title="تمت المعالجة" onClick={() => handleUpdate(item.id, 'Resolved')}>
+                                            <Check className="h-4 w-4" />
+                                        </Button>
+                                        <Button variant="ghost" size="icon" title="تجاهل" onClick={() => handleUpdate(item.id, 'Dismissed')}>
+                                            <X className="h-4 w-4" />
+                                        </Button>
+                                    </TableCell>
+                                </TableRow>
+                            )) : (
+                                <TableRow><TableCell colSpan={6} className="h-24 text-center">لا توجد استثناءات مفتوحة.</TableCell></TableRow>
+                            )}
+                        </TableBody>
+                    </Table>
+                )}
             </CardContent>
         </Card>
     )
@@ -1,4 +1,3 @@
-
 'use client';
 
 import { useState, useEffect } from 'react';
@@ -10,6 +9,7 @@ import {
 } from '@/components/ui/dialog';
 import { Button } from '@/components/ui/button';
 import { Loader2, Download } from 'lucide-react';
+import { getSignedUrl } from '@/lib/utils';
 import type { ChecklistItem } from '../page';
 
 interface PreviewDocumentDialogProps {
@@ -18,63 +18,36 @@ interface PreviewDocumentDialogProps {
   item: ChecklistItem;
 }
 
+// The browser loads the file itself (through a signed URL) so that the PDF viewer can
+// request byte ranges and repeated previews are answered from the HTTP cache.
+const getFileUrl = (filePath: string) => {
+  // Clean up path to remove any '..' parts just in case
+  const cleanedPath = filePath.replace(/\.\.\//g, '');
+  return getSignedUrl(`/api/uploads/${cleanedPath}`);
+};
+
 export function PreviewDocumentDialog({ open, onOpenChange, item }: PreviewDocumentDialogProps) {
   const [fileUrl, setFileUrl] = useState<string | null>(null);
   const [isLoading, setIsLoading] = useState(true);
 
-  useEffect(() => {
-    let objectUrl: string | null = null;
-
-    const fetchAsBlob = async (filePath: string) => {
-        setIsLoading(true);
-        setFileUrl(null); // Reset previous URL
-        const token = localStorage.getItem('authToken');
-        
-        // Clean up path to remove any '..' parts just in case
-        const cleanedPath = filePath.replace(/\.\.\//g, '');
-        const url = `/api/uploads/${cleanedPath}`;
-        
-        try {
-            const res = await fetch(url, { headers: { 'Authorization': `Bearer ${token}` } });
-            if (!res.ok) {
-              const errorBody = await res.text();
-              console.error("Fetch error:", res.status, errorBody);
-              throw new Error('Failed to fetch file');
-            }
-            const blob = await res.blob();
-            objectUrl = URL.createObjectURL(blob);
-            setFileUrl(objectUrl);
-        } catch (error) {
-            console.error("Failed to load file for preview:", error);
-        } finally {
-            setIsLoading(false);
-        }
-      };
+  const canPreview = item.mime_type?.startsWith('image/') || item.mime_type === 'application/pdf';
 
+  useEffect(() => {
+    let cancelled = false;
+    setFileUrl(null);
     if (open && item.file_path) {
-      if (item.mime_type?.startsWith('image/') || item.mime_type === 'application/pdf') {
-        fetchAsBlob(item.file_path);
-      } else {
-        // For other file types that can't be previewed
-        setIsLoading(false);
-        setFileUrl(null);
-      }
+      setIsLoading(true);
+      getFileUrl(item.file_path)
+        .then(url => { if (!cancelled) setFileUrl(url); })
+        .catch(() => { if (!cancelled) setIsLoading(false); })
+        // For other file types that can't be previewed the URL is only used for the download link
+        .finally(() => { if (!cancelled && !canPreview) setIsLoading(false); });
+    } else {
+      setIsLoading(false);
     }
-
-    return () => {
-      // Clean up the object URL to avoid memory leaks
-      if (objectUrl) {
-        URL.revokeObjectURL(objectUrl);
-      }
-    };
+    return () => { cancelled = true; };
   // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [open, item.file_path, item.mime_type]);
-  
-  const getDownloadUrl = () => {
-    if (!item.file_path) return '#';
-    const cleanedPath = item.file_path.replace(/\.\.\//g, '');
-    return `/api/uploads/${cleanedPath}`;
-  }
 
   return (
     <Dialog open={open} onOpenChange={onOpenChange}>
@@ -82,8 +55,8 @@ export function PreviewDocumentDialog({ open, onOpenChange, item }: PreviewDocum
         <DialogHeader>
           <DialogTitle className="flex justify-between items-center">
             <span>معاينة: {item.doc_type.title_ar}</span>
-            {item.file_path && (
-                <a href={getDownloadUrl()} download={item.file_name || 'document'}>
+            {fileUrl && (
+                <a href={fileUrl} download={item.file_name || 'document'}>
                 <Button variant="outline" size="sm">
                     <Download className="ml-2 h-4 w-4"/>
                     تحميل
@@ -92,18 +65,17 @@ export function PreviewDocumentDialog({ open, onOpenChange, item }: PreviewDocum
             )}
           </DialogTitle>
         </DialogHeader>
-        <div className="flex-grow flex items-center justify-center bg-muted/50 rounded-md overflow-hidden">
-          {isLoading ? (
-             <Loader2 className="h-8 w-8 animate-spin" />
-          ) : fileUrl ? (
+        <div className="relative flex-grow flex items-center justify-center bg-muted/50 rounded-md overflow-hidden">
+          {isLoading && (
+             <Loader2 className="absolute h-8 w-8 animate-spin" />
+          )}
+          {fileUrl && canPreview ? (
             item.mime_type?.startsWith('image/') ? (
-                <img src={fileUrl} alt={item.doc_type.title_ar} className="max-w-full max-h-full object-contain" />
-            ) : item.mime_type === 'application/pdf' ? (
-                <iframe src={fileUrl} className="w-full h-full" title={item.doc_type.title_ar} />
+                <img src={fileUrl} alt={item.doc_type.title_ar} className="max-w-full max-h-full object-contain" onLoad={() => setIsLoading(false)} onError={() => setIsLoading(false)} />
             ) : (
-                <p>لا يمكن عرض هذا الملف.</p>
+                <iframe src={fileUrl} className="w-full h-full" title={item.doc_type.title_ar} onLoad={() => setIsLoading(false)} />
             )
-          ) : (
+          ) : !isLoading && (
             <p>لا يمكن عرض هذا الملف.</p>
           )}
         </div>
@@ -16,6 +16,7 @@ import {
 import { Button } from '@/components/ui/button';
 import { Input } from '@/components/ui/input';
 import { Label } from '@/components/ui/label';
+import { Progress } from '@/components/ui/progress';
 import { useToast } from '@/components/ui/use-toast';
 import { Loader2, UploadCloud, FileCheck2, AlertCircle } from 'lucide-react';
 import type { ChecklistItem } from '../page';
@@ -36,10 +37,85 @@ const uploadSchema = z.object({
 
 type UploadFormValues = z.infer<typeof uploadSchema>;
 
+const CHUNK_SIZE = 2 * 1024 * 1024;
+const MAX_RETRIES = 5;
+
+// Sends the file in chunks through an upload session. The session id is kept in
+// localStorage so that retrying the same file after a dropped connection resumes it.
+async function uploadInChunks(file: File, token: string | null, meta: Record<string, unknown>, onProgress: (percent: number) => void) {
+  const headers = { Authorization: `Bearer ${token}` };
+  const sessionKey = `upload-session:${meta.employee_id}:${meta.doc_type_id}:${file.name}:${file.size}:${file.lastModified}`;
+
+  let session: { id: string; received_size: number; status: string } | null = null;
+  const savedId = localStorage.getItem(sessionKey);
+  if (savedId) {
+    const response = await fetch(`/api/upload-sessions/${savedId}`, { headers });
+    if (response.ok) {
+      const saved = await response.json();
+      if (saved.status === 'Uploading') session = saved;
+    }
+  }
+  if (!session) {
+    // With the content hash the server can link a file it already stores without a transfer
+    const sha256 = crypto?.subtle && file.size <= 64 * 1024 * 1024
+      ? Array.from(new Uint8Array(await crypto.subtle.digest('SHA-256', await file.arrayBuffer()))).map(b => b.toString(16).padStart(2, '0')).join('')
+      : undefined;
+    const response = await fetch('/api/upload-sessions', {
+      method: 'POST',
+      headers: { ...headers, 'Content-Type': 'application/json' },
+      body: JSON.stringify({ ...meta, purpose: 'employee_document', file_name: file.name, mime_type: file.type, total_size: file.size, sha256 }),
+    });
+    const result = await response.json();
+    if (!response.ok) throw new Error(result.message || 'فشل رفع الملف');
+    if (result.status === 'Completed') {
+      onProgress(100);
+      return;
+    }
+    session = result;
+    localStorage.setItem(sessionKey, result.id);
+  }
+
+  let offset = session!.received_size;
+  let retries = 0;
+  onProgress(Math.round((offset / file.size) * 100));
+  while (offset < file.size) {
+    const end = Math.min(offset + CHUNK_SIZE, file.size);
+    let response: Response;
+    try {
+      response = await fetch(`/api/upload-sessions/${session!.id}`, {
+        method: 'PUT',
+        headers: { ...headers, 'Content-Type': 'application/octet-stream', 'Content-Range': `bytes ${offset}-${end - 1}/${file.size}` },
+        body: file.slice(offset, end),
+      });
+    } catch (error) {
+      // Network failure: wait, then ask the server how much it kept
+      if (++retries > MAX_RETRIES) throw new Error('انقطع الاتصال أثناء الرفع، أعد المحاولة لاستكمال الرفع');
+      await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+      const status = await fetch(`/api/upload-sessions/${session!.id}`, { headers }).then(r => r.json()).catch(() => null);
+      if (status) offset = status.received_size;
+      continue;
+    }
+    const result = await response.json();
+    if (!response.ok && typeof result.received_size === 'number' && retries++ < MAX_RETRIES) {
+      offset = result.received_size;
+      continue;
+    }
+    if (!response.ok) {
+      localStorage.removeItem(sessionKey);
+      throw new Error(result.message || 'فشل رفع الملف');
+    }
+    offset = result.received_size;
+    retries = 0;
+    onProgress(Math.round((offset / file.size) * 100));
+  }
+  localStorage.removeItem(sessionKey);
+}
+
 export function UploadDocumentDialog({ open, onOpenChange, onSuccess, checklistItem, employeeId }: UploadDocumentDialogProps) {
   const { toast } = useToast();
   const [isSubmitting, setIsSubmitting] = useState(false);
   const [uploadError, setUploadError] = useState<string | null>(null);
+  const [progress, setProgress] = useState(0);
 
   const { control, handleSubmit, setValue, watch, reset } = useForm<UploadFormValues>({
     resolver: zodResolver(uploadSchema),
@@ -79,25 +155,14 @@ export function UploadDocumentDialog({ open, onOpenChange, onSuccess, checklistI
 
   const onSubmit = async (data: UploadFormValues) => {
     setIsSubmitting(true);
-    const formData = new FormData();
-    formData.append('doc_type_id', String(checklistItem.doc_type.id));
-    formData.append('file', data.file);
-    if (data.expiry_date) {
-      formData.append('expiry_date', data.expiry_date);
-    }
-    
+    setProgress(0);
     try {
       const token = localStorage.getItem('authToken');
-      const response = await fetch(`/api/documents/employee/${employeeId}/upload`, {
-        method: 'POST',
-        headers: { Authorization: `Bearer ${token}` },
-        body: formData,
-      });
-
-      const result = await response.json();
-      if (!response.ok) {
-        throw new Error(result.message || 'فشل رفع الملف');
-      }
+      await uploadInChunks(data.file, token, {
+        employee_id: employeeId,
+        doc_type_id: checklistItem.doc_type.id,
+        expiry_date: data.expiry_date || null,
+      }, setProgress);
       onSuccess();
       reset();
     } catch (error: any) {
@@ -138,6 +203,7 @@ export function UploadDocumentDialog({ open, onOpenChange, onSuccess, checklistI
                         </div>
                     )}
                 </div>
+                {isSubmitting && <Progress value={progress} className="mt-2" />}
                 {uploadError && <p className="text-sm text-destructive mt-2 flex items-center gap-1"><AlertCircle className="h-4 w-4" /> {uploadError}</p>}
             </div>
 
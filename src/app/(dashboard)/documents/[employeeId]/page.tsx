@@ -21,6 +21,7 @@ export interface ChecklistItem {
   mime_type: string | null;
   expiry_date: string | null;
   note: string | null;
+  thumbnail_url: string | null;
 }
 
 const statusMap = {
@@ -155,6 +156,16 @@ export default function EmployeeChecklistPage() {
                            </div>
                       </CardHeader>
                       <CardContent>
+                          {item.thumbnail_url && (
+                              <button type="button" className="mb-3 block w-full overflow-hidden rounded-md bg-background" onClick={() => handlePreviewClick(item)}>
+                                  <img
+                                      src={item.thumbnail_url}
+                                      alt={item.doc_type.title_ar}
+                                      loading="lazy"
+                                      className="mx-auto h-32 object-contain"
+                                  />
+                              </button>
+                          )}
                           <p className={`text-sm font-semibold ${status.color}`}>{status.text}</p>
                           {item.doc_type.requires_expiry && (
                                <p className={`text-xs mt-1 ${expiryColor}`}>
@@ -12,6 +12,7 @@ import { MoreHorizontal, Loader2, Search, ListFilter, FileDown, BellRing, Eye, F
 import { useToast } from '@/components/ui/use-toast';
 import { useRouter } from 'next/navigation';
 import type { EmployeeWithCompliance } from '@/lib/types';
+import { getSignedUrl } from '@/lib/utils';
 import { Input } from '@/components/ui/input';
 
 const ComplianceBar = ({ value }: { value: number }) => {
@@ -58,6 +59,15 @@ export default function DocumentsOverviewPage() {
         fetchOverview();
     }, [router, toast]);
 
+    // The archive is streamed by the server; navigating to it lets the browser save it to disk as it arrives
+    const downloadArchive = async (params: Record<string, string | number> = {}) => {
+        try {
+            window.location.href = await getSignedUrl('/api/documents/export', params);
+        } catch (error: any) {
+            toast({ variant: 'destructive', title: 'خطأ', description: error.message });
+        }
+    };
+
     const formatRelativeTime = (isoDate: string) => {
         if (isoDate === "لم يحدث") return isoDate;
         try {
@@ -91,7 +101,7 @@ export default function DocumentsOverviewPage() {
                         </CardDescription>
                     </div>
                     <div className="flex items-center gap-2">
-                         <Button variant="outline" size="sm" disabled>
+                         <Button variant="outline" size="sm" onClick={() => downloadArchive()}>
                             <FileDown className="ml-2 h-4 w-4" />
                             تصدير
                         </Button>
@@ -164,7 +174,10 @@ export default function DocumentsOverviewPage() {
                                         </div>
                                     </TableCell>
                                     <TableCell className="text-right font-medium">{emp.missing_docs_count}</TableCell>
-                                    <TableCell className="text-right text-amber-600 font-medium">{emp.expiring_docs_count}</TableCell>
+                                    <TableCell className="text-right text-amber-600 font-medium">
+                                        {emp.expiring_docs_count}
+                                        {emp.expired_docs_count > 0 && <span className="text-destructive text-xs mr-2">({emp.expired_docs_count} منتهية)</span>}
+                                    </TableCell>
                                     <TableCell className="text-right text-xs text-muted-foreground">{formatRelativeTime(emp.last_updated)}</TableCell>
                                     <TableCell className="text-right">
                                         <DropdownMenu>
@@ -177,7 +190,7 @@ export default function DocumentsOverviewPage() {
                                                     <Eye className="ml-2 h-4 w-4" />
                                                     عرض قائمة المستندات
                                                 </DropdownMenuItem>
-                                                <DropdownMenuItem disabled>
+                                                <DropdownMenuItem onSelect={() => downloadArchive({ employee_id: emp.id })}>
                                                     <FileArchive className="ml-2 h-4 w-4" />
                                                     تصدير ZIP
                                                 </DropdownMenuItem>
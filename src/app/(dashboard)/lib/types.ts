@@ -140,6 +140,7 @@ export type Job = {
   created_at: string;
   department?: { name_ar: string }; // For UI
   applicants_count?: number; // For UI
+  stage_counts?: Partial<Record<Applicant['stage'], number>>;
 };
 
 
@@ -152,6 +153,7 @@ export type Applicant = {
   source: string;
   stage: 'Applied' | 'Screening' | 'Interview' | 'Offer' | 'Hired' | 'Rejected';
   cv_path?: string | null;
+  cv_file_name?: string | null;
   rating?: number;
   notes?: string | null;
   created_at: string;
@@ -24,7 +24,7 @@ import {
   Loader2,
   Briefcase,
 } from 'lucide-react';
-import type { Employee, LeaveRequest, PerformanceReview } from '@/lib/types';
+import type { LeaveRequest } from '@/lib/types';
 import Link from 'next/link';
 import { Avatar, AvatarFallback, AvatarImage } from '@/components/ui/avatar';
 import { useState, useEffect, useCallback } from 'react';
@@ -67,20 +67,16 @@ export default function DashboardPage() {
       }
       const data = await response.json();
       
-      const averagePerformance = data.performanceReviews.length > 0 
-        ? (data.performanceReviews.reduce((acc: number, r: PerformanceReview) => acc + r.score, 0) / data.performanceReviews.length).toFixed(1) 
-        : "0";
-      
-      const openJobsCount = data.jobs?.length || 0;
+      const { kpis } = data;
 
       setStats([
-        { title: 'إجمالي الموظفين', value: data.employees.length, icon: Users, change: `+${data.employees.filter((e: Employee) => e.hire_date && new Date(e.hire_date).getMonth() === new Date().getMonth()).length} هذا الشهر` },
-        { title: 'طلبات الإجازة المعلقة', value: data.leaveRequests.filter((l: LeaveRequest) => l.status === 'Pending').length, icon: CalendarCheck, change: `${data.leaveRequests.filter((l: LeaveRequest) => l.status === 'Approved').length} موافق عليها` },
-        { title: 'وظائف شاغرة', value: openJobsCount, icon: Briefcase },
-        { title: 'متوسط تقييم الأداء', value: averagePerformance, icon: Star, change: 'مقارنة بالربع الماضي' },
+        { title: 'إجمالي الموظفين', value: kpis.total_employees, icon: Users, change: `+${kpis.new_hires_this_month} هذا الشهر` },
+        { title: 'طلبات الإجازة المعلقة', value: kpis.pending_leaves, icon: CalendarCheck, change: `${kpis.approved_leaves} موافق عليها` },
+        { title: 'وظائف شاغرة', value: kpis.open_jobs, icon: Briefcase },
+        { title: 'متوسط تقييم الأداء', value: kpis.average_performance.toFixed(1), icon: Star, change: 'مقارنة بالربع الماضي' },
       ]);
 
-      setPendingLeaves(data.leaveRequests.filter((l: LeaveRequest) => l.status === 'Pending').slice(0, 5));
+      setPendingLeaves(data.pendingLeaves);
       setRecentActivities(data.recentActivities);
 
     } catch (error: any) {
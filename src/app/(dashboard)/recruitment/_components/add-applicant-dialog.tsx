@@ -187,6 +187,13 @@ export function AddApplicantDialog({ open, onOpenChange, jobId, onSuccess }: Add
         }
 
       toast({ title: `تم إضافة ${createdApplicants.length} متقدمين بنجاح` });
+      const duplicates = createdApplicants.filter(a => a.possible_duplicates?.length);
+      if (duplicates.length > 0) {
+        toast({
+          title: 'متقدمون محتملو التكرار',
+          description: duplicates.map(a => `${a.full_name}: ${a.possible_duplicates.map((m: any) => m.full_name).join('، ')}`).join(' | '),
+        });
+      }
       form.reset();
       onSuccess();
       onOpenChange(false);
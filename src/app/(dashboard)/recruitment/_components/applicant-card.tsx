@@ -29,6 +29,15 @@ interface ApplicantCardProps {
   onEdit: (applicant: Applicant) => void;
 }
 
+type DuplicateMatch = {
+  type: 'applicant' | 'employee';
+  id: number;
+  full_name: string;
+  email: string;
+  phone?: string | null;
+  matched_on: string[];
+};
+
 const STAGES = [
   { id: 'Applied', title: 'التقديم' },
   { id: 'Screening', title: 'الفرز' },
@@ -40,10 +49,11 @@ const STAGES = [
 
 export function ApplicantCard({ applicant, onActionComplete, onEdit }: ApplicantCardProps) {
   const [isDeleteAlertOpen, setIsDeleteAlertOpen] = useState(false);
+  const [hireDuplicates, setHireDuplicates] = useState<DuplicateMatch[]>([]);
   const { toast } = useToast();
   const router = useRouter();
 
-  const handleAction = async (action: 'move' | 'delete' | 'hire', newStage?: string) => {
+  const handleAction = async (action: 'move' | 'delete' | 'hire', newStage?: string, force = false) => {
     try {
       const token = localStorage.getItem('authToken');
       let url = '';
@@ -57,7 +67,7 @@ export function ApplicantCard({ applicant, onActionComplete, onEdit }: Applicant
         url = `/api/recruitment/applicants/${applicant.id}`;
         method = 'DELETE';
       } else if (action === 'hire') {
-        url = `/api/recruitment/applicants/${applicant.id}/hire`;
+        url = `/api/recruitment/applicants/${applicant.id}/hire${force ? '?force=true' : ''}`;
         method = 'POST';
       }
       
@@ -71,6 +81,12 @@ export function ApplicantCard({ applicant, onActionComplete, onEdit }: Applicant
       });
 
       const result = await response.json();
+      // A phone match with an existing employee can be overridden; an email match cannot.
+      if (action === 'hire' && response.status === 409 && result.possible_duplicates?.length
+          && !result.possible_duplicates.some((m: DuplicateMatch) => m.matched_on.includes('email'))) {
+        setHireDuplicates(result.possible_duplicates);
+        return;
+      }
       if (!response.ok) throw new Error(result.message || 'فشل تنفيذ الإجراء');
       
       let successMessage = `تم نقل ${applicant.full_name} إلى مرحلة "${STAGES.find(s => s.id === newStage)?.title}"`;
@@ -176,6 +192,26 @@ export function ApplicantCard({ applicant, onActionComplete, onEdit }: Applicant
             </AlertDialogFooter>
         </AlertDialogContent>
       </AlertDialog>
+
+      <AlertDialog open={hireDuplicates.length > 0} onOpenChange={(open) => !open && setHireDuplicates([])}>
+        <AlertDialogContent>
+            <AlertDialogHeader>
+                <AlertDialogTitle>موظف محتمل التكرار</AlertDialogTitle>
+                <AlertDialogDescription>
+                    يوجد موظف بنفس رقم الهاتف الخاص بالمتقدم "{applicant.full_name}". تأكد من أنه ليس نفس الشخص قبل المتابعة.
+                </AlertDialogDescription>
+            </AlertDialogHeader>
+            <ul className="space-y-1 text-sm">
+                {hireDuplicates.map(match => (
+                    <li key={`${match.type}-${match.id}`}>{match.full_name} - {match.email} {match.phone && <span dir="ltr">({match.phone})</span>}</li>
+                ))}
+            </ul>
+            <AlertDialogFooter>
+                <AlertDialogCancel>إلغاء</AlertDialogCancel>
+                <AlertDialogAction onClick={() => { setHireDuplicates([]); handleAction('hire', undefined, true); }}>توظيف على أي حال</AlertDialogAction>
+            </AlertDialogFooter>
+        </AlertDialogContent>
+      </AlertDialog>
     </>
   );
 }
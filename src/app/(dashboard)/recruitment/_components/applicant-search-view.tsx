@@ -0,0 +1,214 @@
+'use client';
+
+import { useState, useEffect, useCallback } from 'react';
+import { Card, CardContent, CardHeader, CardTitle, CardDescription } from '@/components/ui/card';
+import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from '@/components/ui/table';
+import { Badge } from '@/components/ui/badge';
+import { Button } from '@/components/ui/button';
+import { Input } from '@/components/ui/input';
+import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@/components/ui/select';
+import { Loader2, Search } from 'lucide-react';
+import { useToast } from '@/components/ui/use-toast';
+import { useRouter } from 'next/navigation';
+import type { Applicant, Job } from '@/lib/types';
+
+type SearchResult = Applicant & { job_title: string; cv_snippet: string | null };
+
+type Facets = {
+    stage: Record<string, number>;
+    job_id: Record<string, number>;
+    source: Record<string, number>;
+    experience: Record<string, number>;
+};
+
+const stageLabels: { [key: string]: string } = {
+    Applied: 'تقدم',
+    Screening: 'فرز',
+    Interview: 'مقابلة',
+    Offer: 'عرض',
+    Hired: 'تم التوظيف',
+    Rejected: 'مرفوض',
+};
+
+const experienceRanges: { [key: string]: [string, string] } = {
+    '0-2': ['0', '2'],
+    '3-5': ['3', '5'],
+    '6-10': ['6', '10'],
+    '11+': ['11', ''],
+};
+
+// The API wraps matched words in \x02…\x03; render them as <mark> without using innerHTML.
+const Snippet = ({ text }: { text: string }) => (
+    <>
+        {text.split('\x02').map((part, i) => {
+            const [match, rest] = i === 0 ? ['', part] : part.split('\x03');
+            return <span key={i}>{match && <mark>{match}</mark>}{rest}</span>;
+        })}
+    </>
+);
+
+export function ApplicantSearchView({ jobs }: { jobs: Job[] }) {
+    const [query, setQuery] = useState('');
+    const [debouncedQuery, setDebouncedQuery] = useState('');
+    const [stage, setStage] = useState('all');
+    const [jobId, setJobId] = useState('all');
+    const [source, setSource] = useState('all');
+    const [experience, setExperience] = useState('all');
+    const [page, setPage] = useState(1);
+    const [results, setResults] = useState<SearchResult[]>([]);
+    const [facets, setFacets] = useState<Facets | null>(null);
+    const [total, setTotal] = useState(0);
+    const [pages, setPages] = useState(0);
+    const [isLoading, setIsLoading] = useState(true);
+    const { toast } = useToast();
+    const router = useRouter();
+
+    useEffect(() => {
+        const timer = setTimeout(() => setDebouncedQuery(query.trim()), 300);
+        return () => clearTimeout(timer);
+    }, [query]);
+
+    useEffect(() => {
+        setPage(1);
+    }, [debouncedQuery, stage, jobId, source, experience]);
+
+    const fetchResults = useCallback(async () => {
+        setIsLoading(true);
+        try {
+            const token = localStorage.getItem('authToken');
+            if (!token) {
+                router.push('/login');
+                return;
+            }
+            const params = new URLSearchParams({ page: String(page) });
+            if (debouncedQuery) params.set('q', debouncedQuery);
+            if (stage !== 'all') params.set('stage', stage);
+            if (jobId !== 'all') params.set('job_id', jobId);
+            if (source !== 'all') params.set('source', source);
+            if (experience !== 'all') {
+                const [min, max] = experienceRanges[experience];
+                params.set('min_experience', min);
+                if (max) params.set('max_experience', max);
+            }
+            const response = await fetch(`/api/recruitment/applicants/search?${params}`, {
+                headers: { 'Authorization': `Bearer ${token}` }
+            });
+            const data = await response.json();
+            if (!response.ok) throw new Error(data.message || 'فشل في البحث عن المتقدمين');
+            setResults(data.applicants);
+            setFacets(data.facets);
+            setTotal(data.total);
+            setPages(data.pages);
+        } catch (error: any) {
+            toast({ variant: 'destructive', title: 'خطأ', description: error.message });
+        } finally {
+            setIsLoading(false);
+        }
+    }, [router, toast, page, debouncedQuery, stage, jobId, source, experience]);
+
+    useEffect(() => {
+        fetchResults();
+    }, [fetchResults]);
+
+    const jobTitle = (id: string) => jobs.find(j => String(j.id) === id)?.title || `#${id}`;
+    const withCount = (label: string, count?: number) => count !== undefined ? `${label} (${count})` : label;
+
+    return (
+        <Card>
+            <CardHeader>
+                <CardTitle>البحث في المتقدمين</CardTitle>
+                <CardDescription>ابحث بالاسم أو البريد أو الهاتف أو المسمى الحالي أو محتوى السيرة الذاتية.</CardDescription>
+                <div className="flex flex-wrap items-center gap-2 pt-2">
+                    <div className="relative flex-1 min-w-[220px]">
+                        <Search className="absolute right-2.5 top-2.5 h-4 w-4 text-muted-foreground" />
+                        <Input value={query} onChange={e => setQuery(e.target.value)} placeholder="بحث..." className="pr-8" />
+                    </div>
+                    <Select value={stage} onValueChange={setStage}>
+                        <SelectTrigger className="w-40"><SelectValue /></SelectTrigger>
+                        <SelectContent>
+                            <SelectItem value="all">كل المراحل</SelectItem>
+                            {Object.entries(stageLabels).map(([value, label]) => (
+                                <SelectItem key={value} value={value}>{withCount(label, facets?.stage[value] ?? 0)}</SelectItem>
+                            ))}
+                        </SelectContent>
+                    </Select>
+                    <Select value={jobId} onValueChange={setJobId}>
+                        <SelectTrigger className="w-48"><SelectValue /></SelectTrigger>
+                        <SelectContent>
+                            <SelectItem value="all">كل الوظائف</SelectItem>
+                            {Object.entries(facets?.job_id || {}).map(([value, count]) => (
+                                <SelectItem key={value} value={value}>{withCount(jobTitle(value), count)}</SelectItem>
+                            ))}
+                        </SelectContent>
+                    </Select>
+                    <Select value={source} onValueChange={setSource}>
+                        <SelectTrigger className="w-36"><SelectValue /></SelectTrigger>
+                        <SelectContent>
+                            <SelectItem value="all">كل المصادر</SelectItem>
+                            {Object.entries(facets?.source || {}).map(([value, count]) => (
+                                <SelectItem key={value} value={value}>{withCount(value, count)}</SelectItem>
+                            ))}
+                        </SelectContent>
+                    </Select>
+                    <Select value={experience} onValueChange={setExperience}>
+                        <SelectTrigger className="w-36"><SelectValue /></SelectTrigger>
+                        <SelectContent>
+                            <SelectItem value="all">كل الخبرات</SelectItem>
+                            {Object.keys(experienceRanges).map(range => (
+                                <SelectItem key={range} value={range}>{withCount(`${range} سنوات`, facets?.experience[range] ?? 0)}</SelectItem>
+                            ))}
+                        </SelectContent>
+                    </Select>
+                </div>
+            </CardHeader>
+            <CardContent>
+                {isLoading ? (
+                    <div className="flex items-center justify-center p-8">
+                        <Loader2 className="h-8 w-8 animate-spin" />
+                    </div>
+                ) : (
+                    <>
+                        <Table>
+                            <TableHeader>
+                                <TableRow>
+                                    <TableHead>المتقدم</TableHead>
+                                    <TableHead>الوظيفة</TableHead>
+                                    <TableHead>المرحلة</TableHead>
+                                    <TableHead>المسمى الحالي</TableHead>
+                                    <TableHead>الخبرة</TableHead>
+                                </TableRow>
+                            </TableHeader>
+                            <TableBody>
+                                {results.length > 0 ? results.map(applicant => (
+                                    <TableRow key={applicant.id}>
+                                        <TableCell>
+                                            <div className="font-medium">{applicant.full_name}</div>
+                                            <div className="text-xs text-muted-foreground">{applicant.email}</div>
+                                            {applicant.cv_snippet && (
+                                                <p className="mt-1 text-xs text-muted-foreground line-clamp-2"><Snippet text={applicant.cv_snippet} /></p>
+                                            )}
+                                        </TableCell>
+                                        <TableCell>{applicant.job_title}</TableCell>
+                                        <TableCell><Badge variant="secondary">{stageLabels[applicant.stage] || applicant.stage}</Badge></TableCell>
+                                        <TableCell>{[applicant.current_title, applicant.current_company].filter(Boolean).join(' - ') || '-'}</TableCell>
+                                        <TableCell>{applicant.years_experience ?? '-'}</TableCell>
+                                    </TableRow>
+                                )) : (
+                                    <TableRow><TableCell colSpan={5} className="h-24 text-center">لا توجد نتائج مطابقة.</TableCell></TableRow>
+                                )}
+                            </TableBody>
+                        </Table>
+                        <div className="flex items-center justify-between pt-4 text-sm text-muted-foreground">
+                            <span>{total} متقدم</span>
+                            <div className="flex items-center gap-2">
+                                <Button variant="outline" size="sm" disabled={page <= 1} onClick={() => setPage(p => p - 1)}>السابق</Button>
+                                <span>{pages ? `${page} / ${pages}` : '-'}</span>
+                                <Button variant="outline" size="sm" disabled={page >= pages} onClick={() => setPage(p => p + 1)}>التالي</Button>
+                            </div>
+                        </div>
+                    </>
+                )}
+            </CardContent>
+        </Card>
+    );
+}
@@ -159,7 +159,7 @@ export function EditApplicantDialog({ open, onOpenChange, applicant, onSuccess }
                     <FormField control={form.control} name="cvFile" render={({ field }) => (<FormItem><FormControl>
                           <Input id={`cv_upload_edit`} type="file" className="block w-full text-sm text-gray-500 file:mr-4 file:py-2 file:px-4 file:rounded-full file:border-0 file:text-sm file:font-semibold file:bg-violet-50 file:text-violet-700 hover:file:bg-violet-100" accept="application/pdf" onChange={(e) => field.onChange(e.target.files ? e.target.files[0] : null)} />
                     </FormControl><FormMessage /></FormItem>)}/>
-                    {applicant?.cv_path && <p className="text-xs text-muted-foreground">الملف الحالي: {applicant.cv_path.split('/').pop()}</p>}
+                    {applicant?.cv_path && <p className="text-xs text-muted-foreground">الملف الحالي: {applicant.cv_file_name || applicant.cv_path.split('/').pop()}</p>}
                   </div>
 
                    <h4 className="font-semibold text-lg border-b pb-2 pt-4">تفاصيل إضافية (اختياري)</h4>
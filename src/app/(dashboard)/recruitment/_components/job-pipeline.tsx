@@ -1,11 +1,11 @@
 
 'use client';
 
-import { useState } from 'react';
+import { useState, useEffect, useCallback } from 'react';
 import type { Job, Applicant } from '@/lib/types';
 import { StageColumn } from './stage-column';
 import { Button } from '@/components/ui/button';
-import { Lock } from 'lucide-react';
+import { Lock, Loader2 } from 'lucide-react';
 import { AlertDialog, AlertDialogAction, AlertDialogCancel, AlertDialogContent, AlertDialogDescription, AlertDialogFooter, AlertDialogHeader, AlertDialogTitle } from '@/components/ui/alert-dialog';
 import { Input } from '@/components/ui/input';
 import { useToast } from '@/components/ui/use-toast';
@@ -13,11 +13,17 @@ import { useRouter } from 'next/navigation';
 
 interface JobPipelineProps {
   job: Job;
-  applicants: Applicant[];
   onActionComplete: () => void;
   onEditApplicant: (applicant: Applicant) => void;
 }
 
+type BoardColumn = {
+  stage: string;
+  count: number;
+  applicants: Applicant[];
+  has_more: boolean;
+};
+
 const STAGES = [
   { id: 'Applied', title: 'التقديم' },
   { id: 'Screening', title: 'الفرز' },
@@ -26,12 +32,57 @@ const STAGES = [
   { id: 'Hired', title: 'تم التوظيف' },
 ];
 
-export function JobPipeline({ job, applicants, onActionComplete, onEditApplicant }: JobPipelineProps) {
+export function JobPipeline({ job, onActionComplete, onEditApplicant }: JobPipelineProps) {
   const [isCloseAlertOpen, setIsCloseAlertOpen] = useState(false);
   const [closeReason, setCloseReason] = useState('');
+  const [columns, setColumns] = useState<Record<string, BoardColumn>>({});
+  const [isLoading, setIsLoading] = useState(true);
   const { toast } = useToast();
   const router = useRouter();
 
+  // The board returns stage counts and the newest applicants of each column in one request;
+  // further pages of a column are loaded on demand.
+  const fetchBoard = useCallback(async () => {
+    try {
+      const token = localStorage.getItem('authToken');
+      const response = await fetch(`/api/recruitment/jobs/${job.id}/board`, {
+        headers: { Authorization: `Bearer ${token}` },
+      });
+      const result = await response.json();
+      if (!response.ok) throw new Error(result.message || 'فشل في جلب مراحل الوظيفة');
+      setColumns(Object.fromEntries(result.stages.map((column: BoardColumn) => [column.stage, column])));
+    } catch (error: any) {
+      toast({ variant: 'destructive', title: 'خطأ', description: error.message });
+    } finally {
+      setIsLoading(false);
+    }
+  }, [job, toast]);
+
+  useEffect(() => {
+    fetchBoard();
+  }, [fetchBoard]);
+
+  const handleLoadMore = async (stage: string) => {
+    const column = columns[stage];
+    if (!column) return;
+    try {
+      const token = localStorage.getItem('authToken');
+      const params = new URLSearchParams({ stage, offset: String(column.applicants.length) });
+      const response = await fetch(`/api/recruitment/jobs/${job.id}/board?${params}`, {
+        headers: { Authorization: `Bearer ${token}` },
+      });
+      const result = await response.json();
+      if (!response.ok) throw new Error(result.message || 'فشل في جلب المتقدمين');
+      const page: BoardColumn = result.stages[0];
+      setColumns(prev => ({
+        ...prev,
+        [stage]: { ...page, applicants: [...prev[stage].applicants, ...page.applicants] },
+      }));
+    } catch (error: any) {
+      toast({ variant: 'destructive', title: 'خطأ', description: error.message });
+    }
+  };
+
   const handleCloseJob = async () => {
     if (!closeReason) {
       toast({ variant: 'destructive', title: 'السبب مطلوب', description: 'يرجى كتابة سبب إغلاق الوظيفة.' });
@@ -73,18 +124,27 @@ export function JobPipeline({ job, applicants, onActionComplete, onEditApplicant
             إغلاق الوظيفة
           </Button>
         </div>
-        <div className="grid grid-cols-1 md:grid-cols-5 gap-4">
-          {STAGES.map(stage => (
-            <StageColumn
-              key={stage.id}
-              stage={stage}
-              jobId={job.id}
-              applicants={applicants.filter(a => a.stage === stage.id)}
-              onActionComplete={onActionComplete}
-              onEditApplicant={onEditApplicant}
-            />
-          ))}
-        </div>
+        {isLoading ? (
+          <div className="flex justify-center items-center h-64">
+            <Loader2 className="h-8 w-8 animate-spin" />
+          </div>
+        ) : (
+          <div className="grid grid-cols-1 md:grid-cols-5 gap-4">
+            {STAGES.map(stage => (
+              <StageColumn
+                key={stage.id}
+                stage={stage}
+                jobId={job.id}
+                applicants={columns[stage.id]?.applicants || []}
+                count={columns[stage.id]?.count || 0}
+                hasMore={columns[stage.id]?.has_more || false}
+                onLoadMore={() => handleLoadMore(stage.id)}
+                onActionComplete={onActionComplete}
+                onEditApplicant={onEditApplicant}
+              />
+            ))}
+          </div>
+        )}
       </div>
       
       <AlertDialog open={isCloseAlertOpen} onOpenChange={setIsCloseAlertOpen}>
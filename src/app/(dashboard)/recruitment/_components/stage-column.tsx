@@ -12,11 +12,14 @@ interface StageColumnProps {
   stage: { id: string; title: string };
   jobId: number;
   applicants: Applicant[];
+  count: number;
+  hasMore: boolean;
+  onLoadMore: () => void;
   onActionComplete: () => void;
   onEditApplicant: (applicant: Applicant) => void;
 }
 
-export function StageColumn({ stage, jobId, applicants, onActionComplete, onEditApplicant }: StageColumnProps) {
+export function StageColumn({ stage, jobId, applicants, count, hasMore, onLoadMore, onActionComplete, onEditApplicant }: StageColumnProps) {
   const [isAddDialogOpen, setIsAddDialogOpen] = useState(false);
 
   return (
@@ -25,7 +28,7 @@ export function StageColumn({ stage, jobId, applicants, onActionComplete, onEdit
         <div className="flex items-center justify-between mb-4">
           <h3 className="font-semibold text-md">{stage.title}</h3>
           <span className="text-sm font-medium text-muted-foreground bg-secondary px-2 py-0.5 rounded-full">
-            {applicants.length}
+            {count}
           </span>
         </div>
         <div className="bg-muted/50 rounded-lg p-2 min-h-64 flex-1">
@@ -37,6 +40,11 @@ export function StageColumn({ stage, jobId, applicants, onActionComplete, onEdit
               onEdit={onEditApplicant}
             />
           ))}
+          {hasMore && (
+             <Button variant="link" size="sm" className="w-full" onClick={onLoadMore}>
+                عرض المزيد ({count - applicants.length})
+             </Button>
+          )}
           {stage.id === 'Applied' && (
              <Button variant="ghost" className="w-full mt-2" onClick={() => setIsAddDialogOpen(true)}>
                 <Plus className="ml-2 h-4 w-4" />
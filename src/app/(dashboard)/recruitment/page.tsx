@@ -13,11 +13,11 @@ import { JobPipeline } from './_components/job-pipeline';
 import { EditApplicantDialog } from './_components/edit-applicant-dialog';
 import { Tabs, TabsContent, TabsList, TabsTrigger } from '@/components/ui/tabs';
 import { ArchiveView } from './_components/archive-view';
+import { ApplicantSearchView } from './_components/applicant-search-view';
 
 
 export default function RecruitmentPage() {
   const [jobs, setJobs] = useState<Job[]>([]);
-  const [applicants, setApplicants] = useState<Applicant[]>([]);
   const [isLoading, setIsLoading] = useState(true);
   const [isEditDialogOpen, setIsEditDialogOpen] = useState(false);
   const [selectedApplicant, setSelectedApplicant] = useState<Applicant | null>(null);
@@ -28,20 +28,14 @@ export default function RecruitmentPage() {
     try {
       const token = localStorage.getItem('authToken');
       const headers = { 'Authorization': `Bearer ${token}` };
-      const [jobsRes, applicantsRes] = await Promise.all([
-        fetch('/api/recruitment/jobs', { headers }),
-        fetch('/api/recruitment/applicants', { headers })
-      ]);
+      const jobsRes = await fetch('/api/recruitment/jobs', { headers });
       
-      if (!jobsRes.ok || !applicantsRes.ok) {
+      if (!jobsRes.ok) {
         throw new Error('فشل في جلب بيانات التوظيف');
       }
       
       const jobsData = await jobsRes.json();
-      const applicantsData = await applicantsRes.json();
-
       setJobs(jobsData.jobs);
-      setApplicants(applicantsData.applicants);
 
     } catch (error: any) {
       toast({ variant: 'destructive', title: 'خطأ', description: error.message });
@@ -83,11 +77,15 @@ export default function RecruitmentPage() {
         </Card>
         
         <Tabs defaultValue="active_jobs">
-            <TabsList className="grid w-full grid-cols-2">
+            <TabsList className="grid w-full grid-cols-3">
                 <TabsTrigger value="active_jobs">
                     <LayoutGrid className="ml-2 h-4 w-4" />
                     الوظائف النشطة
                 </TabsTrigger>
+                <TabsTrigger value="search">
+                    <Search className="ml-2 h-4 w-4" />
+                    بحث المتقدمين
+                </TabsTrigger>
                 <TabsTrigger value="archive">
                     <Archive className="ml-2 h-4 w-4" />
                     الأرشيف
@@ -104,7 +102,6 @@ export default function RecruitmentPage() {
                     <JobPipeline
                         key={job.id}
                         job={job}
-                        applicants={applicants.filter(a => a.job_id === job.id && a.stage !== 'Hired')}
                         onActionComplete={handleActionComplete}
                         onEditApplicant={handleEditApplicant}
                     />
@@ -117,6 +114,9 @@ export default function RecruitmentPage() {
                 </div>
                 )}
             </TabsContent>
+            <TabsContent value="search">
+                <ApplicantSearchView jobs={jobs} />
+            </TabsContent>
             <TabsContent value="archive">
                 <ArchiveView />
             </TabsContent>
@@ -1,19 +1,49 @@
 
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, jsonify, request, send_file, Response, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import os
 from datetime import datetime, date, time, timedelta
 import logging
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required, JWTManager, get_jwt
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required, JWTManager, get_jwt, verify_jwt_in_request
+from itsdangerous import URLSafeSerializer, BadSignature
 from zk import ZK, const
 from collections import defaultdict
-from sqlalchemy import func, inspect, CheckConstraint, Time, Date, cast, text
+from sqlalchemy import func, inspect, CheckConstraint, Time, Date, cast, text, event
+from sqlalchemy.orm import Session as SASession
+from sqlalchemy.engine import Engine
 from werkzeug.utils import secure_filename
+from urllib.parse import quote as url_quote, urlencode
+from functools import wraps
 import re
+import json
+import itertools
+import bisect
+import math
+import multiprocessing
+import queue
+import threading
+import time as _time
+import zipfile
+import io
+import secrets
+import hashlib
+import tempfile
+import mimetypes
+import unicodedata
+import difflib
+import xml.etree.ElementTree as ElementTree
+import shutil
+import subprocess
 from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+try:
+    from PIL import Image, ImageOps
+except ImportError: # optional: image thumbnails are skipped without Pillow
+    Image = ImageOps = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -26,10 +56,13 @@ CORS(app) # Enable CORS for all routes
 basedir = os.path.abspath(os.path.dirname(__file__))
 db_path = os.path.join(basedir, 'hrms.db')
 UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
+UPLOAD_PARTIAL_FOLDER = os.path.join(basedir, 'uploads_partial') # in-progress chunked uploads, never served
 
 
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Background threads and payroll worker processes share the SQLite file; wait for locks instead of failing fast
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
 app.config["JWT_SECRET_KEY"] = os.environ.get('SECRET_KEY', "super-secret-key-change-it") # Change this in your production environment
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
@@ -41,6 +74,7 @@ jwt = JWTManager(app)
 # Ensure upload directory exists
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
+os.makedirs(UPLOAD_PARTIAL_FOLDER, exist_ok=True)
 
 
 # --- Database Models ---
@@ -85,6 +119,7 @@ class Location(db.Model):
     phone = db.Column(db.String)
     email = db.Column(db.String)
     manager_id = db.Column(db.Integer, db.ForeignKey('employees.id'))
+    tax_scheme_id = db.Column(db.Integer, db.ForeignKey('tax_schemes.id')) # falls back to the default active scheme
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -331,6 +366,11 @@ class DeviceLog(db.Model):
     source = db.Column(db.String, default='device') # device, file, api, manual
     raw_payload = db.Column(db.String)
 
+    __table_args__ = (
+        db.Index('ix_device_logs_punch', 'device_id', 'employee_id', 'log_datetime', unique=True),
+        db.Index('ix_device_logs_employee_time', 'employee_id', 'log_datetime'),
+    )
+
 class Attendance(db.Model):
     __tablename__ = 'attendance'
     id = db.Column(db.Integer, primary_key=True)
@@ -347,9 +387,42 @@ class Attendance(db.Model):
     
     employee = db.relationship('Employee', backref='attendance_records')
 
+    __table_args__ = (db.Index('ix_attendance_employee_date', 'employee_id', 'date'),)
+
     def to_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns if not c.name.startswith('_')}
 
+class AttendanceException(db.Model):
+    __tablename__ = 'attendance_exceptions'
+    id = db.Column(db.Integer, primary_key=True)
+    employee_id = db.Column(db.Integer, db.ForeignKey('employees.id', ondelete='CASCADE'), nullable=False)
+    date = db.Column(db.String, nullable=False)
+    type = db.Column(db.String, nullable=False) # no_show, wrong_shift, unrostered_punch
+    slot_id = db.Column(db.Integer, db.ForeignKey('roster_slots.id', ondelete='SET NULL'))
+    shift_id = db.Column(db.Integer, db.ForeignKey('shifts.id'))
+    details = db.Column(db.Text) # JSON: punches, expected window
+    status = db.Column(db.String, default='Open') # Open, Resolved, Dismissed
+    resolution_note = db.Column(db.Text)
+    resolved_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    resolved_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    employee = db.relationship('Employee')
+
+    __table_args__ = (
+        db.Index('ix_attendance_exceptions_key', 'employee_id', 'date', 'type', unique=True),
+        db.Index('ix_attendance_exceptions_status_date', 'status', 'date'),
+    )
+
+    def to_dict(self):
+        d = {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        d['details'] = json.loads(self.details) if self.details else None
+        for key in ['resolved_at', 'created_at']:
+            if isinstance(d.get(key), datetime):
+                d[key] = d[key].isoformat()
+        d['employee_name'] = self.employee.full_name if self.employee else None
+        return d
+
 # --- Roster Models ---
 class RotationPattern(db.Model):
     __tablename__ = 'rotation_patterns'
@@ -358,15 +431,25 @@ class RotationPattern(db.Model):
     description = db.Column(db.Text)
     cycle_days = db.Column(db.Integer, nullable=False)
     active = db.Column(db.Boolean, default=True)
+    lines = db.relationship('RotationPatternLine', backref='pattern', lazy='dynamic', cascade="all, delete-orphan")
+
+    def to_dict(self, include_lines=False):
+        d = {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        if include_lines:
+            d['lines'] = [l.to_dict() for l in self.lines.order_by(RotationPatternLine.day_index)]
+        return d
 
 class RotationPatternLine(db.Model):
     __tablename__ = 'rotation_pattern_lines'
     id = db.Column(db.Integer, primary_key=True)
     pattern_id = db.Column(db.Integer, db.ForeignKey('rotation_patterns.id', ondelete='CASCADE'), nullable=False)
-    day_index = db.Column(db.Integer, nullable=False)
-    shift_id = db.Column(db.Integer, db.ForeignKey('shifts.id'))
+    day_index = db.Column(db.Integer, nullable=False) # 0-based position in the cycle
+    shift_id = db.Column(db.Integer, db.ForeignKey('shifts.id')) # empty = day off
     required_headcount = db.Column(db.Integer)
 
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
 class RosterPeriod(db.Model):
     __tablename__ = 'roster_periods'
     id = db.Column(db.Integer, primary_key=True)
@@ -379,6 +462,13 @@ class RosterPeriod(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     locked_at = db.Column(db.DateTime)
 
+    def to_dict(self):
+        d = {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        for key in ['created_at', 'locked_at']:
+            if isinstance(d.get(key), datetime):
+                d[key] = d[key].isoformat()
+        return d
+
 class RosterSlot(db.Model):
     __tablename__ = 'roster_slots'
     id = db.Column(db.Integer, primary_key=True)
@@ -390,8 +480,14 @@ class RosterSlot(db.Model):
     source = db.Column(db.String, default='manual') # manual, rotation, copy, import, auto
     status = db.Column(db.String, default='Draft') # Draft, Published, Changed, Cancelled
     note = db.Column(db.Text)
-    
-    db.UniqueConstraint('period_id', 'date', 'employee_id')
+
+    __table_args__ = (
+        db.Index('ix_roster_slots_period_date_employee', 'period_id', 'date', 'employee_id', unique=True),
+        db.Index('ix_roster_slots_date_employee', 'date', 'employee_id'),
+    )
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 class ShiftAllowance(db.Model):
     __tablename__ = 'shift_allowances'
@@ -400,6 +496,23 @@ class ShiftAllowance(db.Model):
     allowance_amount = db.Column(db.Float, default=0)
     apply_when = db.Column(db.String, default='worked') # scheduled, worked
 
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+class ShiftAllowanceAccrual(db.Model):
+    """Monthly shift allowance per employee and shift, rebuilt by accrue_shift_allowances()."""
+    __tablename__ = 'shift_allowance_accruals'
+    id = db.Column(db.Integer, primary_key=True)
+    employee_id = db.Column(db.Integer, db.ForeignKey('employees.id', ondelete='CASCADE'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    shift_id = db.Column(db.Integer, db.ForeignKey('shifts.id', ondelete='CASCADE'), nullable=False)
+    shift_count = db.Column(db.Integer, default=0)
+    amount = db.Column(db.Float, default=0)
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_shift_allowance_accruals_period', 'year', 'month', 'employee_id', 'shift_id', unique=True),)
+
 # --- End of Attendance Models ---
 
 
@@ -446,10 +559,15 @@ class Payroll(db.Model):
     tax = db.Column(db.Float)
     insurance = db.Column(db.Float)
     net_salary = db.Column(db.Float, nullable=False)
+    allowances = db.Column(db.Float)
+    breakdown_json = db.Column(db.Text) # per-component amounts
+    payslip_path = db.Column(db.String) # relative to UPLOAD_FOLDER
     generated_at = db.Column(db.DateTime, default=datetime.utcnow)
     status = db.Column(db.String, default='Generated')
     employee = db.relationship('Employee', backref='payrolls')
 
+    __table_args__ = (db.Index('ix_payroll_employee_period', 'employee_id', 'year', 'month', unique=True),)
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -458,14 +576,76 @@ class Payroll(db.Model):
             'month': self.month,
             'year': self.year,
             'base_salary': self.base_salary,
+            'allowances': self.allowances,
+            'breakdown': json.loads(self.breakdown_json) if self.breakdown_json else None,
             'overtime': self.overtime,
             'deductions': self.deductions,
             'tax': self.tax,
             'insurance': self.insurance,
             'net_salary': self.net_salary,
-            'status': self.status
+            'status': self.status,
+            'payslip_url': f"/api/uploads/{self.payslip_path}" if self.payslip_path else None
         }
         
+class PayrollStaleMark(db.Model):
+    """A stored payroll line whose inputs changed after it was generated."""
+    __tablename__ = 'payroll_stale_marks'
+    employee_id = db.Column(db.Integer, db.ForeignKey('employees.id', ondelete='CASCADE'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    reason = db.Column(db.String) # employee, component, attendance, leave
+    marked_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class PayrollRun(db.Model):
+    __tablename__ = 'payroll_runs'
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    partition_by = db.Column(db.String, default='location') # location, department
+    status = db.Column(db.String, default='Pending') # Pending, Running, Completed, Failed
+    total_partitions = db.Column(db.Integer, default=0)
+    completed_partitions = db.Column(db.Integer, default=0)
+    employees_processed = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text)
+    started_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    partitions = db.relationship('PayrollRunPartition', backref='run', lazy='dynamic', cascade="all, delete-orphan")
+
+    def to_dict(self, include_partitions=False):
+        data = {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        for key in ['created_at', 'finished_at']:
+            if isinstance(data.get(key), datetime):
+                data[key] = data[key].isoformat()
+        data['progress_percent'] = round(self.completed_partitions / self.total_partitions * 100) if self.total_partitions else 0
+        if include_partitions:
+            data['partitions'] = [p.to_dict() for p in self.partitions.order_by(PayrollRunPartition.partition_key)]
+        return data
+
+class PayrollRunPartition(db.Model):
+    """One location/department slice of a payroll run; status 'Done' is its checkpoint."""
+    __tablename__ = 'payroll_run_partitions'
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('payroll_runs.id', ondelete='CASCADE'), nullable=False)
+    partition_key = db.Column(db.Integer, nullable=False) # location/department id, 0 = unassigned
+    status = db.Column(db.String, default='Pending') # Pending, Running, Done, Failed
+    employee_count = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (db.UniqueConstraint('run_id', 'partition_key', name='_run_partition_uc'),)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'partition_key': self.partition_key,
+            'status': self.status,
+            'employee_count': self.employee_count,
+            'error': self.error,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
 class PerformanceReview(db.Model):
     __tablename__ = 'performance_reviews'
     id = db.Column(db.Integer, primary_key=True)
@@ -563,6 +743,11 @@ class InAppNotification(db.Model):
     
     recipient = db.relationship('User', backref='notifications')
 
+    __table_args__ = (
+        db.Index('ix_notifications_recipient_created', 'recipient_user_id', 'created_at'),
+        db.Index('ix_notifications_recipient_status', 'recipient_user_id', 'status'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -574,6 +759,11 @@ class InAppNotification(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
+class NotificationCounter(db.Model):
+    __tablename__ = 'notification_counters'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+
 class DisciplinaryAction(db.Model):
     __tablename__ = 'disciplinary_actions'
     id = db.Column(db.Integer, primary_key=True)
@@ -610,7 +800,7 @@ class PayrollComponent(db.Model):
     code = db.Column(db.String, unique=True, nullable=False)
     name = db.Column(db.String, nullable=False)
     component_type = db.Column(db.String, nullable=False) # earning, deduction, benefit, insurance
-    calculation_type = db.Column(db.String, nullable=False) # fixed, percent, slab, formula
+    calculation_type = db.Column(db.String, nullable=False) # fixed, percent, slab, formula, shift_allowance
     value = db.Column(db.Float)
     rate = db.Column(db.Float)
     base = db.Column(db.String, default='base')
@@ -671,8 +861,10 @@ class Job(db.Model):
     
     department = db.relationship('Department', backref='jobs', lazy=True)
     applicants = db.relationship('Applicant', backref='job', lazy='dynamic')
+    stage_counts = db.relationship('JobStageCount', lazy='selectin', viewonly=True)
     
     def to_dict(self):
+        counts = {c.stage: c.count for c in self.stage_counts if c.count}
         return {
             'id': self.id,
             'title': self.title,
@@ -682,7 +874,8 @@ class Job(db.Model):
             'hires_count': self.hires_count,
             'status': self.status,
             'created_at': self.created_at,
-            'applicants_count': self.applicants.count(),
+            'applicants_count': sum(counts.values()),
+            'stage_counts': counts,
             'close_reason': self.close_reason,
             'location': self.location,
         }
@@ -690,13 +883,16 @@ class Job(db.Model):
 class Applicant(db.Model):
     __tablename__ = 'applicants'
     id = db.Column(db.Integer, primary_key=True)
-    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'), nullable=False)
+    # active_history: the stage counters need the old job/stage even when the row was expired by a commit
+    job_id = db.column_property(db.Column(db.Integer, db.ForeignKey('jobs.id'), nullable=False), active_history=True)
     full_name = db.Column(db.Text, nullable=False)
     email = db.Column(db.Text, nullable=False)
     phone = db.Column(db.Text)
     source = db.Column(db.Text, default='manual') # 'manual','referral','website','linkedin',…
-    stage = db.Column(db.Text, CheckConstraint("stage IN ('Applied','Screening','Interview','Offer','Hired','Rejected')"), default='Applied')
+    stage = db.column_property(db.Column(db.Text, CheckConstraint("stage IN ('Applied','Screening','Interview','Offer','Hired','Rejected')"), default='Applied'), active_history=True)
     cv_path = db.Column(db.Text)
+    cv_file_name = db.Column(db.String)
+    cv_blob_hash = db.Column(db.String(64), index=True)
     rating = db.Column(db.Integer, default=0)
     notes = db.Column(db.Text)
     created_at = db.Column(db.Text, default=lambda: datetime.utcnow().isoformat())
@@ -710,7 +906,10 @@ class Applicant(db.Model):
     current_company = db.Column(db.String)
     expected_salary = db.Column(db.Float)
 
-    __table_args__ = (db.UniqueConstraint('job_id', 'email', name='_job_email_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('job_id', 'email', name='_job_email_uc'),
+        db.Index('ix_applicants_job_stage_created', 'job_id', 'stage', 'created_at'),
+    )
 
     def to_dict(self):
         data = {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -718,6 +917,13 @@ class Applicant(db.Model):
             data['job'] = {'title': self.job.title}
         return data
 
+class JobStageCount(db.Model):
+    """Number of applicants per job and stage, kept current by a flush listener."""
+    __tablename__ = 'job_stage_counts'
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id'), primary_key=True)
+    stage = db.Column(db.Text, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
 class DocumentType(db.Model):
     __tablename__ = 'document_types'
     id = db.Column(db.Integer, primary_key=True)
@@ -743,7 +949,9 @@ class EmployeeDocument(db.Model):
     file_path = db.Column(db.String, nullable=False)
     file_name = db.Column(db.String)
     mime_type = db.Column(db.String)
-    expiry_date = db.Column(db.String)
+    blob_hash = db.Column(db.String(64), index=True)
+    expiry_date = db.Column(db.String, index=True)
+    expiry_warned_on = db.Column(db.String) # date the expiry warning went out; cleared on re-upload
     status = db.Column(db.String, default='Uploaded') # Uploaded, Verified, Rejected, Expired
     note = db.Column(db.String)
     uploaded_by = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -752,6 +960,69 @@ class EmployeeDocument(db.Model):
     doc_type = db.relationship('DocumentType')
     employee = db.relationship('Employee', backref='documents')
 
+class EmployeeDocumentStats(db.Model):
+    """Per-employee document counters for the compliance overview, kept by refresh_document_stats()."""
+    __tablename__ = 'employee_document_stats'
+    employee_id = db.Column(db.Integer, db.ForeignKey('employees.id', ondelete='CASCADE'), primary_key=True)
+    documents_count = db.Column(db.Integer, nullable=False, default=0)
+    required_count = db.Column(db.Integer, nullable=False, default=0) # documents of active, required types
+    expiring_count = db.Column(db.Integer, nullable=False, default=0)
+    expired_count = db.Column(db.Integer, nullable=False, default=0)
+    last_uploaded_at = db.Column(db.DateTime)
+    refreshed_on = db.Column(db.String) # the day the expiring window was computed for
+
+class FileBlob(db.Model):
+    """A stored file, addressed by the SHA-256 of its content and shared by every record that points at it."""
+    __tablename__ = 'file_blobs'
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    mime_type = db.Column(db.String)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    stored_at = db.Column(db.DateTime, default=datetime.utcnow) # last time this content was uploaded
+
+class ApplicantCvText(db.Model):
+    """Text extracted from a CV blob, shared by every applicant who uploaded the same file."""
+    __tablename__ = 'applicant_cv_texts'
+    blob_hash = db.Column(db.String(64), primary_key=True)
+    status = db.Column(db.String, nullable=False) # Extracted, Unsupported, Failed
+    content = db.Column(db.Text)
+    extracted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class IdentityKey(db.Model):
+    """Normalised email, phone and name keys of applicants and employees, for duplicate detection."""
+    __tablename__ = 'identity_keys'
+    subject_type = db.Column(db.String, primary_key=True) # applicant, employee
+    subject_id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, primary_key=True) # email, phone, name
+    value = db.Column(db.String, nullable=False)
+    __table_args__ = (db.Index('ix_identity_keys_kind_value', 'kind', 'value'),)
+
+class UploadSession(db.Model):
+    """A chunked upload in progress; received_size is where the client resumes."""
+    __tablename__ = 'upload_sessions'
+    id = db.Column(db.String, primary_key=True)
+    purpose = db.Column(db.String, nullable=False) # employee_document, applicant_cv
+    employee_id = db.Column(db.Integer, db.ForeignKey('employees.id', ondelete='CASCADE'))
+    doc_type_id = db.Column(db.Integer, db.ForeignKey('document_types.id'))
+    applicant_id = db.Column(db.Integer, db.ForeignKey('applicants.id', ondelete='CASCADE'))
+    expiry_date = db.Column(db.String)
+    file_name = db.Column(db.String, nullable=False)
+    mime_type = db.Column(db.String, nullable=False)
+    total_size = db.Column(db.Integer, nullable=False)
+    received_size = db.Column(db.Integer, default=0)
+    status = db.Column(db.String, default='Uploading') # Uploading, Completed, Aborted
+    result_path = db.Column(db.String)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        d = {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        for key in ['created_at', 'updated_at']:
+            if isinstance(d.get(key), datetime):
+                d[key] = d[key].isoformat()
+        return d
+
 # --- Onboarding Models ---
 class OnboardingRecord(db.Model):
     __tablename__ = 'onboarding_records'
@@ -777,6 +1048,29 @@ class EmployeeEvent(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
 
+# --- Reporting Models ---
+class ReportFact(db.Model):
+    """Monthly HR facts per department and location; 0 stands for 'not assigned'."""
+    __tablename__ = 'report_facts'
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String, nullable=False) # YYYY-MM
+    department_id = db.Column(db.Integer, nullable=False, default=0)
+    location_id = db.Column(db.Integer, nullable=False, default=0)
+    headcount = db.Column(db.Integer, default=0)
+    hires = db.Column(db.Integer, default=0)
+    separations = db.Column(db.Integer, default=0)
+    leave_days = db.Column(db.Float, default=0)
+    attendance_present = db.Column(db.Integer, default=0)
+    attendance_late = db.Column(db.Integer, default=0)
+    attendance_absent = db.Column(db.Integer, default=0)
+
+    __table_args__ = (db.UniqueConstraint('month', 'department_id', 'location_id', name='_report_fact_uc'),)
+
+class ReportDirtyMonth(db.Model):
+    """Months whose report facts must be recomputed."""
+    __tablename__ = 'report_dirty_months'
+    month = db.Column(db.String, primary_key=True)
+
 # --- Utility Functions ---
 def log_action(action, details, username="نظام", user_id=None):
     try:
@@ -787,27 +1081,419 @@ def log_action(action, details, username="نظام", user_id=None):
         app.logger.error(f"Failed to log action: {e}")
         db.session.rollback()
 
+def chunked(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
 def create_notification(recipient_user_id, title, message, type, related_link=None):
+    notify_users([recipient_user_id], title, message, type, related_link)
+
+# --- Background Work ---
+# Work that should not hold up the request runs on thread pools, each task
+# inside its own app context. Short tasks (notification fan-out, KPI pushes) use
+# background_executor; long batch jobs (payroll runs, report and stats
+# refreshes, reconciliation, thumbnails, CV extraction) use batch_executor so
+# they can never delay notifications.
+background_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('BACKGROUND_WORKERS', 4)),
+    thread_name_prefix='hrms-bg'
+)
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('BATCH_WORKERS', 2)),
+    thread_name_prefix='hrms-batch'
+)
+
+def run_in_background(func, *args, **kwargs):
+    """Schedules func on the background pool and returns its Future."""
+    return _submit_in_app_context(background_executor, func, args, kwargs)
+
+def run_batch_job(func, *args, **kwargs):
+    """Schedules a long-running func on the batch pool and returns its Future."""
+    return _submit_in_app_context(batch_executor, func, args, kwargs)
+
+def _submit_in_app_context(executor, func, args, kwargs):
+    def runner():
+        with app.app_context():
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                app.logger.error(f"Background task {func.__name__} failed: {e}")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+    return executor.submit(runner)
+
+_periodic_threads = {}
+
+def start_periodic_task(name, func, interval_hours):
+    """Runs func now and then every interval_hours on a daemon thread; only the first call per name starts it."""
+    if name in _periodic_threads:
+        return _periodic_threads[name]
+
+    def loop():
+        while True:
+            with app.app_context():
+                try:
+                    result = func()
+                    app.logger.info(f"Periodic task {name}: {result}")
+                except Exception as e:
+                    app.logger.error(f"Periodic task {name} failed: {e}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            _time.sleep(interval_hours * 3600)
+
+    thread = _periodic_threads[name] = threading.Thread(target=loop, name=f'hrms-{name}', daemon=True)
+    thread.start()
+    return thread
+
+# --- Change Tracking ---
+# Functions registered with on_tables_changed() are called after a commit that
+# touched one of their tables, either through ORM flushes or through
+# session.execute() of INSERT/UPDATE/DELETE statements. Raw text() SQL must
+# call mark_tables_changed() itself. Listeners run after the transaction has
+# ended, so they must not use the session; schedule background work instead.
+_table_change_listeners = defaultdict(list)
+
+def on_tables_changed(*table_names):
+    def decorator(func):
+        for table_name in table_names:
+            _table_change_listeners[table_name].append(func)
+        return func
+    return decorator
+
+def mark_tables_changed(*table_names):
+    db.session.info.setdefault('changed_tables', set()).update(table_names)
+
+# Functions registered with on_flush() receive every flushed object of their
+# models as (obj, kind) pairs, kind being 'new', 'dirty' or 'deleted'. They run
+# inside the flush, so they may write with session.connection() but must not
+# add objects to the session.
+_flush_listeners = defaultdict(list)
+
+def on_flush(*models):
+    def decorator(func):
+        for model in models:
+            _flush_listeners[model].append(func)
+        return func
+    return decorator
+
+def previous_value(obj, attr):
+    """The value attr had before the pending change (or the current one if unchanged)."""
+    history = inspect(obj).attrs[attr].history
+    return history.deleted[0] if history.deleted else getattr(obj, attr)
+
+@event.listens_for(SASession, 'after_flush')
+def _collect_flushed_tables(session, flush_context):
+    changed = session.info.setdefault('changed_tables', set())
+    per_listener = defaultdict(list)
+    for kind, objects in (('new', session.new), ('dirty', session.dirty), ('deleted', session.deleted)):
+        for obj in objects:
+            table_name = getattr(obj, '__tablename__', None)
+            if table_name:
+                changed.add(table_name)
+            for func in _flush_listeners.get(type(obj), ()):
+                per_listener[func].append((obj, kind))
+    for func, changes in per_listener.items():
+        func(session, changes)
+
+@event.listens_for(SASession, 'do_orm_execute')
+def _collect_executed_tables(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, 'table', None)
+        if table is not None and getattr(table, 'name', None):
+            orm_execute_state.session.info.setdefault('changed_tables', set()).add(table.name)
+
+@event.listens_for(SASession, 'after_commit')
+def _dispatch_table_changes(session):
+    changed = session.info.pop('changed_tables', None)
+    if not changed:
+        return
+    listeners = []
+    for table_name in changed:
+        for func in _table_change_listeners.get(table_name, ()):
+            if func not in listeners:
+                listeners.append(func)
+    for func in listeners:
+        try:
+            func(changed)
+        except Exception as e:
+            app.logger.error(f"Change listener {func.__name__} failed: {e}")
+
+@event.listens_for(SASession, 'after_soft_rollback')
+def _discard_table_changes(session, previous_transaction):
+    session.info.pop('changed_tables', None)
+
+# --- Aggregate Cache ---
+# Small in-process cache for computed summaries (dashboard KPIs and the like).
+# Entries are dropped by change listeners when their source tables change. Each
+# key prefix has a generation that invalidation bumps; a value computed while
+# its prefix was invalidated is returned but not cached, since it may predate
+# the write.
+_aggregate_cache = {}
+_aggregate_generations = defaultdict(int)
+_aggregate_cache_lock = threading.Lock()
+
+def cached_aggregate(key, compute):
+    with _aggregate_cache_lock:
+        if key in _aggregate_cache:
+            return _aggregate_cache[key]
+        generation = _aggregate_generations[key[0]]
+    value = compute()
+    with _aggregate_cache_lock:
+        if _aggregate_generations[key[0]] == generation:
+            _aggregate_cache[key] = value
+    return value
+
+def invalidate_aggregates(prefix):
+    with _aggregate_cache_lock:
+        _aggregate_generations[prefix] += 1
+        for key in [k for k in _aggregate_cache if k[0] == prefix]:
+            del _aggregate_cache[key]
+
+# --- Signed URLs ---
+# Files the browser loads by itself (<img>, the PDF viewer, downloads) and the
+# EventSource stream can't carry the Authorization header. Instead of putting the JWT in the query string, the
+# client asks for a signed URL: it is bound to the path, the query and the
+# signer's claims, and expires at the end of a fixed window so the same file
+# keeps the same URL (and browser cache entry) for a while.
+SIGNED_URL_WINDOW_SECONDS = int(os.environ.get('SIGNED_URL_WINDOW_SECONDS', 300))
+SIGNED_URL_PREFIXES = ('/api/uploads/', '/api/documents/thumbnails/', '/api/documents/export', '/api/stream')
+signed_url_serializer = URLSafeSerializer(app.config['JWT_SECRET_KEY'], salt='signed-url')
+
+def sign_url(path, params=None):
+    """Returns path (plus params) with a signature valid for one to two windows, for the current user."""
+    params = {key: str(value) for key, value in (params or {}).items()}
+    claims = get_jwt()
+    expires = (int(_time.time()) // SIGNED_URL_WINDOW_SECONDS + 2) * SIGNED_URL_WINDOW_SECONDS
+    signature = signed_url_serializer.dumps({
+        'path': path, 'params': params, 'exp': expires,
+        'sub': get_jwt_identity(), 'role': claims.get('role'), 'username': claims.get('username'),
+    })
+    return f"{path}?{urlencode({**params, 'sig': signature})}"
+
+def signed_url_or_jwt(view):
+    """Accepts either the usual Authorization header or a URL from sign_url(); the claims end up in g.url_claims."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        signature = request.args.get('sig')
+        if signature is None:
+            verify_jwt_in_request()
+            claims = get_jwt()
+            g.url_claims = {'sub': get_jwt_identity(), 'role': claims.get('role'), 'username': claims.get('username')}
+            return view(*args, **kwargs)
+        try:
+            payload = signed_url_serializer.loads(signature)
+        except BadSignature:
+            return jsonify({"message": "Forbidden"}), 403
+        params = {key: value for key, value in request.args.items() if key != 'sig'}
+        if payload.get('path') != request.path or payload.get('params') != params or payload.get('exp', 0) < _time.time():
+            return jsonify({"message": "انتهت صلاحية الرابط"}), 403
+        g.url_claims = payload
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/signed-urls', methods=['POST'])
+@jwt_required()
+def create_signed_url():
+    """Signs a file or export URL; access itself is checked when the URL is used."""
+    data = request.get_json() or {}
+    path = data.get('path') or ''
+    params = data.get('params') or {}
+    if not isinstance(params, dict) or not path.startswith(SIGNED_URL_PREFIXES):
+        return jsonify({"message": "رابط غير مدعوم"}), 400
+    return jsonify({"url": sign_url(path, params)})
+
+# --- Event Broker ---
+# Live updates (notifications, unread counts, attendance KPIs) are published to
+# named channels and streamed to browsers by /api/stream. The default broker is
+# in-process; any object with the same subscribe/unsubscribe/publish methods
+# (e.g. one backed by a local Redis) can be assigned to event_broker instead.
+SSE_HEARTBEAT_SECONDS = 15
+
+class InProcessEventBroker:
+    def __init__(self, max_queue_size=100):
+        self.max_queue_size = max_queue_size
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, *channels):
+        """Returns a queue that receives (event, data) tuples for the channels."""
+        subscription = queue.Queue(maxsize=self.max_queue_size)
+        with self._lock:
+            for channel in channels:
+                self._subscribers[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription, *channels):
+        with self._lock:
+            for channel in channels:
+                self._subscribers[channel].discard(subscription)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+
+    def publish(self, channel, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait((event, data))
+            except queue.Full:
+                pass  # Slow client; it resyncs from the REST API on reconnect
+
+event_broker = InProcessEventBroker()
+
+def user_channel(user_id):
+    return f"user:{user_id}"
+
+ATTENDANCE_CHANNEL = 'attendance'
+
+# --- Notification Service ---
+NOTIFICATION_INSERT_BATCH = 500
+
+def resolve_notification_audience(roles=None, department_id=None, manager_chain_of=None, exclude_user_ids=None):
+    """Returns the ids of active users matching any of the audience selectors.
+
+    roles: user roles, e.g. ['Admin', 'HR'].
+    department_id: users linked to employees of that department.
+    manager_chain_of: employee id whose direct and indirect managers are notified.
+    """
+    user_ids = set()
+    active_users = db.session.query(User.id).filter(User.account_status == 'Active')
+
+    if roles:
+        user_ids.update(uid for (uid,) in active_users.filter(User.role.in_(roles)))
+
+    if department_id:
+        user_ids.update(uid for (uid,) in active_users.join(Employee, User.employee_id == Employee.id)
+                        .filter(Employee.department_id == department_id))
+
+    if manager_chain_of:
+        chain = []
+        manager_id = db.session.query(Employee.manager_id).filter(Employee.id == manager_chain_of).scalar()
+        while manager_id and manager_id not in chain:  # guard against cycles in bad data
+            chain.append(manager_id)
+            manager_id = db.session.query(Employee.manager_id).filter(Employee.id == manager_id).scalar()
+        if chain:
+            user_ids.update(uid for (uid,) in active_users.filter(User.employee_id.in_(chain)))
+
+    if exclude_user_ids:
+        user_ids.difference_update(exclude_user_ids)
+    return sorted(user_ids)
+
+def notify_users(user_ids, title, message, type, related_link=None):
+    """Creates one notification per recipient using multi-row INSERTs in a single transaction."""
+    return deliver_notifications([
+        {'recipient_user_id': uid, 'title': title, 'message': message, 'type': type, 'related_link': related_link}
+        for uid in user_ids
+    ])
+
+def deliver_notifications(notifications):
+    """Inserts individually addressed notifications (dicts with recipient_user_id, title,
+    message, type and related_link) in a single transaction and pushes them to subscribers."""
+    if not notifications:
+        return 0
+    now = datetime.utcnow()
+    rows = [{**n, 'status': 'Unread', 'created_at': now} for n in notifications]
+    deltas = defaultdict(int)
+    for row in rows:
+        deltas[row['recipient_user_id']] += 1
     try:
-        notification = InAppNotification(
-            recipient_user_id=recipient_user_id,
-            title=title,
-            message=message,
-            type=type,
-            related_link=related_link,
-            status='Unread'
-        )
-        db.session.add(notification)
+        for i in range(0, len(rows), NOTIFICATION_INSERT_BATCH):
+            db.session.execute(InAppNotification.__table__.insert().values(rows[i:i + NOTIFICATION_INSERT_BATCH]))
+        adjust_unread_counters(deltas)
+        # The counts pushed with the events are read in the same transaction, one query per batch
+        unread_counts = read_unread_counters(deltas)
         db.session.commit()
     except Exception as e:
-        app.logger.error(f"Failed to create notification: {e}")
+        app.logger.error(f"Failed to create notifications: {e}")
         db.session.rollback()
+        return 0
+    invalidate_unread_cache(deltas)
+
+    for row in rows:
+        uid = row['recipient_user_id']
+        payload = {key: row[key] for key in ('title', 'message', 'type', 'related_link')}
+        event_broker.publish(user_channel(uid), 'notification', {**payload, 'created_at': now.isoformat(), 'unread_count': unread_counts.get(uid, 0)})
+    return len(rows)
+
+def publish_unread_count(user_id):
+    event_broker.publish(user_channel(user_id), 'unread_count', {'unread_count': get_unread_count(user_id)})
+
+# --- Unread Notification Counters ---
+# notification_counters holds each user's unread count, adjusted in the same
+# transaction as the notification rows. Reads are served from an in-process
+# cache of the stored value; writers invalidate a user's entry after their
+# commit, so the next read goes back to the table. A read that overlaps an
+# invalidation does not cache what it read (the generation check), so the
+# cache can lag a write by at most that one read and never drifts from the table.
+_unread_cache = {}
+_unread_cache_lock = threading.Lock()
+_unread_cache_generation = 0
+
+def adjust_unread_counters(deltas):
+    """Adds {user_id: delta} to the stored counters, never going below zero; the caller commits."""
+    params = [{'user_id': uid, 'delta': delta} for uid, delta in deltas.items()]
+    db.session.execute(text("INSERT OR IGNORE INTO notification_counters (user_id, unread_count) VALUES (:user_id, 0)"), params)
+    db.session.execute(text("UPDATE notification_counters SET unread_count = max(unread_count + :delta, 0) WHERE user_id = :user_id"), params)
+
+def read_unread_counters(user_ids):
+    """{user_id: stored unread count} for the given users, read in the caller's transaction."""
+    counts = {}
+    for batch in chunked(user_ids, NOTIFICATION_INSERT_BATCH):
+        counts.update(db.session.execute(
+            text("SELECT user_id, unread_count FROM notification_counters WHERE user_id IN :ids")
+            .bindparams(db.bindparam('ids', expanding=True)), {'ids': batch}).all())
+    return counts
+
+def invalidate_unread_cache(user_ids):
+    """Drops the cached counts of users whose counters a committed transaction changed."""
+    global _unread_cache_generation
+    with _unread_cache_lock:
+        _unread_cache_generation += 1
+        for uid in user_ids:
+            _unread_cache.pop(uid, None)
+
+def get_unread_count(user_id):
+    with _unread_cache_lock:
+        if user_id in _unread_cache:
+            return _unread_cache[user_id]
+        generation = _unread_cache_generation
+    counter = db.session.get(NotificationCounter, user_id)
+    if counter is None:
+        # No counter row yet (backfill_notification_counters covers users at startup); a read never writes
+        count = InAppNotification.query.filter_by(recipient_user_id=user_id, status='Unread').count()
+    else:
+        count = counter.unread_count
+    with _unread_cache_lock:
+        if generation == _unread_cache_generation:
+            _unread_cache[user_id] = count
+    return count
+
+def _deliver_to_audience(title, message, type, related_link, audience):
+    user_ids = resolve_notification_audience(**audience)
+    return notify_users(user_ids, title, message, type, related_link)
+
+def notify_audience(title, message, type, related_link=None, **audience):
+    """Resolves the audience and delivers the notifications off the request thread.
+
+    Accepts the selectors of resolve_notification_audience as keyword arguments.
+    """
+    return run_in_background(_deliver_to_audience, title, message, type, related_link, audience)
+
+# Indexes replaced by others; migrate_db drops them from existing databases
+OBSOLETE_INDEXES = ['ix_applicants_job_stage'] # superseded by ix_applicants_job_stage_created
 
 def migrate_db():
     """A simple migration utility to add missing columns."""
     with app.app_context():
         inspector = inspect(db.engine)
         all_tables = inspector.get_table_names()
+
+        for index_name in OBSOLETE_INDEXES:
+            db.session.execute(text(f'DROP INDEX IF EXISTS {index_name}'))
+        db.session.commit()
         
         for table_name, model in db.metadata.tables.items():
             if table_name not in all_tables:
@@ -838,6 +1524,30 @@ def migrate_db():
                         app.logger.error(f"Error adding column {column_name} to {table_name}: {e}")
                 db.session.commit()
 
+            # create_all() only builds indexes together with new tables
+            existing_indexes = {i['name'] for i in inspector.get_indexes(table_name)}
+            for index in model.indexes:
+                if index.name not in existing_indexes:
+                    try:
+                        if index.unique:
+                            # Rows written before the index existed may collide; those are left for an operator to resolve
+                            key_columns = ', '.join(c.name for c in index.columns)
+                            not_null = ' AND '.join(f'{c.name} IS NOT NULL' for c in index.columns) # NULL keys never collide
+                            duplicates = db.session.execute(text(
+                                f'SELECT {key_columns}, COUNT(*) FROM {table_name} WHERE {not_null} '
+                                f'GROUP BY {key_columns} HAVING COUNT(*) > 1 LIMIT 10'
+                            )).all()
+                            db.session.rollback() # end the read before index.create() takes its own connection
+                            if duplicates:
+                                app.logger.error(
+                                    f"Not creating unique index '{index.name}': '{table_name}' has duplicate "
+                                    f"({key_columns}) rows, e.g. {[tuple(row) for row in duplicates]}. Remove them and restart.")
+                                continue
+                        index.create(bind=db.engine)
+                        app.logger.info(f"Created index '{index.name}' on table '{table_name}'.")
+                    except Exception as e:
+                        app.logger.error(f"Error creating index {index.name} on {table_name}: {e}")
+
 # --- API Routes ---
 
 @app.route("/api")
@@ -1000,7 +1710,9 @@ def handle_employees():
             db.session.add(new_employee)
             db.session.commit()
             log_action("إضافة موظف", f"تمت إضافة موظف جديد: {new_employee.full_name}")
-            return jsonify(new_employee.to_dict()), 201
+            data = new_employee.to_dict()
+            data['possible_duplicates'] = find_identity_matches('employee', new_employee.id)
+            return jsonify(data), 201
         except Exception as e:
             db.session.rollback()
             app.logger.error(f"Error adding employee: {e}")
@@ -1109,6 +1821,156 @@ def get_employee_profile(id):
     })
 
 
+# --- Employee Search ---
+# employee_search is an FTS5 index over each employee's name, email, code,
+# national id, phone, department and job title, keyed by employee id. Text is
+# normalised by hr_normalize(), registered on every SQLite connection, so the
+# index can be rebuilt in plain SQL and queries are normalised the same way:
+# diacritics and tatweel dropped, alef/yaa/taa-marbuta variants folded,
+# Arabic-Indic digits mapped to ASCII, lower case. Flush listeners keep the
+# index in the same transaction as the employee, department and job title rows.
+EMPLOYEE_SEARCH_LIMIT = 10
+EMPLOYEE_SEARCH_MAX_LIMIT = 50
+ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+ARABIC_FOLDING = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ئ': 'ي', 'ة': 'ه', 'ؤ': 'و',
+    **{chr(0x0660 + i): str(i) for i in range(10)}, **{chr(0x06f0 + i): str(i) for i in range(10)},
+})
+SEARCH_TOKEN = re.compile(r'[^\W_]+')
+
+def normalize_search_text(value):
+    if not value:
+        return ''
+    value = unicodedata.normalize('NFKC', str(value))
+    return ARABIC_DIACRITICS.sub('', value).translate(ARABIC_FOLDING).lower()
+
+def _search_digits(value):
+    return re.sub(r'\D', '', normalize_search_text(value))
+
+@event.listens_for(Engine, 'connect')
+def _register_search_functions(dbapi_connection, connection_record):
+    if hasattr(dbapi_connection, 'create_function'):
+        dbapi_connection.create_function('hr_normalize', 1, normalize_search_text, deterministic=True)
+        dbapi_connection.create_function('hr_digits', 1, _search_digits, deterministic=True)
+
+def ensure_search_index(index, fields, source_table):
+    """Creates an FTS5 index over fields and rebuilds it if it is out of step with source_table."""
+    db.session.execute(text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5({', '.join(fields)}, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    ))
+    indexed = db.session.execute(text(f"SELECT COUNT(*) FROM {index}")).scalar()
+    if indexed != db.session.execute(text(f"SELECT COUNT(*) FROM {source_table}")).scalar():
+        db.session.execute(text(f"DELETE FROM {index}"))
+        return True
+    return False
+
+def refresh_search_rows(connection, index, fields, rowid, from_sql, key=None, values=None):
+    """Rewrites index rows from the SQL expressions in fields ({index column: expression}),
+    for source rows whose key (e.g. 'e.department_id') is in values; all rows if key is None."""
+    insert = f"INSERT INTO {index} (rowid, {', '.join(fields)}) SELECT {rowid}, {', '.join(fields.values())} FROM {from_sql}"
+    if key is None:
+        connection.execute(text(insert))
+        return
+    if not values:
+        return
+    where = f" WHERE {key} IN :values"
+    for sql in (f"DELETE FROM {index} WHERE rowid IN (SELECT {rowid} FROM {from_sql}{where})", insert + where):
+        connection.execute(text(sql).bindparams(db.bindparam('values', expanding=True)), {'values': list(values)})
+
+EMPLOYEE_SEARCH_FIELDS = {
+    'name': 'hr_normalize(e.full_name)',
+    'email': 'hr_normalize(e.email)',
+    'code': 'hr_normalize(e.employee_code)',
+    'national_id': 'hr_digits(e.national_id)',
+    'phone': 'hr_digits(e.phone)',
+    'department': "hr_normalize(COALESCE(d.name_ar, '') || ' ' || COALESCE(d.name_en, ''))",
+    'job_title': "hr_normalize(COALESCE(j.title_ar, '') || ' ' || COALESCE(j.title_en, ''))",
+}
+EMPLOYEE_SEARCH_SOURCE = """employees e
+    LEFT JOIN departments d ON d.id = e.department_id
+    LEFT JOIN job_titles j ON j.id = e.job_title_id"""
+EMPLOYEE_SEARCH_WEIGHTS = '10.0, 4.0, 8.0, 8.0, 6.0, 1.0, 1.0' # bm25 weights, in field order
+
+def ensure_employee_search_index():
+    with app.app_context():
+        if ensure_search_index('employee_search', EMPLOYEE_SEARCH_FIELDS, 'employees'):
+            reindex_employee_search(db.session)
+        db.session.commit()
+
+def reindex_employee_search(connection, column=None, values=None):
+    """Rewrites the index rows of employees whose column (e.g. 'department_id') is in values; all if column is None."""
+    refresh_search_rows(connection, 'employee_search', EMPLOYEE_SEARCH_FIELDS, 'e.id', EMPLOYEE_SEARCH_SOURCE,
+                        f"e.{column}" if column else None, values)
+
+@on_flush(Employee)
+def _index_flushed_employees(session, changes):
+    connection = session.connection()
+    deleted = [obj.id for obj, kind in changes if kind == 'deleted']
+    if deleted:
+        connection.execute(text("DELETE FROM employee_search WHERE rowid IN :ids")
+                           .bindparams(db.bindparam('ids', expanding=True)), {'ids': deleted})
+    reindex_employee_search(connection, 'id', [obj.id for obj, kind in changes if kind != 'deleted'])
+
+@on_flush(Department, JobTitle)
+def _index_renamed_departments(session, changes):
+    renamed = defaultdict(list)
+    for obj, kind in changes:
+        if isinstance(obj, Department) and kind == 'dirty' and (
+                previous_value(obj, 'name_ar') != obj.name_ar or previous_value(obj, 'name_en') != obj.name_en):
+            renamed['department_id'].append(obj.id)
+        elif isinstance(obj, JobTitle) and kind == 'dirty' and (
+                previous_value(obj, 'title_ar') != obj.title_ar or previous_value(obj, 'title_en') != obj.title_en):
+            renamed['job_title_id'].append(obj.id)
+    for column, ids in renamed.items():
+        reindex_employee_search(session.connection(), column, ids)
+
+EMPLOYEE_SEARCH_PERSONAL_COLUMNS = '{name email code national_id phone}'
+
+def search_employees(query_text, limit=EMPLOYEE_SEARCH_LIMIT, status=None):
+    """Prefix search; every word typed must match the start of a word in some field.
+
+    Matches on the employee's own fields are ranked with bm25. Department and job
+    title words can match thousands of rows that all rank alike, so those only
+    fill the remaining slots, unranked, which keeps broad queries fast.
+    """
+    tokens = SEARCH_TOKEN.findall(normalize_search_text(query_text))
+    if not tokens:
+        return []
+    match = ' '.join(f'"{token}"*' for token in tokens)
+    select = """
+        SELECT e.id, e.full_name, e.employee_code, e.email, e.phone, e.status, e.avatar,
+               d.name_ar AS department, j.title_ar AS job_title
+        FROM employee_search s
+        JOIN employees e ON e.id = s.rowid
+        LEFT JOIN departments d ON d.id = e.department_id
+        LEFT JOIN job_titles j ON j.id = e.job_title_id
+        WHERE employee_search MATCH :match
+    """ + ("AND e.status = :status " if status else "")
+    params = {'status': status, 'limit': limit}
+
+    rows = db.session.execute(
+        text(select + f"ORDER BY bm25(employee_search, {EMPLOYEE_SEARCH_WEIGHTS}) LIMIT :limit"),
+        {**params, 'match': f"{EMPLOYEE_SEARCH_PERSONAL_COLUMNS} : ({match})"}
+    ).mappings().all()
+    results = [dict(row) for row in rows]
+    if len(results) < limit:
+        found = [row['id'] for row in results] or [0]
+        rows = db.session.execute(
+            text(select + "AND s.rowid NOT IN :found LIMIT :remaining").bindparams(db.bindparam('found', expanding=True)),
+            {**params, 'match': match, 'found': found, 'remaining': limit - len(results)}
+        ).mappings().all()
+        results.extend(dict(row) for row in rows)
+    return results
+
+@app.route("/api/employees/search", methods=['GET'])
+@jwt_required()
+def handle_employee_search():
+    limit = max(1, min(request.args.get('limit', EMPLOYEE_SEARCH_LIMIT, type=int), EMPLOYEE_SEARCH_MAX_LIMIT))
+    results = search_employees(request.args.get('q', ''), limit, request.args.get('status'))
+    return jsonify({'employees': results})
+
+
 # --- Departments API ---
 @app.route("/api/departments", methods=['GET', 'POST'])
 @jwt_required()
@@ -1186,6 +2048,7 @@ def handle_location(id):
         location.name_ar = data.get('name_ar', location.name_ar)
         location.name_en = data.get('name_en', location.name_en)
         location.code = data.get('code', location.code)
+        location.tax_scheme_id = data.get('tax_scheme_id', location.tax_scheme_id) or None
         manager_id = data.get('manager_id')
         if manager_id == 'none' or manager_id == '':
             location.manager_id = None
@@ -1242,17 +2105,16 @@ def handle_leaves():
         employee_of_leave = Employee.query.get(employee_id_to_use)
         log_action("تقديم طلب إجازة", f"تم تقديم طلب إجازة للموظف {employee_of_leave.full_name}", username=user.username, user_id=user.id)
         
-        # Notify manager(s)
-        managers = User.query.filter(User.role.in_(['Admin', 'HR', 'Manager'])).all()
-        for manager in managers:
-             if manager.id != user.id:
-                create_notification(
-                    recipient_user_id=manager.id,
-                    title="طلب إجازة جديد",
-                    message=f"قدم الموظف {employee_of_leave.full_name} طلب إجازة جديد.",
-                    type="LeaveRequest",
-                    related_link="/leaves"
-                )
+        # Notify HR, admins and the employee's management chain
+        notify_audience(
+            title="طلب إجازة جديد",
+            message=f"قدم الموظف {employee_of_leave.full_name} طلب إجازة جديد.",
+            type="LeaveRequest",
+            related_link="/leaves",
+            roles=['Admin', 'HR', 'Manager'],
+            manager_chain_of=employee_of_leave.id,
+            exclude_user_ids=[user.id]
+        )
 
         return jsonify(new_leave_request.to_dict()), 201
 
@@ -1301,6 +2163,7 @@ def update_leave(id):
             )
 
         db.session.commit()
+        run_in_background(publish_attendance_kpis)
         return jsonify({"success": True, "message": "تمت الموافقة على طلب الإجازة."})
     elif action == 'reject':
         leave_request.status = 'Rejected'
@@ -1326,26 +2189,47 @@ def update_leave(id):
 
 
 # --- Dashboard API ---
+def compute_dashboard_summary(month_prefix):
+    """KPIs and the pending-leave preview for the dashboard, aggregated in SQL."""
+    headcount_by_status = dict(db.session.query(Employee.status, func.count(Employee.id)).group_by(Employee.status).all())
+    leaves_by_status = dict(db.session.query(LeaveRequest.status, func.count(LeaveRequest.id)).group_by(LeaveRequest.status).all())
+    review_count, average_score = db.session.query(func.count(PerformanceReview.id), func.avg(PerformanceReview.score)).one()
+
+    pending_leaves = LeaveRequest.query.options(db.joinedload(LeaveRequest.employee)).filter_by(status='Pending') \
+        .order_by(LeaveRequest.created_at.desc()).limit(5).all()
+
+    return {
+        'kpis': {
+            'total_employees': sum(headcount_by_status.values()),
+            'headcount_by_status': headcount_by_status,
+            'new_hires_this_month': Employee.query.filter(Employee.hire_date.like(f"{month_prefix}%")).count(),
+            'pending_leaves': leaves_by_status.get('Pending', 0),
+            'approved_leaves': leaves_by_status.get('Approved', 0),
+            'open_jobs': Job.query.filter_by(status='Open').count(),
+            'performance_reviews': review_count,
+            'average_performance': round(average_score, 1) if average_score is not None else 0,
+        },
+        'pendingLeaves': [lr.to_dict() for lr in pending_leaves],
+    }
+
+@on_tables_changed('employees', 'leave_requests', 'performance_reviews', 'jobs')
+def _invalidate_dashboard(changed_tables):
+    invalidate_aggregates('dashboard')
+
 @app.route("/api/dashboard", methods=['GET'])
 @jwt_required()
 def get_dashboard_data():
-    employees = Employee.query.all()
-    leave_requests = LeaveRequest.query.all()
-    performance_reviews = PerformanceReview.query.all()
-    logs = AuditLog.query.order_by(AuditLog.timestamp.desc()).limit(5).all()
+    month_prefix = date.today().strftime('%Y-%m')
+    summary = cached_aggregate(('dashboard', month_prefix), lambda: compute_dashboard_summary(month_prefix))
 
+    # Recent activity changes with every audited action, so it is never cached
+    logs = AuditLog.query.order_by(AuditLog.timestamp.desc()).limit(5).all()
     recent_activities = [{
         "text": f"{log.username or 'النظام'} قام بـ \"{log.action}\" - {log.details}",
         "time": f"منذ {int((datetime.utcnow() - log.timestamp).total_seconds() / 60)} دقائق"
     } for log in logs]
 
-    return jsonify({
-        "employees": [e.to_dict() for e in employees],
-        "leaveRequests": [lr.to_dict() for lr in leave_requests],
-        "performanceReviews": [pr.to_dict() for pr in performance_reviews],
-        "recentActivities": recent_activities,
-        "jobs": [j.to_dict() for j in Job.query.filter_by(status='Open').all()]
-    })
+    return jsonify({**summary, "recentActivities": recent_activities})
 
 # --- Recruitment API ---
 @app.route("/api/recruitment/jobs", methods=['GET', 'POST'])
@@ -1425,21 +2309,20 @@ def handle_applicants():
             if 'cv_file' in request.files:
                 file = request.files['cv_file']
                 if file.filename != '':
-                    filename = secure_filename(file.filename)
-                    job_upload_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'applicants', str(new_applicant.job_id))
-                    os.makedirs(job_upload_folder, exist_ok=True)
-                    
-                    unique_filename = f"{new_applicant.full_name.replace(' ', '_')}_{filename}"
-                    file_path = os.path.join(job_upload_folder, unique_filename)
-                    
-                    file.save(file_path)
-                    new_applicant.cv_path = os.path.join('applicants', str(new_applicant.job_id), unique_filename)
+                    error = check_uploaded_file(file, *upload_limits('applicant_cv'))
+                    if error:
+                        return jsonify({'message': error}), 400
+                    new_applicant.cv_blob_hash = store_blob_from_stream(file.stream, file.mimetype)
+                    new_applicant.cv_path = blob_relative_path(new_applicant.cv_blob_hash)
+                    new_applicant.cv_file_name = secure_filename(file.filename)
 
 
             db.session.add(new_applicant)
             db.session.commit()
             log_action("إضافة متقدم", f"تمت إضافة متقدم جديد: {new_applicant.full_name} للوظيفة ID {new_applicant.job_id}")
-            return jsonify(new_applicant.to_dict()), 201
+            data = new_applicant.to_dict()
+            data['possible_duplicates'] = find_identity_matches('applicant', new_applicant.id)
+            return jsonify(data), 201
 
         except IntegrityError as e:
             db.session.rollback()
@@ -1473,33 +2356,26 @@ def handle_applicant(id):
     if request.method == 'PUT':
         data = request.form.to_dict()
         for key, value in data.items():
-            if hasattr(applicant, key):
+            if hasattr(applicant, key) and key not in ('id', 'cv_path', 'cv_file_name', 'cv_blob_hash'):
                 setattr(applicant, key, value)
         
         if 'cv_file' in request.files:
             file = request.files['cv_file']
             if file.filename != '':
-                filename = secure_filename(file.filename)
-                job_upload_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'applicants', str(applicant.job_id))
-                os.makedirs(job_upload_folder, exist_ok=True)
-                unique_filename = f"{applicant.full_name.replace(' ', '_')}_{filename}"
-                file_path = os.path.join(job_upload_folder, unique_filename)
-                file.save(file_path)
-                applicant.cv_path = os.path.join('applicants', str(applicant.job_id), unique_filename)
+                error = check_uploaded_file(file, *upload_limits('applicant_cv'))
+                if error:
+                    db.session.rollback()
+                    return jsonify({'message': error}), 400
+                applicant.cv_blob_hash = store_blob_from_stream(file.stream, file.mimetype)
+                applicant.cv_path = blob_relative_path(applicant.cv_blob_hash)
+                applicant.cv_file_name = secure_filename(file.filename)
 
         db.session.commit()
         log_action("تحديث متقدم", f"تم تحديث بيانات المتقدم: {applicant.full_name}")
         return jsonify(applicant.to_dict())
 
     if request.method == 'DELETE':
-        if applicant.cv_path:
-            try:
-                full_path = os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], applicant.cv_path))
-                if full_path.startswith(os.path.abspath(app.config['UPLOAD_FOLDER'])):
-                    os.remove(full_path)
-            except OSError as e:
-                app.logger.error(f"Error deleting file {applicant.cv_path}: {e}")
-
+        # The CV blob may be shared (e.g. with a hired employee's documents); garbage collection removes it once unreferenced
         log_action("حذف متقدم", f"تم حذف المتقدم: {applicant.full_name}")
         db.session.delete(applicant)
         db.session.commit()
@@ -1528,8 +2404,11 @@ def hire_applicant(id):
     if applicant.stage == 'Hired':
         return jsonify({'message': 'المتقدم تم توظيفه بالفعل'}), 409
 
-    if Employee.query.filter_by(email=applicant.email).first():
-        return jsonify({'message': 'يوجد موظف بنفس البريد الإلكتروني بالفعل'}), 409
+    existing = find_identity_matches('applicant', applicant.id, kinds=['email', 'phone'], match_type='employee', limit=None)
+    if any('email' in m['matched_on'] for m in existing):
+        return jsonify({'message': 'يوجد موظف بنفس البريد الإلكتروني بالفعل', 'possible_duplicates': existing}), 409
+    if existing and request.args.get('force') != 'true':
+        return jsonify({'message': 'يوجد موظف بنفس رقم الهاتف، يرجى التأكد قبل التوظيف', 'possible_duplicates': existing}), 409
     
     job = Job.query.options(db.joinedload(Job.department)).get_or_404(applicant.job_id)
 
@@ -1573,11 +2452,14 @@ def hire_applicant(id):
         if applicant.cv_path:
             doc_type_cv = DocumentType.query.filter_by(code='CV').first()
             if doc_type_cv:
+                cv_blob = db.session.get(FileBlob, applicant.cv_blob_hash) if applicant.cv_blob_hash else None
                 emp_doc = EmployeeDocument(
                     employee_id=new_employee.id,
                     doc_type_id=doc_type_cv.id,
                     file_path=applicant.cv_path,
-                    file_name=os.path.basename(applicant.cv_path),
+                    blob_hash=applicant.cv_blob_hash,
+                    file_name=applicant.cv_file_name or os.path.basename(applicant.cv_path),
+                    mime_type=cv_blob.mime_type if cv_blob else None,
                     status='Uploaded'
                 )
                 db.session.add(emp_doc)
@@ -1596,12 +2478,1354 @@ def hire_applicant(id):
         return jsonify({'message': 'حدث خطأ أثناء عملية التوظيف'}), 500
 
 
+# --- Recruitment Pipeline ---
+# job_stage_counts holds the number of applicants in each stage of each job, so
+# job lists and the pipeline board never count applicant rows. A flush listener
+# applies +1/-1 deltas for created, deleted and moved applicants (hiring is a
+# move to Hired) in the same transaction; recount_job_stage_counts() rebuilds
+# them from the applicants table, on start and every JOB_STAGE_RECOUNT_HOURS,
+# so changes made outside the ORM (raw SQL, manual edits) can't drift forever.
+PIPELINE_STAGES = ('Applied', 'Screening', 'Interview', 'Offer', 'Hired', 'Rejected')
+PIPELINE_PAGE_SIZE = 20
+PIPELINE_MAX_PAGE_SIZE = 100
+JOB_STAGE_RECOUNT_HOURS = float(os.environ.get('JOB_STAGE_RECOUNT_HOURS', 24)) # 0 disables the periodic recount
+
+def recount_job_stage_counts(connection, job_ids=None):
+    where = " WHERE job_id IN :job_ids" if job_ids is not None else ""
+    for sql in (f"DELETE FROM job_stage_counts{where}",
+                f"INSERT INTO job_stage_counts (job_id, stage, count) SELECT job_id, stage, COUNT(*) FROM applicants{where} GROUP BY job_id, stage"):
+        statement = text(sql)
+        if job_ids is not None:
+            statement = statement.bindparams(db.bindparam('job_ids', expanding=True))
+        connection.execute(statement, {'job_ids': list(job_ids)} if job_ids is not None else {})
+
+def ensure_job_stage_counts():
+    with app.app_context():
+        if db.session.query(JobStageCount.job_id).first() is None and db.session.query(Applicant.id).first() is not None:
+            recount_job_stage_counts(db.session)
+        db.session.commit()
+
+def recount_all_job_stage_counts():
+    """Periodic task: rebuilds every job's counters in one transaction; returns how many were off."""
+    before = {(c.job_id, c.stage): c.count for c in JobStageCount.query if c.count}
+    recount_job_stage_counts(db.session)
+    db.session.commit()
+    after = {(c.job_id, c.stage): c.count for c in JobStageCount.query}
+    return {'corrected': sum(1 for key in before.keys() | after.keys() if before.get(key, 0) != after.get(key, 0))}
+
+@on_flush(Applicant)
+def _count_flushed_applicants(session, changes):
+    deltas = defaultdict(int)
+    for obj, kind in changes:
+        if kind != 'new':
+            deltas[(previous_value(obj, 'job_id'), previous_value(obj, 'stage'))] -= 1
+        if kind != 'deleted':
+            deltas[(obj.job_id, obj.stage)] += 1
+    rows = [{'job_id': job_id, 'stage': stage, 'count': delta} for (job_id, stage), delta in deltas.items() if delta]
+    if rows:
+        upsert = sqlite_insert(JobStageCount)
+        session.connection().execute(upsert.on_conflict_do_update(
+            index_elements=['job_id', 'stage'], set_={'count': JobStageCount.count + upsert.excluded.count}
+        ), rows)
+
+def pipeline_column(job_id, stage, offset=0, limit=PIPELINE_PAGE_SIZE):
+    return (Applicant.query.filter_by(job_id=job_id, stage=stage)
+            .order_by(Applicant.created_at.desc(), Applicant.id.desc())
+            .offset(offset).limit(limit).all())
+
+@app.route("/api/recruitment/jobs/<int:id>/board", methods=['GET'])
+@jwt_required()
+def job_pipeline_board(id):
+    """Stage counts plus the newest applicants of each stage column. ?stage=X&offset=N
+    returns the next page of a single column."""
+    job = Job.query.options(db.joinedload(Job.department)).get_or_404(id)
+    limit = min(max(request.args.get('per_stage', PIPELINE_PAGE_SIZE, type=int), 1), PIPELINE_MAX_PAGE_SIZE)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    stage_filter = request.args.get('stage')
+    if stage_filter and stage_filter not in PIPELINE_STAGES:
+        return jsonify({'message': 'مرحلة غير صالحة'}), 400
+
+    job_data = job.to_dict()
+    stages = []
+    for stage in ([stage_filter] if stage_filter else PIPELINE_STAGES):
+        count = job_data['stage_counts'].get(stage, 0)
+        applicants = pipeline_column(job.id, stage, offset, limit) if count > offset else []
+        stages.append({
+            'stage': stage,
+            'count': count,
+            'applicants': [a.to_dict() for a in applicants],
+            'has_more': offset + len(applicants) < count,
+        })
+    return jsonify({'job': job_data, 'stages': stages})
+
+
+# --- Applicant Search ---
+# applicant_search is an FTS5 index over applicant fields and the text of their
+# CV, keyed by applicant id and normalised like employee_search. CV text is
+# extracted once per blob by a background task scheduled after the commit that
+# attached the CV (so the blob row is visible to it) and stored in
+# applicant_cv_texts; applicants sharing the file share the text. Failed
+# extractions are retried at startup and whenever the file is attached again.
+# PDFs need pdftotext (poppler-utils); DOCX files are read with the standard
+# library. CV snippets are cut from the stored text, not the normalised index.
+APPLICANT_SEARCH_FIELDS = {
+    'name': 'hr_normalize(a.full_name)',
+    'email': 'hr_normalize(a.email)',
+    'phone': 'hr_digits(a.phone)',
+    'current_title': 'hr_normalize(a.current_title)',
+    'current_company': 'hr_normalize(a.current_company)',
+    'cv_text': 'hr_normalize(t.content)',
+}
+APPLICANT_SEARCH_SOURCE = "applicants a LEFT JOIN applicant_cv_texts t ON t.blob_hash = a.cv_blob_hash"
+APPLICANT_SEARCH_WEIGHTS = '10.0, 4.0, 4.0, 6.0, 4.0, 1.0'
+APPLICANT_SEARCH_PER_PAGE = 25
+APPLICANT_SEARCH_MAX_PER_PAGE = 100
+APPLICANT_EXPERIENCE_BUCKETS = ((0, 2, '0-2'), (3, 5, '3-5'), (6, 10, '6-10'), (11, None, '11+'))
+CV_TEXT_MAX_CHARS = 200_000
+CV_SNIPPET_WORDS = 12
+PDFTOTEXT = shutil.which('pdftotext')
+DOCX_MIME = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+def ensure_applicant_search_index():
+    with app.app_context():
+        if ensure_search_index('applicant_search', APPLICANT_SEARCH_FIELDS, 'applicants'):
+            reindex_applicant_search(db.session)
+        db.session.commit()
+        # CVs whose extraction failed or never ran (payroll worker processes import the app too; they skip this)
+        pending = [h for (h,) in db.session.execute(text(
+            "SELECT DISTINCT a.cv_blob_hash FROM applicants a LEFT JOIN applicant_cv_texts t ON t.blob_hash = a.cv_blob_hash "
+            "WHERE a.cv_blob_hash IS NOT NULL AND (t.blob_hash IS NULL OR t.status = 'Failed')"))]
+        if pending and multiprocessing.parent_process() is None:
+            run_batch_job(extract_cv_texts, pending)
+
+def reindex_applicant_search(connection, column=None, values=None):
+    refresh_search_rows(connection, 'applicant_search', APPLICANT_SEARCH_FIELDS, 'a.id', APPLICANT_SEARCH_SOURCE,
+                        f"a.{column}" if column else None, values)
+
+def extract_document_text(path, mime_type):
+    """Plain text of a PDF or DOCX file, or None for types we cannot read."""
+    if mime_type == 'application/pdf':
+        if not PDFTOTEXT:
+            return None
+        result = subprocess.run([PDFTOTEXT, '-q', '-enc', 'UTF-8', path, '-'], check=True, capture_output=True, timeout=60)
+        return result.stdout.decode('utf-8', 'replace')
+    if mime_type == DOCX_MIME:
+        with zipfile.ZipFile(path) as docx:
+            root = ElementTree.fromstring(docx.read('word/document.xml'))
+        return '\n'.join(''.join(node.text or '' for node in paragraph.iter(f"{WORD_NAMESPACE}t"))
+                         for paragraph in root.iter(f"{WORD_NAMESPACE}p"))
+    return None
+
+def extract_cv_texts(blob_hashes):
+    """Background task: extracts each CV blob's text once (again if it failed) and reindexes the applicants using it."""
+    done = {h for (h,) in db.session.query(ApplicantCvText.blob_hash).filter(
+        ApplicantCvText.blob_hash.in_(blob_hashes), ApplicantCvText.status != 'Failed')}
+    for blob_hash in set(blob_hashes) - done:
+        blob = db.session.get(FileBlob, blob_hash)
+        status, content = 'Unsupported', None
+        if blob and os.path.exists(_blob_full_path(blob_hash)):
+            try:
+                content = extract_document_text(_blob_full_path(blob_hash), blob.mime_type)
+                status = 'Extracted' if content is not None else 'Unsupported'
+            except Exception as e:
+                app.logger.warning(f"Could not extract CV text from {blob_hash}: {e}")
+                status = 'Failed'
+        upsert = sqlite_insert(ApplicantCvText).values(
+            blob_hash=blob_hash, status=status, content=content[:CV_TEXT_MAX_CHARS] if content else None,
+            extracted_at=datetime.utcnow()
+        )
+        db.session.execute(upsert.on_conflict_do_update(
+            index_elements=['blob_hash'],
+            set_={'status': upsert.excluded.status, 'content': upsert.excluded.content, 'extracted_at': upsert.excluded.extracted_at},
+            where=ApplicantCvText.status == 'Failed',
+        ))
+        reindex_applicant_search(db.session, 'cv_blob_hash', [blob_hash])
+        db.session.commit()
+
+@on_flush(Applicant)
+def _index_flushed_applicants(session, changes):
+    connection = session.connection()
+    deleted = [obj.id for obj, kind in changes if kind == 'deleted']
+    if deleted:
+        connection.execute(text("DELETE FROM applicant_search WHERE rowid IN :ids")
+                           .bindparams(db.bindparam('ids', expanding=True)), {'ids': deleted})
+    reindex_applicant_search(connection, 'id', [obj.id for obj, kind in changes if kind != 'deleted'])
+    pending = session.info.setdefault('pending_cv_texts', set())
+    for obj, kind in changes:
+        if kind != 'deleted' and obj.cv_blob_hash and (kind == 'new' or previous_value(obj, 'cv_blob_hash') != obj.cv_blob_hash):
+            pending.add(obj.cv_blob_hash)
+
+@event.listens_for(SASession, 'after_commit')
+def _schedule_cv_text_extraction(session):
+    pending = session.info.pop('pending_cv_texts', None)
+    if pending:
+        run_batch_job(extract_cv_texts, sorted(pending))
+
+@event.listens_for(SASession, 'after_soft_rollback')
+def _discard_cv_text_extraction(session, previous_transaction):
+    session.info.pop('pending_cv_texts', None)
+
+def _fold_search_token(value):
+    # Like FTS5's remove_diacritics, so 'résumé' in a CV matches the query 'resume'
+    return ''.join(c for c in unicodedata.normalize('NFKD', value) if not unicodedata.combining(c))
+
+def cv_snippet(content, tokens):
+    """About CV_SNIPPET_WORDS words of the original CV text around the first word matching a
+    query token (as a prefix), with matches wrapped in \x02…\x03; None if nothing matches."""
+    if not content or not tokens:
+        return None
+    prefixes = [_fold_search_token(token) for token in tokens]
+    def mark(word):
+        parts = SEARCH_TOKEN.findall(_fold_search_token(normalize_search_text(word)))
+        return f"\x02{word}\x03" if any(part.startswith(prefix) for part in parts for prefix in prefixes) else word
+    words = (match.group() for match in re.finditer(r'\S+', content))
+    preceding, skipped = [], 0
+    for word in words:
+        marked = mark(word)
+        if marked != word:
+            break
+        if len(preceding) == 3:
+            skipped += 1
+        preceding = preceding[-2:] + [word]
+    else:
+        return None
+    window = preceding + [marked]
+    for word in words:
+        if len(window) == CV_SNIPPET_WORDS:
+            window.append('…')
+            break
+        window.append(mark(word))
+    return ('… ' if skipped else '') + ' '.join(window)
+
+def _applicant_filters(args, skip=None):
+    """SQL conditions and parameters for the search filters, leaving out the facet being counted."""
+    conditions, params = [], {}
+    tokens = SEARCH_TOKEN.findall(normalize_search_text(args.get('q', '')))
+    if tokens:
+        conditions.append("applicant_search MATCH :match")
+        params['match'] = ' '.join(f'"{token}"*' for token in tokens)
+    for key, column, cast_type in (('job_id', 'a.job_id', int), ('stage', 'a.stage', str), ('source', 'a.source', str)):
+        if key != skip and args.get(key):
+            conditions.append(f"{column} = :{key}")
+            params[key] = cast_type(args[key])
+    if skip != 'experience':
+        if args.get('min_experience') not in (None, ''):
+            conditions.append("a.years_experience >= :min_experience")
+            params['min_experience'] = int(args['min_experience'])
+        if args.get('max_experience') not in (None, ''):
+            conditions.append("a.years_experience <= :max_experience")
+            params['max_experience'] = int(args['max_experience'])
+    if args.get('max_salary') not in (None, ''):
+        conditions.append("a.expected_salary <= :max_salary")
+        params['max_salary'] = float(args['max_salary'])
+    from_sql = "applicants a" + (" JOIN applicant_search ON applicant_search.rowid = a.id" if tokens else "")
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    return from_sql, where, params, bool(tokens)
+
+def search_applicants(args):
+    """One page of matching applicants plus facet counts. Each facet is counted with
+    every filter except its own, so the counts show what selecting another value gives."""
+    page = max(int(args.get('page', 1)), 1)
+    per_page = min(max(int(args.get('per_page', APPLICANT_SEARCH_PER_PAGE)), 1), APPLICANT_SEARCH_MAX_PER_PAGE)
+    from_sql, where, params, ranked = _applicant_filters(args)
+
+    total = db.session.execute(text(f"SELECT COUNT(*) FROM {from_sql}{where}"), params).scalar()
+    order = f"bm25(applicant_search, {APPLICANT_SEARCH_WEIGHTS})" if ranked else "a.created_at DESC"
+    rows = db.session.execute(text(f"""
+        SELECT a.id, a.job_id, jb.title AS job_title, a.full_name, a.email, a.phone, a.stage, a.source, a.rating,
+               a.current_title, a.current_company, a.years_experience, a.expected_salary, a.created_at,
+               a.cv_path, a.cv_file_name, {"t.content" if ranked else "NULL"} AS cv_content
+        FROM {from_sql} JOIN jobs jb ON jb.id = a.job_id
+             {"LEFT JOIN applicant_cv_texts t ON t.blob_hash = a.cv_blob_hash" if ranked else ""}{where}
+        ORDER BY {order} LIMIT :limit OFFSET :offset
+    """), {**params, 'limit': per_page, 'offset': (page - 1) * per_page}).mappings().all()
+    # Matches in the CV snippet are wrapped in \x02…\x03 so clients can highlight them without parsing HTML.
+    tokens = SEARCH_TOKEN.findall(normalize_search_text(args.get('q', ''))) if ranked else []
+    applicants = []
+    for row in rows:
+        applicant = dict(row)
+        applicant['cv_snippet'] = cv_snippet(applicant.pop('cv_content'), tokens)
+        applicants.append(applicant)
+
+    facets = {}
+    for facet, column in (('stage', 'a.stage'), ('job_id', 'a.job_id'), ('source', 'a.source')):
+        facet_from, facet_where, facet_params, _ = _applicant_filters(args, skip=facet)
+        facets[facet] = {str(value): count for value, count in db.session.execute(
+            text(f"SELECT {column}, COUNT(*) FROM {facet_from}{facet_where} GROUP BY {column}"), facet_params)}
+    facet_from, facet_where, facet_params, _ = _applicant_filters(args, skip='experience')
+    buckets = ' '.join(
+        f"WHEN a.years_experience >= {low}" + (f" AND a.years_experience <= {high}" if high is not None else "") + f" THEN '{label}'"
+        for low, high, label in APPLICANT_EXPERIENCE_BUCKETS)
+    facets['experience'] = {label or 'unknown': count for label, count in db.session.execute(text(
+        f"SELECT CASE {buckets} END AS bucket, COUNT(*) FROM {facet_from}{facet_where} GROUP BY bucket"), facet_params)}
+
+    return {
+        'applicants': applicants,
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'pages': (total + per_page - 1) // per_page,
+        'facets': facets,
+    }
+
+@app.route("/api/recruitment/applicants/search", methods=['GET'])
+@jwt_required()
+def handle_applicant_search():
+    try:
+        return jsonify(search_applicants(request.args))
+    except ValueError:
+        return jsonify({'message': 'معايير البحث غير صالحة'}), 400
+
+
+# --- Duplicate Detection ---
+# identity_keys holds one normalised email, phone and name key per applicant and
+# employee, so "is this the same person?" is an index lookup on (kind, value)
+# rather than a scan. Keys are computed in SQL by functions registered on every
+# connection and rewritten by a flush listener in the same transaction as the
+# row. Emails ignore case, +tags and Gmail dots; phones compare on their last
+# PHONE_KEY_DIGITS digits so 05xxxxxxxx and +9665xxxxxxxx meet; names ignore
+# word order, diacritics and "bin"/"عبد" spacing. Fuzzy name matching (difflib)
+# is only done in the bulk report.
+PHONE_KEY_DIGITS = 9
+PHONE_KEY_MIN_DIGITS = 7
+GMAIL_DOMAINS = {'gmail.com', 'googlemail.com'}
+NAME_KEY_IGNORED = {'بن', 'بنت', 'ابن', 'bin', 'bint', 'ibn'}
+NAME_KEY_PREFIXES = {'عبد', 'abd', 'abdul', 'abdel'}
+IDENTITY_SOURCES = {
+    'applicant': (Applicant, 'applicants', 'full_name'),
+    'employee': (Employee, 'employees', 'full_name'),
+}
+IDENTITY_KEY_EXPRESSIONS = {
+    'email': 'hr_email_key(email)',
+    'phone': 'hr_phone_key(phone)',
+    'name': 'hr_name_key(full_name)',
+}
+IDENTITY_MATCH_LIMIT = 20
+DUPLICATE_NAME_SIMILARITY = 0.88
+DUPLICATE_FUZZY_MAX_BLOCK = 500 # name blocks larger than this are skipped by the fuzzy pass
+DUPLICATE_REPORT_PER_PAGE = 50
+
+def email_identity_key(value):
+    local, _, domain = normalize_search_text(value).strip().partition('@')
+    if not local or not domain:
+        return None
+    local = local.split('+', 1)[0]
+    if domain in GMAIL_DOMAINS:
+        local, domain = local.replace('.', ''), 'gmail.com'
+    return f"{local}@{domain}"
+
+def phone_identity_key(value):
+    digits = _search_digits(value)
+    return digits[-PHONE_KEY_DIGITS:] if len(digits) >= PHONE_KEY_MIN_DIGITS else None
+
+def name_identity_key(value):
+    tokens, parts = SEARCH_TOKEN.findall(normalize_search_text(value)), []
+    for token in tokens:
+        if token in NAME_KEY_IGNORED or token.isdigit():
+            continue
+        if parts and parts[-1] in NAME_KEY_PREFIXES:
+            parts[-1] += token
+        else:
+            parts.append(token)
+    return ' '.join(sorted(parts)) if len(parts) >= 2 else None
+
+@event.listens_for(Engine, 'connect')
+def _register_identity_functions(dbapi_connection, connection_record):
+    if hasattr(dbapi_connection, 'create_function'):
+        dbapi_connection.create_function('hr_email_key', 1, email_identity_key, deterministic=True)
+        dbapi_connection.create_function('hr_phone_key', 1, phone_identity_key, deterministic=True)
+        dbapi_connection.create_function('hr_name_key', 1, name_identity_key, deterministic=True)
+
+def refresh_identity_keys(connection, subject_type, ids=None):
+    """Rewrites the keys of the given applicants/employees (all of them if ids is None)."""
+    _, table, _ = IDENTITY_SOURCES[subject_type]
+    if ids is not None and not ids:
+        return
+    where = " AND subject_id IN :ids" if ids is not None else ""
+    source_where = " WHERE id IN :ids" if ids is not None else ""
+    params = {'subject_type': subject_type, **({'ids': list(ids)} if ids is not None else {})}
+    def run(sql):
+        statement = text(sql)
+        if ids is not None:
+            statement = statement.bindparams(db.bindparam('ids', expanding=True))
+        connection.execute(statement, params)
+    run(f"DELETE FROM identity_keys WHERE subject_type = :subject_type{where}")
+    run("INSERT INTO identity_keys (subject_type, subject_id, kind, value) SELECT :subject_type, id, kind, value FROM ("
+        + " UNION ALL ".join(f"SELECT id, '{kind}' AS kind, {expression} AS value FROM {table}{source_where}"
+                             for kind, expression in IDENTITY_KEY_EXPRESSIONS.items())
+        + ") WHERE value IS NOT NULL")
+
+def ensure_identity_keys():
+    with app.app_context():
+        for subject_type, (model, _, _) in IDENTITY_SOURCES.items():
+            keyed = db.session.execute(text("SELECT COUNT(DISTINCT subject_id) FROM identity_keys WHERE subject_type = :t"),
+                                       {'t': subject_type}).scalar()
+            if keyed == 0 and db.session.query(model.id).first() is not None:
+                refresh_identity_keys(db.session, subject_type)
+        db.session.commit()
+
+@on_flush(Applicant)
+def _key_flushed_applicants(session, changes):
+    refresh_identity_keys(session.connection(), 'applicant', {obj.id for obj, kind in changes})
+
+@on_flush(Employee)
+def _key_flushed_employees(session, changes):
+    refresh_identity_keys(session.connection(), 'employee', {obj.id for obj, kind in changes})
+
+def describe_identity_subjects(subjects):
+    """{(subject_type, id): summary} for display next to a duplicate match."""
+    described = {}
+    applicant_ids = [i for t, i in subjects if t == 'applicant']
+    employee_ids = [i for t, i in subjects if t == 'employee']
+    if applicant_ids:
+        for a in Applicant.query.options(db.joinedload(Applicant.job)).filter(Applicant.id.in_(applicant_ids)):
+            described[('applicant', a.id)] = {
+                'type': 'applicant', 'id': a.id, 'full_name': a.full_name, 'email': a.email, 'phone': a.phone,
+                'stage': a.stage, 'job_id': a.job_id, 'job_title': a.job.title if a.job else None,
+            }
+    if employee_ids:
+        for e in Employee.query.filter(Employee.id.in_(employee_ids)):
+            described[('employee', e.id)] = {
+                'type': 'employee', 'id': e.id, 'full_name': e.full_name, 'email': e.email, 'phone': e.phone,
+                'status': e.status,
+            }
+    return described
+
+def find_identity_matches(subject_type, subject_id, kinds=None, match_type=None, limit=IDENTITY_MATCH_LIMIT):
+    """Other applicants/employees (only match_type ones if given) sharing at least one key
+    with the subject, with the keys they share. limit=None returns every match."""
+    kind_filter = " AND k.kind IN :kinds" if kinds else ""
+    type_filter = " AND o.subject_type = :match_type" if match_type else ""
+    statement = text(f"""
+        SELECT o.subject_type, o.subject_id, group_concat(o.kind) AS kinds
+        FROM identity_keys k
+        JOIN identity_keys o ON o.kind = k.kind AND o.value = k.value
+             AND NOT (o.subject_type = k.subject_type AND o.subject_id = k.subject_id){type_filter}
+        WHERE k.subject_type = :subject_type AND k.subject_id = :subject_id{kind_filter}
+        GROUP BY o.subject_type, o.subject_id
+        ORDER BY COUNT(*) DESC
+        LIMIT :limit
+    """)
+    params = {'subject_type': subject_type, 'subject_id': subject_id, 'match_type': match_type,
+              'limit': -1 if limit is None else limit}
+    if kinds:
+        statement = statement.bindparams(db.bindparam('kinds', expanding=True))
+        params['kinds'] = list(kinds)
+    rows = db.session.execute(statement, params).all()
+    described = describe_identity_subjects([(t, i) for t, i, _ in rows])
+    return [{**described[(t, i)], 'matched_on': sorted(k.split(','))} for t, i, k in rows if (t, i) in described]
+
+def _fuzzy_name_pairs():
+    """(subject, subject, score, names) for names that are similar but not key-equal. Each
+    distinct name is compared once, represented by one of its subjects (equal names are
+    already linked by their key), and only within its block of token count and the first
+    two letters of each token."""
+    blocks = defaultdict(dict)
+    for subject_type, subject_id, value in db.session.execute(
+            text("SELECT subject_type, subject_id, value FROM identity_keys WHERE kind = 'name'")):
+        tokens = value.split()
+        blocks[(len(tokens), tuple(sorted(t[:2] for t in tokens)))].setdefault(value, (subject_type, subject_id))
+    pairs = []
+    for block in blocks.values():
+        if len(block) < 2 or len(block) > DUPLICATE_FUZZY_MAX_BLOCK:
+            continue
+        members = list(block.items())
+        for i, (name, subject) in enumerate(members):
+            matcher = difflib.SequenceMatcher(None, '', name) # b is cached, so the fixed name goes there
+            for other_name, other in members[i + 1:]:
+                matcher.set_seq1(other_name)
+                if matcher.real_quick_ratio() >= DUPLICATE_NAME_SIMILARITY and matcher.quick_ratio() >= DUPLICATE_NAME_SIMILARITY:
+                    score = matcher.ratio()
+                    if score >= DUPLICATE_NAME_SIMILARITY:
+                        pairs.append((subject, other, round(score, 3), f"{name} ~ {other_name}"))
+    return pairs
+
+def build_duplicate_report(fuzzy=False):
+    """Groups of applicants/employees linked by a shared key (or similar names when fuzzy),
+    merged transitively, largest first. Each group lists the keys that linked it."""
+    parent = {}
+    def find(subject):
+        parent.setdefault(subject, subject)
+        while parent[subject] != subject:
+            parent[subject] = parent[parent[subject]]
+            subject = parent[subject]
+        return subject
+    def union(a, b):
+        parent[find(a)] = find(b)
+
+    # A hired applicant and the employee created from them are the same person, not duplicates
+    hired = {('applicant', applicant_id): ('employee', employee_id) for applicant_id, employee_id in
+             db.session.query(OnboardingRecord.applicant_id, OnboardingRecord.employee_id).filter(OnboardingRecord.applicant_id.isnot(None))}
+
+    links = []
+    for kind, value, members in db.session.execute(text("""
+        SELECT kind, value, group_concat(subject_type || ':' || subject_id)
+        FROM identity_keys GROUP BY kind, value HAVING COUNT(*) > 1
+    """)):
+        subjects = list(dict.fromkeys(hired.get(s, s) for s in ((t, int(i)) for t, i in (m.split(':') for m in members.split(',')))))
+        if len(subjects) < 2:
+            continue
+        for other in subjects[1:]:
+            union(subjects[0], other)
+        links.append((subjects[0], {'kind': kind, 'value': value, 'count': len(subjects)}))
+    if fuzzy:
+        for a, b, score, names in _fuzzy_name_pairs():
+            a, b = hired.get(a, a), hired.get(b, b)
+            if a != b:
+                union(a, b)
+                links.append((a, {'kind': 'similar_name', 'value': names, 'score': score}))
+
+    groups = defaultdict(lambda: {'members': set(), 'reasons': []})
+    for subject in parent:
+        groups[find(subject)]['members'].add(subject)
+    for subject, reason in links:
+        groups[find(subject)]['reasons'].append(reason)
+    return sorted(groups.values(), key=lambda g: (-len(g['members']), min(g['members'])))
+
+@app.route("/api/recruitment/duplicates", methods=['GET'])
+@jwt_required()
+def duplicate_report():
+    """Bulk dedup report across all applicants and employees; ?fuzzy=true adds similar-name matching."""
+    if get_jwt().get('role') not in ['Admin', 'HR']:
+        return jsonify({'message': 'Forbidden'}), 403
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', DUPLICATE_REPORT_PER_PAGE, type=int), 1), 200)
+    groups = build_duplicate_report(fuzzy=request.args.get('fuzzy') == 'true')
+    page_groups = groups[(page - 1) * per_page:page * per_page]
+    described = describe_identity_subjects([s for g in page_groups for s in g['members']])
+    return jsonify({
+        'groups': [{
+            'members': [described[s] for s in sorted(g['members']) if s in described],
+            'reasons': g['reasons'],
+        } for g in page_groups],
+        'total': len(groups),
+        'page': page,
+        'per_page': per_page,
+    })
+
+@app.route("/api/recruitment/applicants/<int:id>/duplicates", methods=['GET'])
+@jwt_required()
+def applicant_duplicates(id):
+    applicant = Applicant.query.get_or_404(id)
+    return jsonify({'duplicates': find_identity_matches('applicant', applicant.id)})
+
+
+# --- Tax Evaluation ---
+class CompiledTaxScheme:
+    """In-memory form of a tax scheme for fast evaluation.
+
+    Brackets become sorted threshold/cap/rate arrays plus the cumulative tax
+    owed at each threshold, so one amount is taxed with a binary search.
+    """
+
+    def __init__(self, scheme_id, method, brackets):
+        brackets = sorted(brackets, key=lambda b: b[0])
+        self.scheme_id = scheme_id
+        self.method = method
+        self.thresholds = [b[0] for b in brackets]
+        self.caps = [b[1] for b in brackets]
+        self.rates = [b[2] / 100 for b in brackets]
+        self.cumulative = [0.0]
+        for i in range(len(brackets) - 1):
+            cap = self.caps[i] if self.caps[i] is not None else self.thresholds[i + 1]
+            self.cumulative.append(self.cumulative[-1] + (cap - self.thresholds[i]) * self.rates[i])
+
+    def bracket_index(self, amount):
+        """Index of the bracket amount falls into, or -1 below the first threshold."""
+        return bisect.bisect_left(self.thresholds, amount) - 1
+
+    def tax(self, amount):
+        i = self.bracket_index(amount)
+        if i < 0:
+            return 0.0
+        if self.method == 'flat':
+            return amount * self.rates[i]
+        cap = self.caps[i]
+        return self.cumulative[i] + ((amount if cap is None else min(amount, cap)) - self.thresholds[i]) * self.rates[i]
+
+    def tax_many(self, amounts):
+        return [self.tax(amount) for amount in amounts]
+
+_compiled_tax_schemes = {}
+_compiled_tax_lock = threading.Lock()
+
+def compile_tax_scheme(scheme):
+    brackets = [(b.min_amount, b.max_amount, b.rate) for b in TaxBracket.query.filter_by(scheme_id=scheme.id)]
+    return CompiledTaxScheme(scheme.id, scheme.method, brackets)
+
+def get_compiled_tax_scheme(scheme_id=None):
+    """Compiled scheme by id, or the default (first active) scheme; None if there is none."""
+    key = scheme_id or 'default'
+    with _compiled_tax_lock:
+        if key in _compiled_tax_schemes:
+            return _compiled_tax_schemes[key]
+    if scheme_id:
+        scheme = db.session.get(TaxScheme, scheme_id)
+    else:
+        scheme = TaxScheme.query.filter_by(active=True).order_by(TaxScheme.id).first()
+    compiled = compile_tax_scheme(scheme) if scheme else None
+    with _compiled_tax_lock:
+        _compiled_tax_schemes[key] = compiled
+    return compiled
+
+@on_tables_changed('tax_schemes', 'tax_brackets')
+def _invalidate_compiled_tax_schemes(changed_tables):
+    with _compiled_tax_lock:
+        _compiled_tax_schemes.clear()
+
+# --- Payroll Engine ---
+# A run computes a whole month for every active employee in one pass: inputs
+# are loaded with a handful of queries into per-employee columns, each pay
+# element is computed column-wise, and the resulting Payroll rows replace the
+# period's previous non-final rows in bulk.
+PAYROLL_STANDARD_MONTHLY_HOURS = 240 # 30 days x 8 hours, for the hourly overtime rate
+PAYROLL_OVERTIME_MULTIPLIER = 1.5
+PAYROLL_FINAL_STATUSES = ('Approved', 'Paid') # never recomputed by a run
+PAYROLL_BATCH_SIZE = 500
+PAYROLL_DAYS_PER_MONTH = 30 # daily rate basis for unpaid leave
+PAYROLL_UNPAID_LEAVE_TYPES = ('Unpaid',)
+# Deducting approved unpaid leave changes net pay, so it is opt-in
+PAYROLL_DEDUCT_UNPAID_LEAVE = os.environ.get('PAYROLL_DEDUCT_UNPAID_LEAVE', '').lower() == 'true'
+APPROVED_LEAVE_STATUSES = ('Approved', 'HRApproved')
+
+def _component_amounts(component, base, gross):
+    if component.calculation_type == 'fixed':
+        return [component.value or 0.0] * len(base)
+    if component.calculation_type == 'percent':
+        basis = gross if component.base == 'gross' else base
+        rate = (component.rate or 0.0) / 100
+        return [b * rate for b in basis]
+    app.logger.warning(f"Payroll component {component.code}: calculation type '{component.calculation_type}' is not supported, skipped.")
+    return None
+
+def unpaid_leave_days(month):
+    """{employee_id: approved unpaid leave days falling in the 'YYYY-MM' month}."""
+    month_start, month_end = _month_bounds(month)
+    overlap_days = (func.julianday(func.min(LeaveRequest.end_date, month_end))
+                    - func.julianday(func.max(LeaveRequest.start_date, month_start)) + 1)
+    return dict(db.session.query(LeaveRequest.employee_id, func.sum(overlap_days)).filter(
+        LeaveRequest.leave_type.in_(PAYROLL_UNPAID_LEAVE_TYPES),
+        LeaveRequest.status.in_(APPROVED_LEAVE_STATUSES),
+        LeaveRequest.start_date <= month_end,
+        LeaveRequest.end_date >= month_start
+    ).group_by(LeaveRequest.employee_id).all())
+
+def compute_payroll_lines(month, year, employee_ids=None):
+    """Computes payroll lines for the period without writing them."""
+    month_prefix = f"{year:04d}-{month:02d}-"
+    query = db.session.query(Employee.id, Employee.base_salary, Employee.allowances, Employee.location_id).filter(Employee.status == 'Active')
+    if employee_ids is not None:
+        query = query.filter(Employee.id.in_(employee_ids))
+    employees = query.order_by(Employee.id).all()
+    if not employees:
+        return []
+
+    ids = [e.id for e in employees]
+    base = [e.base_salary or 0.0 for e in employees]
+    allowances = [e.allowances or 0.0 for e in employees]
+
+    overtime_by_employee = dict(db.session.query(Attendance.employee_id, func.sum(Attendance.overtime_minutes)).filter(
+        Attendance.date.like(f"{month_prefix}%"),
+        Attendance.overtime_minutes > 0
+    ).group_by(Attendance.employee_id).all())
+    overtime = [b / PAYROLL_STANDARD_MONTHLY_HOURS * PAYROLL_OVERTIME_MULTIPLIER * (overtime_by_employee.get(i) or 0) / 60
+                for i, b in zip(ids, base)]
+    gross = [b + a + o for b, a, o in zip(base, allowances, overtime)]
+
+    zeros = [0.0] * len(ids)
+    earnings, deductions, insurance = zeros[:], zeros[:], zeros[:]
+    taxable = gross[:]
+    breakdowns = [{} for _ in ids]
+
+    unpaid_days = unpaid_leave_days(month_prefix[:7]) if PAYROLL_DEDUCT_UNPAID_LEAVE else {}
+    for i, eid in enumerate(ids):
+        days = min(unpaid_days.get(eid) or 0, PAYROLL_DAYS_PER_MONTH)
+        if days:
+            amount = base[i] / PAYROLL_DAYS_PER_MONTH * days
+            deductions[i] += amount
+            taxable[i] -= amount
+            breakdowns[i]['UNPAID_LEAVE'] = round(amount, 2)
+    for component in PayrollComponent.query.filter_by(active=True).order_by(PayrollComponent.id):
+        if component.calculation_type == 'shift_allowance':
+            accrued = shift_allowance_totals(month, year)
+            amounts = [accrued.get(eid, 0.0) for eid in ids]
+        else:
+            amounts = _component_amounts(component, base, gross)
+        if amounts is None:
+            continue
+        is_earning = component.component_type in ('earning', 'benefit')
+        target = earnings if is_earning else insurance if component.component_type == 'insurance' else deductions
+        for i, amount in enumerate(amounts):
+            target[i] += amount
+            breakdowns[i][component.code] = round(amount, 2)
+            if is_earning and component.taxable:
+                taxable[i] += amount
+            elif not is_earning and component.pre_tax:
+                taxable[i] -= amount
+
+    # Each location may use its own scheme; bracket limits are annual amounts
+    location_schemes = dict(db.session.query(Location.id, Location.tax_scheme_id).filter(Location.tax_scheme_id.isnot(None)).all())
+    scheme_ids = [location_schemes.get(e.location_id) for e in employees]
+    tax = zeros[:]
+    for scheme_id in set(scheme_ids):
+        compiled = get_compiled_tax_scheme(scheme_id)
+        if compiled is None:
+            continue
+        members = [i for i, sid in enumerate(scheme_ids) if sid == scheme_id]
+        for i, annual_tax in zip(members, compiled.tax_many([taxable[i] * 12 for i in members])):
+            tax[i] = annual_tax / 12
+
+    return [{
+        'employee_id': ids[i],
+        'month': month,
+        'year': year,
+        'base_salary': round(base[i], 2),
+        'allowances': round(allowances[i] + earnings[i], 2),
+        'overtime': round(overtime[i], 2),
+        'deductions': round(deductions[i], 2),
+        'tax': round(tax[i], 2),
+        'insurance': round(insurance[i], 2),
+        'net_salary': round(gross[i] + earnings[i] - deductions[i] - insurance[i] - tax[i], 2),
+        'breakdown_json': json.dumps(breakdowns[i]),
+        'status': 'Generated',
+    } for i in range(len(ids))]
+
+def run_payroll(month, year, employee_ids=None, commit=True):
+    """Computes and stores payroll for the period. Re-running replaces non-final rows."""
+    final_rows = db.session.query(Payroll.employee_id).filter(
+        Payroll.month == month, Payroll.year == year, Payroll.status.in_(PAYROLL_FINAL_STATUSES))
+    if employee_ids is None:
+        finalized = {eid for (eid,) in final_rows}
+    else:
+        # Only this run's employees, so partitions don't each report the whole period
+        finalized = set()
+        for batch in chunked(employee_ids, PAYROLL_BATCH_SIZE):
+            finalized.update(eid for (eid,) in final_rows.filter(Payroll.employee_id.in_(batch)))
+    lines = [line for line in compute_payroll_lines(month, year, employee_ids) if line['employee_id'] not in finalized]
+
+    now = datetime.utcnow()
+    for batch in chunked(lines, PAYROLL_BATCH_SIZE):
+        Payroll.query.filter(
+            Payroll.month == month, Payroll.year == year,
+            Payroll.employee_id.in_([line['employee_id'] for line in batch])
+        ).delete(synchronize_session=False)
+        db.session.execute(Payroll.__table__.insert(), [{**line, 'generated_at': now} for line in batch])
+        PayrollStaleMark.query.filter(
+            PayrollStaleMark.month == month, PayrollStaleMark.year == year,
+            PayrollStaleMark.employee_id.in_([line['employee_id'] for line in batch])
+        ).delete(synchronize_session=False)
+    if commit:
+        db.session.commit()
+
+    return {
+        'generated': len(lines),
+        'skipped_finalized': len(finalized),
+        'total_net': round(sum(line['net_salary'] for line in lines), 2),
+        'total_tax': round(sum(line['tax'] for line in lines), 2),
+    }
+
+# --- Shift Allowance Accrual ---
+# A month's shift allowances are rebuilt with one INSERT ... SELECT that groups
+# published roster slots by employee and shift. 'scheduled' allowances count
+# every slot; 'worked' ones only slots with an attendance record that day.
+# Payroll picks the result up through the SHIFT_ALLOWANCE component.
+SHIFT_ALLOWANCE_COMPONENT_CODE = 'SHIFT_ALLOWANCE'
+WORKED_ATTENDANCE_STATUSES = ('Present', 'Late')
+
+def ensure_shift_allowance_component():
+    component = PayrollComponent.query.filter_by(code=SHIFT_ALLOWANCE_COMPONENT_CODE).first()
+    if not component:
+        component = PayrollComponent(code=SHIFT_ALLOWANCE_COMPONENT_CODE, name='بدل المناوبات', component_type='earning',
+                                     calculation_type='shift_allowance', taxable=True, pre_tax=False, active=True)
+        db.session.add(component)
+    return component
+
+def accrue_shift_allowances(month, year):
+    month_start, month_end = _month_bounds(f"{year:04d}-{month:02d}")
+    accruals = ShiftAllowanceAccrual.__table__
+    previous = {eid for (eid,) in db.session.query(accruals.c.employee_id).filter(
+        accruals.c.year == year, accruals.c.month == month).distinct()}
+    db.session.execute(accruals.delete().where(accruals.c.year == year, accruals.c.month == month))
+
+    slots, allowances, attendance = RosterSlot.__table__, ShiftAllowance.__table__, Attendance.__table__
+    worked = db.exists().where(
+        attendance.c.employee_id == slots.c.employee_id,
+        attendance.c.date == slots.c.date,
+        attendance.c.status.in_(WORKED_ATTENDANCE_STATUSES))
+    aggregate = db.select(
+        slots.c.employee_id, db.literal(year), db.literal(month), slots.c.shift_id,
+        func.count(func.distinct(slots.c.id)), func.sum(allowances.c.allowance_amount), db.literal(datetime.utcnow())
+    ).join(allowances, allowances.c.shift_id == slots.c.shift_id).where(
+        slots.c.date.between(month_start, month_end),
+        slots.c.status.in_(RECONCILE_SLOT_STATUSES),
+        db.or_(allowances.c.apply_when == 'scheduled', worked)
+    ).group_by(slots.c.employee_id, slots.c.shift_id)
+    db.session.execute(accruals.insert().from_select(
+        ['employee_id', 'year', 'month', 'shift_id', 'shift_count', 'amount', 'computed_at'], aggregate))
+
+    totals = shift_allowance_totals(month, year)
+    ensure_shift_allowance_component()
+    # Generated payroll lines of affected employees now need recalculation
+    affected = previous | set(totals)
+    if affected:
+        payrolls = Payroll.__table__
+        open_lines = db.select(payrolls.c.employee_id, payrolls.c.year, payrolls.c.month, db.literal('shift_allowance'),
+                               db.literal(datetime.utcnow())).where(
+            payrolls.c.year == year, payrolls.c.month == month,
+            payrolls.c.status.notin_(PAYROLL_FINAL_STATUSES))
+        for eid_chunk in chunked(sorted(affected), 900):
+            db.session.execute(PayrollStaleMark.__table__.insert().prefix_with('OR IGNORE').from_select(
+                ['employee_id', 'year', 'month', 'reason', 'marked_at'], open_lines.where(payrolls.c.employee_id.in_(eid_chunk))))
+    db.session.commit()
+    return {'employees': len(totals), 'total_amount': round(sum(totals.values()), 2)}
+
+def shift_allowance_totals(month, year):
+    return {eid: amount or 0.0 for eid, amount in db.session.query(
+        ShiftAllowanceAccrual.employee_id, func.sum(ShiftAllowanceAccrual.amount)).filter(
+        ShiftAllowanceAccrual.year == year, ShiftAllowanceAccrual.month == month
+    ).group_by(ShiftAllowanceAccrual.employee_id)}
+
+# --- Incremental Payroll Recalculation ---
+# Changes to a payroll input mark the (employee, month) lines that depend on
+# it as stale, but only where a non-final line has already been generated.
+# Recalculation recomputes just those lines and reports what moved.
+PAYROLL_EMPLOYEE_INPUTS = ('base_salary', 'allowances', 'location_id', 'status')
+PAYROLL_COMPONENT_INPUTS = ('component_type', 'calculation_type', 'value', 'rate', 'base', 'taxable', 'pre_tax', 'active')
+PAYROLL_TAX_SCHEME_INPUTS = ('method', 'active')
+PAYROLL_TAX_BRACKET_INPUTS = ('scheme_id', 'min_amount', 'max_amount', 'rate')
+PAYROLL_DIFF_FIELDS = ('base_salary', 'allowances', 'overtime', 'deductions', 'tax', 'insurance', 'net_salary')
+
+def _has_changes(obj, attrs):
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+@on_flush(Employee, PayrollComponent, Attendance, LeaveRequest, TaxScheme, TaxBracket, Location)
+def _mark_stale_payroll_lines(session, changes):
+    payrolls = Payroll.__table__
+    open_lines = db.select(payrolls.c.employee_id, payrolls.c.year, payrolls.c.month).where(
+        payrolls.c.status.notin_(PAYROLL_FINAL_STATUSES))
+    conditions = defaultdict(list) # reason -> where clauses over open payroll lines
+
+    for obj, kind in changes:
+        if isinstance(obj, Employee):
+            if kind == 'dirty' and _has_changes(obj, PAYROLL_EMPLOYEE_INPUTS):
+                conditions['employee'].append(payrolls.c.employee_id == obj.id)
+        elif isinstance(obj, PayrollComponent):
+            if kind != 'dirty' or _has_changes(obj, PAYROLL_COMPONENT_INPUTS):
+                conditions['component'].append(db.true())
+        elif isinstance(obj, (TaxScheme, TaxBracket)):
+            # A scheme can be the fallback for every location without its own, so any line may depend on it
+            inputs = PAYROLL_TAX_SCHEME_INPUTS if isinstance(obj, TaxScheme) else PAYROLL_TAX_BRACKET_INPUTS
+            if kind != 'dirty' or _has_changes(obj, inputs):
+                conditions['tax'].append(db.true())
+        elif isinstance(obj, Location):
+            if kind == 'dirty' and _has_changes(obj, ('tax_scheme_id',)):
+                conditions['tax'].append(payrolls.c.employee_id.in_(
+                    db.select(Employee.id).where(Employee.location_id == obj.id)))
+        elif isinstance(obj, Attendance):
+            if kind == 'dirty' and not _has_changes(obj, ('employee_id', 'date', 'overtime_minutes')):
+                continue
+            for employee_id, day in {(obj.employee_id, obj.date), (previous_value(obj, 'employee_id'), previous_value(obj, 'date'))}:
+                if employee_id and day and len(day) >= 7:
+                    conditions['attendance'].append(db.and_(
+                        payrolls.c.employee_id == employee_id,
+                        payrolls.c.year == int(day[:4]), payrolls.c.month == int(day[5:7])))
+        elif isinstance(obj, LeaveRequest):
+            if not PAYROLL_DEDUCT_UNPAID_LEAVE:
+                continue
+            if kind == 'dirty' and not _has_changes(obj, ('status', 'leave_type', 'start_date', 'end_date')):
+                continue
+            starts = [_month_of(obj.start_date), _month_of(previous_value(obj, 'start_date'))]
+            ends = [_month_of(obj.end_date), _month_of(previous_value(obj, 'end_date'))]
+            if not (all(starts) and all(ends)):
+                continue
+            periods = [db.and_(payrolls.c.year == int(m[:4]), payrolls.c.month == int(m[5:7]))
+                       for m in _months_between(min(starts), max(ends))]
+            conditions['leave'].append(db.and_(payrolls.c.employee_id == obj.employee_id, db.or_(*periods)))
+
+    if not conditions:
+        return
+    connection = session.connection()
+    now = datetime.utcnow()
+    for reason, clauses in conditions.items():
+        rows = connection.execute(open_lines.where(db.or_(*clauses))).all()
+        if rows:
+            stmt = sqlite_insert(PayrollStaleMark.__table__).on_conflict_do_nothing()
+            connection.execute(stmt, [{'employee_id': r.employee_id, 'year': r.year, 'month': r.month,
+                                       'reason': reason, 'marked_at': now} for r in rows])
+
+def recalculate_stale_payrolls(month=None, year=None):
+    """Recomputes stale payroll lines and returns the per-employee differences."""
+    query = PayrollStaleMark.query
+    if month and year:
+        query = query.filter_by(month=month, year=year)
+    marks = defaultdict(dict)
+    for mark in query:
+        marks[(mark.year, mark.month)][mark.employee_id] = mark.reason
+
+    changes, unchanged = [], 0
+    for (period_year, period_month), reasons in sorted(marks.items()):
+        employee_ids = list(reasons)
+        # Plain column rows, so the bulk replace below cannot hand back stale identity-mapped objects
+        line_columns = [Payroll.employee_id] + [getattr(Payroll, f) for f in PAYROLL_DIFF_FIELDS]
+        period_lines = lambda: {row.employee_id: row for row in db.session.query(*line_columns).filter(
+            Payroll.year == period_year, Payroll.month == period_month, Payroll.employee_id.in_(employee_ids))}
+        before = period_lines()
+
+        run_payroll(period_month, period_year, employee_ids, commit=False)
+        # Lines that produced no new result (e.g. the employee is no longer active) are left as they were
+        PayrollStaleMark.query.filter(
+            PayrollStaleMark.year == period_year, PayrollStaleMark.month == period_month,
+            PayrollStaleMark.employee_id.in_(employee_ids)
+        ).delete(synchronize_session=False)
+
+        after = period_lines()
+        for employee_id in employee_ids:
+            old, new = before.get(employee_id), after.get(employee_id)
+            diff = {}
+            for field in PAYROLL_DIFF_FIELDS:
+                old_value = (getattr(old, field) or 0.0) if old else 0.0
+                new_value = (getattr(new, field) or 0.0) if new else 0.0
+                if round(new_value - old_value, 2):
+                    diff[field] = {'old': old_value, 'new': new_value, 'delta': round(new_value - old_value, 2)}
+            if diff:
+                changes.append({'employee_id': employee_id, 'month': period_month, 'year': period_year,
+                                'reason': reasons[employee_id], 'changes': diff})
+            else:
+                unchanged += 1
+    db.session.commit()
+
+    return {
+        'recalculated': sum(len(r) for r in marks.values()),
+        'changed': len(changes),
+        'unchanged': unchanged,
+        'net_delta': round(sum(c['changes'].get('net_salary', {}).get('delta', 0) for c in changes), 2),
+        'changes': changes,
+    }
+
+# --- Parallel Payroll Runs ---
+# Large runs are split by location or department. Partitions execute on a
+# process pool; each one commits its payroll rows together with its 'Done'
+# checkpoint, so resuming a crashed run only redoes unfinished partitions.
+PAYROLL_WORKERS = int(os.environ.get('PAYROLL_WORKERS', os.cpu_count() or 2))
+_active_payroll_runs = set()
+
+# Workers are spawned rather than forked: the server process runs request,
+# background, broker and scheduler threads, and a fork taken while one of them
+# holds a lock (logging, the connection pool) can deadlock the child.
+_payroll_mp_context = multiprocessing.get_context('spawn')
+
+def _payroll_partition_worker(partition_id):
+    """Process-pool entry point: computes one partition and records its checkpoint."""
+    with app.app_context():
+        partition = db.session.get(PayrollRunPartition, partition_id)
+        run = partition.run
+        column = Employee.location_id if run.partition_by == 'location' else Employee.department_id
+        key_filter = column.is_(None) if partition.partition_key == 0 else column == partition.partition_key
+        employee_ids = [eid for (eid,) in db.session.query(Employee.id).filter(key_filter, Employee.status == 'Active')]
+
+        summary = run_payroll(run.month, run.year, employee_ids, commit=False)
+        partition.status = 'Done'
+        partition.employee_count = summary['generated']
+        partition.error = None
+        partition.finished_at = datetime.utcnow()
+        db.session.commit()
+        return summary['generated']
+
+def create_payroll_run(month, year, partition_by, user_id=None):
+    column = Employee.location_id if partition_by == 'location' else Employee.department_id
+    keys = sorted({key or 0 for (key,) in db.session.query(column).filter(Employee.status == 'Active').distinct()})
+    run = PayrollRun(month=month, year=year, partition_by=partition_by, total_partitions=len(keys), started_by=user_id)
+    db.session.add(run)
+    db.session.flush()
+    db.session.execute(PayrollRunPartition.__table__.insert(), [{'run_id': run.id, 'partition_key': key, 'status': 'Pending'} for key in keys])
+    db.session.commit()
+    return run
+
+def execute_payroll_run(run_id):
+    """Runs every partition that has not reached its checkpoint yet."""
+    if run_id in _active_payroll_runs:
+        return
+    _active_payroll_runs.add(run_id)
+    try:
+        run = db.session.get(PayrollRun, run_id)
+        run.status = 'Running'
+        run.error = None
+        db.session.commit()
+
+        pending = [p.id for p in run.partitions.filter(PayrollRunPartition.status != 'Done')]
+        errors = []
+        if pending:
+            with ProcessPoolExecutor(max_workers=min(PAYROLL_WORKERS, len(pending)), mp_context=_payroll_mp_context) as pool:
+                futures = {pool.submit(_payroll_partition_worker, pid): pid for pid in pending}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        app.logger.error(f"Payroll run {run_id}, partition {futures[future]} failed: {e}")
+                        errors.append(str(e))
+                        PayrollRunPartition.query.filter_by(id=futures[future]).update({'status': 'Failed', 'error': str(e)})
+                    _refresh_payroll_run_progress(run)
+
+        _refresh_payroll_run_progress(run)
+        run.status = 'Completed' if run.completed_partitions == run.total_partitions else 'Failed'
+        run.error = '\n'.join(errors) or None
+        run.finished_at = datetime.utcnow()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        PayrollRun.query.filter_by(id=run_id).update({'status': 'Failed', 'error': str(e)})
+        db.session.commit()
+        raise
+    finally:
+        _active_payroll_runs.discard(run_id)
+
+def _refresh_payroll_run_progress(run):
+    done, processed = db.session.query(func.count(PayrollRunPartition.id), func.sum(PayrollRunPartition.employee_count)).filter(
+        PayrollRunPartition.run_id == run.id, PayrollRunPartition.status == 'Done').one()
+    run.completed_partitions = done
+    run.employees_processed = processed or 0
+    db.session.commit()
+
+# --- Payslips ---
+# Payslips are rendered from stored Payroll rows with a template compiled once
+# per process. Rows are loaded and rendered in chunks on a thread pool with at
+# most PAYSLIP_WORKERS chunks in flight; the next chunk is only submitted when
+# one completes and has been written out, so memory stays bounded by workers x
+# chunk size. Each payslip is written to payslips/YYYY-MM/<employee_id>.html
+# (served through /api/uploads) and recorded in Payroll.payslip_path; the
+# archive format additionally bundles them into payslips/YYYY-MM.zip.
+PAYSLIP_WORKERS = int(os.environ.get('PAYSLIP_WORKERS', 4))
+PAYSLIP_CHUNK_SIZE = 500
+PAYSLIP_TEMPLATE = """<!DOCTYPE html>
+<html lang="ar" dir="rtl">
+<head>
+<meta charset="utf-8">
+<title>قسيمة راتب {{ employee_name }} - {{ period }}</title>
+<style>
+body { font-family: Tahoma, Arial, sans-serif; margin: 2em; color: #222; }
+table { border-collapse: collapse; width: 100%; margin-top: 1em; }
+th, td { border: 1px solid #ccc; padding: 6px 10px; text-align: right; }
+th { background: #f3f3f3; }
+.total td { font-weight: bold; }
+</style>
+</head>
+<body>
+<h2>قسيمة راتب - {{ period }}</h2>
+<p>الموظف: {{ employee_name }} ({{ employee_code or employee_id }})<br>
+القسم: {{ department or '-' }}<br>
+المسمى الوظيفي: {{ job_title or '-' }}</p>
+<table>
+<tr><th>البند</th><th>المبلغ</th></tr>
+<tr><td>الراتب الأساسي</td><td>{{ '%.2f' % base_salary }}</td></tr>
+<tr><td>البدلات</td><td>{{ '%.2f' % allowances }}</td></tr>
+<tr><td>العمل الإضافي</td><td>{{ '%.2f' % overtime }}</td></tr>
+{% for label, amount in breakdown %}<tr><td>{{ label }}</td><td>{{ '%.2f' % amount }}</td></tr>
+{% endfor %}<tr><td>الاستقطاعات</td><td>{{ '%.2f' % deductions }}</td></tr>
+<tr><td>التأمينات</td><td>{{ '%.2f' % insurance }}</td></tr>
+<tr><td>الضريبة</td><td>{{ '%.2f' % tax }}</td></tr>
+<tr class="total"><td>صافي الراتب</td><td>{{ '%.2f' % net_salary }}</td></tr>
+</table>
+<p><small>تاريخ الإصدار: {{ issued_at }}</small></p>
+</body>
+</html>
+"""
+_payslip_template = None
+
+def get_payslip_template():
+    global _payslip_template
+    if _payslip_template is None:
+        _payslip_template = app.jinja_env.from_string(PAYSLIP_TEMPLATE)
+    return _payslip_template
+
+def _payslip_folder(month, year):
+    return os.path.join('payslips', f"{year:04d}-{month:02d}")
+
+def _render_payslip_chunk(payroll_ids, labels, issued_at):
+    """Renders one chunk of payroll rows; returns [(payroll_id, employee_id, html)]."""
+    with app.app_context():
+        rows = db.session.query(
+            Payroll.id, Payroll.employee_id, Payroll.month, Payroll.year, Payroll.base_salary, Payroll.allowances,
+            Payroll.overtime, Payroll.deductions, Payroll.tax, Payroll.insurance, Payroll.net_salary, Payroll.breakdown_json,
+            Employee.full_name, Employee.employee_code, Department.name_ar, JobTitle.title_ar
+        ).join(Employee, Payroll.employee_id == Employee.id).outerjoin(
+            Department, Employee.department_id == Department.id
+        ).outerjoin(JobTitle, Employee.job_title_id == JobTitle.id).filter(Payroll.id.in_(payroll_ids)).all()
+        db.session.remove()
+
+    template = get_payslip_template()
+    rendered = []
+    for row in rows:
+        breakdown = json.loads(row.breakdown_json) if row.breakdown_json else {}
+        rendered.append((row.id, row.employee_id, template.render(
+            period=f"{row.year:04d}-{row.month:02d}",
+            employee_id=row.employee_id,
+            employee_name=row.full_name,
+            employee_code=row.employee_code,
+            department=row.name_ar,
+            job_title=row.title_ar,
+            base_salary=row.base_salary or 0.0,
+            allowances=row.allowances or 0.0,
+            overtime=row.overtime or 0.0,
+            deductions=row.deductions or 0.0,
+            tax=row.tax or 0.0,
+            insurance=row.insurance or 0.0,
+            net_salary=row.net_salary or 0.0,
+            breakdown=[(labels.get(code, code), amount) for code, amount in breakdown.items()],
+            issued_at=issued_at,
+        )))
+    return rendered
+
+def _rendered_payslip_chunks(payroll_ids, labels, issued_at):
+    """Yields rendered chunks as they complete, keeping at most PAYSLIP_WORKERS chunks in flight."""
+    chunks = chunked(payroll_ids, PAYSLIP_CHUNK_SIZE)
+    with ThreadPoolExecutor(max_workers=PAYSLIP_WORKERS) as pool:
+        in_flight = {pool.submit(_render_payslip_chunk, chunk, labels, issued_at)
+                     for chunk in itertools.islice(chunks, PAYSLIP_WORKERS)}
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                next_chunk = next(chunks, None)
+                if next_chunk is not None:
+                    in_flight.add(pool.submit(_render_payslip_chunk, next_chunk, labels, issued_at))
+
+def render_payslips(month, year, employee_ids=None, archive=False):
+    """Renders payslips for a period to per-employee files, optionally bundled into one zip archive."""
+    query = db.session.query(Payroll.id).filter(Payroll.month == month, Payroll.year == year)
+    if employee_ids:
+        query = query.filter(Payroll.employee_id.in_(employee_ids))
+    payroll_ids = [pid for (pid,) in query.order_by(Payroll.employee_id)]
+    if not payroll_ids:
+        return {'rendered': 0, 'archive_url': None, 'payslips': []}
+
+    labels = {code: name for code, name in db.session.query(PayrollComponent.code, PayrollComponent.name)}
+    labels['UNPAID_LEAVE'] = 'خصم إجازة غير مدفوعة'
+    issued_at = datetime.utcnow().strftime('%Y-%m-%d')
+    folder = _payslip_folder(month, year)
+    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], folder), exist_ok=True)
+
+    archive_path = f"{folder}.zip"
+    written = []
+    archive_file = zipfile.ZipFile(os.path.join(app.config['UPLOAD_FOLDER'], archive_path), 'w', zipfile.ZIP_DEFLATED) if archive else None
+    try:
+        for rendered in _rendered_payslip_chunks(payroll_ids, labels, issued_at):
+            for payroll_id, employee_id, html in rendered:
+                relative_path = os.path.join(folder, f"{employee_id}.html")
+                with open(os.path.join(app.config['UPLOAD_FOLDER'], relative_path), 'w', encoding='utf-8') as f:
+                    f.write(html)
+                if archive_file:
+                    archive_file.writestr(f"{employee_id}.html", html)
+                written.append({'pid': payroll_id, 'employee_id': employee_id, 'path': relative_path.replace(os.sep, '/')})
+    finally:
+        if archive_file:
+            archive_file.close()
+
+    if written:
+        payrolls = Payroll.__table__
+        db.session.execute(payrolls.update().where(payrolls.c.id == db.bindparam('pid')).values(payslip_path=db.bindparam('path')), written)
+        db.session.commit()
+    return {
+        'rendered': len(written),
+        'archive_url': f"/api/uploads/{archive_path.replace(os.sep, '/')}" if archive else None,
+        'payslips': [{'employee_id': w['employee_id'], 'payslip_url': f"/api/uploads/{w['path']}"} for w in written],
+    }
+
 # --- Other Read-only APIs ---
 @app.route("/api/payrolls", methods=['GET'])
 @jwt_required()
 def get_payrolls():
     payrolls = Payroll.query.options(db.joinedload(Payroll.employee)).order_by(Payroll.year.desc(), Payroll.month.desc()).all()
     return jsonify({"payrolls": [p.to_dict() for p in payrolls]})
+
+@app.route("/api/payrolls/run", methods=['POST'])
+@jwt_required()
+def run_payroll_endpoint():
+    claims = get_jwt()
+    if claims.get('role') not in ['Admin', 'HR']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+
+    data = request.get_json() or {}
+    try:
+        month, year = int(data['month']), int(data['year'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"message": "يجب تحديد الشهر والسنة"}), 400
+    if not 1 <= month <= 12:
+        return jsonify({"message": "شهر غير صالح"}), 400
+
+    if ShiftAllowance.query.first():
+        accrue_shift_allowances(month, year)
+    summary = run_payroll(month, year)
+    log_action("تشغيل الرواتب", f"تم احتساب رواتب {summary['generated']} موظف عن {month}/{year}.",
+               username=claims.get('username'), user_id=int(get_jwt_identity()))
+    return jsonify(summary), 201
+
+@app.route("/api/payrolls/payslips", methods=['POST'])
+@jwt_required()
+def render_payslips_endpoint():
+    claims = get_jwt()
+    if claims.get('role') not in ['Admin', 'HR']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+
+    data = request.get_json() or {}
+    try:
+        month, year = int(data['month']), int(data['year'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"message": "يجب تحديد الشهر والسنة"}), 400
+    if not 1 <= month <= 12:
+        return jsonify({"message": "شهر غير صالح"}), 400
+
+    result = render_payslips(month, year, data.get('employee_ids'), archive=data.get('format') == 'archive')
+    if not result['rendered']:
+        return jsonify({"message": "لا توجد رواتب محتسبة لهذه الفترة"}), 404
+    log_action("إصدار قسائم الرواتب", f"تم إصدار {result['rendered']} قسيمة راتب عن {month}/{year}.",
+               username=claims.get('username'), user_id=int(get_jwt_identity()))
+    return jsonify(result), 201
+
+@app.route("/api/shift-allowances", methods=['GET', 'POST'])
+@jwt_required()
+def handle_shift_allowances():
+    if request.method == 'POST':
+        if get_jwt().get('role') not in ['Admin', 'HR']:
+            return jsonify({"message": "صلاحيات غير كافية"}), 403
+        data = request.get_json() or {}
+        if not db.session.get(Shift, data.get('shift_id') or 0) or data.get('apply_when', 'worked') not in ['scheduled', 'worked']:
+            return jsonify({"message": "بيانات غير صالحة"}), 400
+        allowance = ShiftAllowance(shift_id=data['shift_id'], allowance_amount=float(data.get('allowance_amount') or 0),
+                                   apply_when=data.get('apply_when', 'worked'))
+        db.session.add(allowance)
+        db.session.commit()
+        return jsonify(allowance.to_dict()), 201
+
+    return jsonify({"shift_allowances": [a.to_dict() for a in ShiftAllowance.query.all()]})
+
+@app.route("/api/shift-allowances/<int:id>", methods=['DELETE'])
+@jwt_required()
+def delete_shift_allowance(id):
+    if get_jwt().get('role') not in ['Admin', 'HR']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    db.session.delete(ShiftAllowance.query.get_or_404(id))
+    db.session.commit()
+    return jsonify({"message": "تم حذف البدل بنجاح"})
+
+@app.route("/api/shift-allowances/accrue", methods=['POST'])
+@jwt_required()
+def accrue_shift_allowances_endpoint():
+    claims = get_jwt()
+    if claims.get('role') not in ['Admin', 'HR']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    data = request.get_json() or {}
+    try:
+        month, year = int(data['month']), int(data['year'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"message": "يجب تحديد الشهر والسنة"}), 400
+    if not 1 <= month <= 12:
+        return jsonify({"message": "شهر غير صالح"}), 400
+    result = accrue_shift_allowances(month, year)
+    log_action("احتساب بدل المناوبات", f"تم احتساب بدل المناوبات لـ {result['employees']} موظف عن {month}/{year}.",
+               username=claims.get('username'), user_id=int(get_jwt_identity()))
+    return jsonify(result)
+
+@app.route("/api/shift-allowances/accruals", methods=['GET'])
+@jwt_required()
+def get_shift_allowance_accruals():
+    month, year = request.args.get('month', type=int), request.args.get('year', type=int)
+    if not month or not year:
+        return jsonify({"message": "يجب تحديد الشهر والسنة"}), 400
+    rows = db.session.query(ShiftAllowanceAccrual, Employee.full_name, Shift.name).join(
+        Employee, ShiftAllowanceAccrual.employee_id == Employee.id).join(Shift, ShiftAllowanceAccrual.shift_id == Shift.id).filter(
+        ShiftAllowanceAccrual.year == year, ShiftAllowanceAccrual.month == month).order_by(ShiftAllowanceAccrual.employee_id).all()
+    return jsonify({"accruals": [{
+        'employee_id': a.employee_id, 'employee_name': name, 'shift_id': a.shift_id, 'shift_name': shift_name,
+        'shift_count': a.shift_count, 'amount': a.amount
+    } for a, name, shift_name in rows]})
+
+@app.route("/api/payrolls/stale", methods=['GET'])
+@jwt_required()
+def get_stale_payrolls():
+    claims = get_jwt()
+    if claims.get('role') not in ['Admin', 'HR']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    rows = db.session.query(PayrollStaleMark, Employee.full_name).join(Employee, PayrollStaleMark.employee_id == Employee.id).order_by(
+        PayrollStaleMark.year, PayrollStaleMark.month, PayrollStaleMark.employee_id).all()
+    return jsonify({"stale": [{
+        'employee_id': mark.employee_id,
+        'employee_name': full_name,
+        'month': mark.month,
+        'year': mark.year,
+        'reason': mark.reason,
+        'marked_at': mark.marked_at.isoformat() if mark.marked_at else None
+    } for mark, full_name in rows]})
+
+@app.route("/api/payrolls/recalculate", methods=['POST'])
+@jwt_required()
+def recalculate_payrolls_endpoint():
+    claims = get_jwt()
+    if claims.get('role') not in ['Admin', 'HR']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    data = request.get_json(silent=True) or {}
+    try:
+        month = int(data['month']) if data.get('month') else None
+        year = int(data['year']) if data.get('year') else None
+    except (TypeError, ValueError):
+        return jsonify({"message": "بيانات غير صالحة"}), 400
+    if (month is None) != (year is None):
+        return jsonify({"message": "يجب تحديد الشهر والسنة معًا"}), 400
+
+    report = recalculate_stale_payrolls(month, year)
+    if report['recalculated']:
+        log_action("إعادة احتساب الرواتب", f"أعيد احتساب {report['recalculated']} راتب، تغير منها {report['changed']}.",
+                   username=claims.get('username'), user_id=int(get_jwt_identity()))
+    return jsonify(report)
+
+@app.route("/api/payrolls/runs", methods=['GET', 'POST'])
+@jwt_required()
+def handle_payroll_runs():
+    claims = get_jwt()
+    if claims.get('role') not in ['Admin', 'HR']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        try:
+            month, year = int(data['month']), int(data['year'])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"message": "يجب تحديد الشهر والسنة"}), 400
+        partition_by = data.get('partition_by', 'location')
+        if not 1 <= month <= 12 or partition_by not in ['location', 'department']:
+            return jsonify({"message": "بيانات غير صالحة"}), 400
+
+        if ShiftAllowance.query.first():
+            accrue_shift_allowances(month, year)
+        run = create_payroll_run(month, year, partition_by, int(get_jwt_identity()))
+        run_batch_job(execute_payroll_run, run.id)
+        log_action("تشغيل الرواتب", f"بدء تشغيل رواتب {month}/{year} على {run.total_partitions} جزء.",
+                   username=claims.get('username'), user_id=int(get_jwt_identity()))
+        return jsonify(run.to_dict()), 202
+
+    runs = PayrollRun.query.order_by(PayrollRun.created_at.desc()).limit(50).all()
+    return jsonify({"runs": [r.to_dict() for r in runs]})
+
+@app.route("/api/payrolls/runs/<int:id>", methods=['GET'])
+@jwt_required()
+def get_payroll_run(id):
+    run = PayrollRun.query.get_or_404(id)
+    return jsonify(run.to_dict(include_partitions=True))
+
+@app.route("/api/payrolls/runs/<int:id>/resume", methods=['POST'])
+@jwt_required()
+def resume_payroll_run(id):
+    claims = get_jwt()
+    if claims.get('role') not in ['Admin', 'HR']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    run = PayrollRun.query.get_or_404(id)
+    if run.status == 'Completed':
+        return jsonify({"message": "تم إكمال هذا التشغيل بالفعل"}), 409
+    if id in _active_payroll_runs:
+        return jsonify({"message": "التشغيل قيد التنفيذ حاليًا"}), 409
+    run_batch_job(execute_payroll_run, run.id)
+    return jsonify(run.to_dict()), 202
     
 @app.route("/api/performance", methods=['GET'])
 @jwt_required()
@@ -1616,6 +3840,8 @@ def get_audit_logs():
     return jsonify({"auditLogs": [log.to_dict() for log in logs]})
 
 # --- Attendance APIs ---
+WEEKDAY_MAP = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'] # as stored in weekly_off_days
+
 @app.route('/api/shifts', methods=['GET', 'POST'])
 @jwt_required()
 def handle_shifts():
@@ -1749,8 +3975,6 @@ def get_employee_attendance_history(employee_id):
     ).options(db.joinedload(EmployeeWorkSchedule.schedule)).order_by(EmployeeWorkSchedule.effective_from.desc()).all()
 
     full_history = []
-    
-    WEEKDAY_MAP = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
 
     for day in reversed(date_range):
         day_str = day.isoformat()
@@ -1798,6 +4022,41 @@ def get_employee_attendance_history(employee_id):
     })
 
 
+def compute_attendance_kpis(day_str=None):
+    """Today's attendance KPIs as shown on the daily log, computed with aggregate queries."""
+    day_str = day_str or date.today().isoformat()
+    active_ids = {eid for (eid,) in db.session.query(Employee.id).filter(Employee.status == 'Active')}
+    present_ids = {eid for (eid,) in db.session.query(Attendance.employee_id).filter(Attendance.date == day_str).distinct()}
+    on_leave_ids = {eid for (eid,) in db.session.query(LeaveRequest.employee_id).filter(
+        LeaveRequest.start_date <= day_str,
+        LeaveRequest.end_date >= day_str,
+        LeaveRequest.status.in_(['Approved', 'HRApproved'])
+    )}
+    return {
+        'present': len(present_ids),
+        'late': Attendance.query.filter(Attendance.date == day_str, Attendance.status == 'Late').count(),
+        'absent': len(active_ids - present_ids - on_leave_ids),
+        'offline_devices': ZktDevice.query.filter(ZktDevice.status != 'online').count()
+    }
+
+_last_attendance_kpis = {}
+_attendance_kpis_lock = threading.Lock()
+
+def publish_attendance_kpis():
+    """Pushes the KPIs that changed since the last publish to the attendance channel."""
+    today_str = date.today().isoformat()
+    # Publishes run on background threads; serialising them keeps each delta sent exactly once
+    with _attendance_kpis_lock:
+        kpis = compute_attendance_kpis(today_str)
+        if _last_attendance_kpis.get('date') != today_str:
+            _last_attendance_kpis.clear()
+            _last_attendance_kpis['date'] = today_str
+        changed = {key: value for key, value in kpis.items() if _last_attendance_kpis.get(key) != value}
+        if changed:
+            _last_attendance_kpis.update(kpis)
+            event_broker.publish(ATTENDANCE_CHANNEL, 'attendance_kpis', {'date': today_str, 'kpis': kpis, 'changed': changed})
+
+
 @app.route("/api/attendance/daily-log", methods=['GET'])
 @jwt_required()
 def get_daily_log():
@@ -1959,6 +4218,19 @@ def sync_all_devices():
             if not attendance_logs:
                 continue
 
+            # Raw punches are kept for roster reconciliation (night shifts span two dates)
+            punch_rows = []
+            for log in attendance_logs:
+                try:
+                    punch_rows.append({'device_id': device.id, 'employee_id': int(log.user_id), 'log_datetime': log.timestamp,
+                                       'log_type': 'punch', 'source': 'device'})
+                except (ValueError, TypeError):
+                    continue
+            punch_insert = sqlite_insert(DeviceLog.__table__).on_conflict_do_nothing()
+            for batch in chunked(punch_rows, 5000):
+                db.session.execute(punch_insert, batch)
+            db.session.commit()
+
             daily_punches = defaultdict(list)
             for log in attendance_logs:
                 daily_punches[(log.user_id, log.timestamp.date())].append(log.timestamp.time())
@@ -1998,6 +4270,9 @@ def sync_all_devices():
             if conn:
                 conn.disconnect()
 
+    run_in_background(publish_attendance_kpis)
+    yesterday = date.today() - timedelta(days=1)
+    run_batch_job(reconcile_attendance, yesterday, date.today())
     final_message = f"تمت إضافة {total_new_logs} سجلات حضور جديدة."
     
     if not errors and total_new_logs == 0:
@@ -2009,20 +4284,194 @@ def sync_all_devices():
     return jsonify({"message": f"تمت المزامنة بنجاح. {final_message}", "errors": []})
 
 
-# --- Notifications API ---
-@app.route('/api/notifications', methods=['GET'])
-@jwt_required()
-def get_notifications():
+# --- Attendance Reconciliation ---
+# Punches are matched to the employee's published roster slot for each day,
+# using the shift's real window (night shifts end the next day; split shifts
+# span from the first period's start to the last one's end). Per run, all
+# slots, punches and leaves for the range are loaded in bulk and the open
+# exceptions for the range are replaced; resolved ones are kept.
+RECONCILE_TOLERANCE_MINUTES = 120 # how far outside the shift window a punch still counts for it
+RECONCILE_SLOT_STATUSES = ('Published', 'Changed')
+
+def _load_punches(start, end):
+    """employee_id -> sorted punch datetimes between start and end (both datetimes)."""
+    punches = defaultdict(set)
+    for employee_id, logged_at in db.session.query(DeviceLog.employee_id, DeviceLog.log_datetime).filter(
+            DeviceLog.log_datetime.between(start, end), DeviceLog.employee_id.isnot(None)):
+        punches[employee_id].add(logged_at.replace(microsecond=0))
+    # Manually entered or imported attendance has no raw punches
+    for employee_id, day_str, check_in, check_out in db.session.query(
+            Attendance.employee_id, Attendance.date, Attendance.check_in, Attendance.check_out).filter(
+            Attendance.date.between(start.date().isoformat(), end.date().isoformat()), Attendance.check_in.isnot(None)):
+        day = _parse_iso_date(day_str)
+        try:
+            first = datetime.combine(day, time.fromisoformat(check_in))
+            punches[employee_id].add(first)
+            if check_out:
+                last = datetime.combine(day, time.fromisoformat(check_out))
+                punches[employee_id].add(last if last >= first else last + timedelta(days=1))
+        except (TypeError, ValueError):
+            continue
+    return {eid: sorted(times) for eid, times in punches.items()}
+
+def reconcile_attendance(date_from, date_to, employee_ids=None):
+    """Writes roster exceptions for [date_from, date_to] and returns counts per type."""
+    day_strs = [(date_from + timedelta(days=n)).isoformat() for n in range((date_to - date_from).days + 1)]
+    from_str, to_str = day_strs[0], day_strs[-1]
+    tolerance = timedelta(minutes=RECONCILE_TOLERANCE_MINUTES)
+    now = datetime.now()
+
+    windows = {s.id: shift_window(s) for s in Shift.query.all()}
+    slot_query = db.session.query(RosterSlot.id, RosterSlot.employee_id, RosterSlot.date, RosterSlot.shift_id).filter(
+        RosterSlot.date.between(from_str, to_str), RosterSlot.status.in_(RECONCILE_SLOT_STATUSES))
+    if employee_ids:
+        slot_query = slot_query.filter(RosterSlot.employee_id.in_(employee_ids))
+    slots = defaultdict(list) # employee_id -> [(slot_id, date, shift_id, window start, window end)]
+    for slot_id, employee_id, day_str, shift_id in slot_query:
+        if shift_id not in windows:
+            continue
+        midnight = datetime.combine(_parse_iso_date(day_str), time())
+        start, end = windows[shift_id]
+        slots[employee_id].append((slot_id, day_str, shift_id, midnight + timedelta(minutes=start), midnight + timedelta(minutes=end)))
+
+    # Punches up to a day either side, so night shifts at the range edges are matched correctly
+    range_start = datetime.combine(date_from - timedelta(days=1), time())
+    range_end = datetime.combine(date_to + timedelta(days=2), time())
+    # Employees without any published slot in the range are not rostered; their days follow work schedules
+    punches = {eid: p for eid, p in _load_punches(range_start, range_end).items() if eid in slots}
+
+    on_leave = defaultdict(set)
+    for employee_id, leave_start, leave_end in db.session.query(LeaveRequest.employee_id, LeaveRequest.start_date, LeaveRequest.end_date).filter(
+            LeaveRequest.status.in_(APPROVED_LEAVE_STATUSES), LeaveRequest.start_date <= to_str, LeaveRequest.end_date >= from_str):
+        on_leave[employee_id].update(d for d in day_strs if leave_start <= d <= leave_end)
+
+    exceptions = []
+    for employee_id in slots:
+        employee_punches = punches.get(employee_id, [])
+        slot_punches = {slot[0]: [p for p in employee_punches if slot[3] - tolerance <= p <= slot[4] + tolerance]
+                        for slot in slots[employee_id]}
+        matched = {p for in_window in slot_punches.values() for p in in_window}
+        for slot_id, day_str, shift_id, start, end in slots[employee_id]:
+            if slot_punches[slot_id] or day_str in on_leave[employee_id] or end + tolerance > now:
+                continue
+            # Punches that day which belong to no rostered shift mean the employee worked other hours
+            same_day = [p for p in employee_punches if p.date().isoformat() == day_str and p not in matched]
+            exceptions.append({
+                'employee_id': employee_id, 'date': day_str, 'slot_id': slot_id, 'shift_id': shift_id,
+                'type': 'wrong_shift' if same_day else 'no_show',
+                'details': json.dumps({'expected': [start.isoformat(), end.isoformat()],
+                                       'punches': [p.isoformat() for p in same_day]}),
+            })
+        # Punches that belong to no rostered shift, grouped by calendar day
+        rostered_days = {day_str for _, day_str, _, _, _ in slots[employee_id]}
+        stray = defaultdict(list)
+        for p in employee_punches:
+            day_str = p.date().isoformat()
+            if p not in matched and from_str <= day_str <= to_str and day_str not in rostered_days:
+                stray[day_str].append(p.isoformat())
+        for day_str, day_punches in stray.items():
+            exceptions.append({'employee_id': employee_id, 'date': day_str, 'slot_id': None, 'shift_id': None,
+                               'type': 'unrostered_punch', 'details': json.dumps({'punches': day_punches})})
+
+    delete_query = AttendanceException.query.filter(AttendanceException.date.between(from_str, to_str), AttendanceException.status == 'Open')
+    if employee_ids:
+        delete_query = delete_query.filter(AttendanceException.employee_id.in_(employee_ids))
+    delete_query.delete(synchronize_session=False)
+    created_at = datetime.utcnow()
+    insert = sqlite_insert(AttendanceException.__table__).on_conflict_do_nothing() # keeps reviewed exceptions
+    for batch in chunked(exceptions, 5000):
+        db.session.execute(insert, [{**e, 'status': 'Open', 'created_at': created_at} for e in batch])
+    db.session.commit()
+
+    counts = defaultdict(int)
+    for e in exceptions:
+        counts[e['type']] += 1
+    return {'date_from': from_str, 'date_to': to_str, 'exceptions': dict(counts), 'total': len(exceptions)}
+
+@app.route('/api/attendance/reconcile', methods=['POST'])
+@jwt_required()
+def reconcile_attendance_endpoint():
+    claims = get_jwt()
+    if claims.get('role') not in ['Admin', 'HR', 'Manager']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    data = request.get_json(silent=True) or {}
+    if data.get('period_id'):
+        period = RosterPeriod.query.get_or_404(data['period_id'])
+        date_from, date_to = _parse_iso_date(period.start_date), _parse_iso_date(period.end_date)
+    else:
+        date_from = _parse_iso_date(data.get('date_from') or data.get('date') or (date.today() - timedelta(days=1)).isoformat())
+        date_to = _parse_iso_date(data.get('date_to') or data.get('date')) or date_from
+    if not date_from or not date_to or date_to < date_from:
+        return jsonify({"message": "نطاق التاريخ غير صالح"}), 400
+
+    result = reconcile_attendance(date_from, min(date_to, date.today()), data.get('employee_ids'))
+    log_action("مطابقة الحضور", f"مطابقة الحضور مع الجدول من {result['date_from']} إلى {result['date_to']}: {result['total']} استثناء.",
+               username=claims.get('username'), user_id=int(get_jwt_identity()))
+    return jsonify(result)
+
+@app.route('/api/attendance/exceptions', methods=['GET'])
+@jwt_required()
+def get_attendance_exceptions():
+    query = AttendanceException.query.options(db.joinedload(AttendanceException.employee))
+    status = request.args.get('status', 'Open')
+    if status != 'all':
+        query = query.filter(AttendanceException.status == status)
+    if request.args.get('type'):
+        query = query.filter(AttendanceException.type == request.args['type'])
+    if request.args.get('employee_id'):
+        query = query.filter(AttendanceException.employee_id == request.args.get('employee_id', type=int))
+    if request.args.get('date_from'):
+        query = query.filter(AttendanceException.date >= request.args['date_from'])
+    if request.args.get('date_to'):
+        query = query.filter(AttendanceException.date <= request.args['date_to'])
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 50, type=int), 500)
+    paginated = query.order_by(AttendanceException.date.desc(), AttendanceException.employee_id).paginate(page=page, per_page=per_page, error_out=False)
+    return jsonify({"exceptions": [e.to_dict() for e in paginated.items], "total": paginated.total, "page": page})
+
+@app.route('/api/attendance/exceptions/<int:id>', methods=['PATCH'])
+@jwt_required()
+def update_attendance_exception(id):
+    if get_jwt().get('role') not in ['Admin', 'HR', 'Manager']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    exception = AttendanceException.query.get_or_404(id)
+    data = request.get_json() or {}
+    if data.get('status') not in ['Open', 'Resolved', 'Dismissed']:
+        return jsonify({"message": "حالة غير صالحة"}), 400
+    exception.status = data['status']
+    exception.resolution_note = data.get('note', exception.resolution_note)
+    exception.resolved_by = int(get_jwt_identity()) if data['status'] != 'Open' else None
+    exception.resolved_at = datetime.utcnow() if data['status'] != 'Open' else None
+    db.session.commit()
+    return jsonify(exception.to_dict())
+
+# --- Notifications API ---
+@app.route('/api/notifications', methods=['GET'])
+@jwt_required()
+def get_notifications():
     user_id = get_jwt_identity()
     if not user_id:
         return jsonify({"message": "Invalid token"}), 422
     
     notifications = InAppNotification.query.filter_by(recipient_user_id=int(user_id)).order_by(InAppNotification.created_at.desc()).all()
-    unread_count = InAppNotification.query.filter_by(recipient_user_id=int(user_id), status='Unread').count()
 
     return jsonify({
         'notifications': [n.to_dict() for n in notifications],
-        'unread_count': unread_count
+        'unread_count': get_unread_count(int(user_id))
+    })
+
+@app.route('/api/notifications/summary', methods=['GET'])
+@jwt_required()
+def get_notifications_summary():
+    """Unread count plus the latest N notifications, for the header dropdown."""
+    user_id = int(get_jwt_identity())
+    limit = min(request.args.get('limit', 10, type=int), 50)
+
+    latest = InAppNotification.query.filter_by(recipient_user_id=user_id).order_by(InAppNotification.created_at.desc()).limit(limit).all()
+
+    return jsonify({
+        'notifications': [n.to_dict() for n in latest],
+        'unread_count': get_unread_count(user_id)
     })
 
 @app.route('/api/notifications/<int:id>/read', methods=['PATCH'])
@@ -2031,8 +4480,12 @@ def mark_notification_as_read(id):
     user_id = get_jwt_identity()
     
     notification = InAppNotification.query.filter_by(id=id, recipient_user_id=int(user_id)).first_or_404()
-    notification.status = 'Read'
-    db.session.commit()
+    if notification.status == 'Unread':
+        notification.status = 'Read'
+        adjust_unread_counters({int(user_id): -1})
+        db.session.commit()
+        invalidate_unread_cache([int(user_id)])
+        publish_unread_count(int(user_id))
     
     return jsonify({'message': 'Notification marked as read.'})
 
@@ -2041,11 +4494,54 @@ def mark_notification_as_read(id):
 def mark_all_notifications_as_read():
     user_id = get_jwt_identity()
     
-    InAppNotification.query.filter_by(recipient_user_id=int(user_id), status='Unread').update({'status': 'Read'})
+    # Always checks the table rather than the cached count, so stray Unread rows can be cleared
+    updated = InAppNotification.query.filter_by(recipient_user_id=int(user_id), status='Unread').update({'status': 'Read'})
+    NotificationCounter.query.filter_by(user_id=int(user_id)).update({'unread_count': 0})
     db.session.commit()
+    invalidate_unread_cache([int(user_id)])
+    if updated:
+        publish_unread_count(int(user_id))
     
     return jsonify({'message': 'All notifications marked as read.'})
 
+def _format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/stream', methods=['GET'])
+@signed_url_or_jwt
+def event_stream():
+    """Server-sent events: new notifications, unread-count changes and, for Admin/HR/Manager,
+    attendance KPI deltas.
+
+    EventSource cannot send headers, so clients connect through a signed URL and fetch a new
+    one when they reconnect; the signature is only checked when the stream opens.
+    """
+    user_id = int(g.url_claims['sub'])
+    channels = [user_channel(user_id)]
+    if g.url_claims['role'] in ['Admin', 'HR', 'Manager']:
+        channels.append(ATTENDANCE_CHANNEL)
+    subscription = event_broker.subscribe(*channels)
+    unread_count = get_unread_count(user_id)
+
+    def generate():
+        try:
+            yield "retry: 5000\n\n"
+            yield _format_sse('unread_count', {'unread_count': unread_count})
+            while True:
+                try:
+                    event, data = subscription.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _format_sse(event, data)
+        finally:
+            event_broker.unsubscribe(subscription, *channels)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 # --- Disciplinary API ---
 @app.route('/api/disciplinary/actions', methods=['GET', 'POST'])
 @jwt_required()
@@ -2136,18 +4632,80 @@ def handle_tax_scheme(id):
             if hasattr(scheme, key) and key != 'id':
                 setattr(scheme, key, value)
         
-        # Simple deletion and re-creation of brackets for simplicity
-        TaxBracket.query.filter_by(scheme_id=scheme.id).delete()
-        for bracket_data in brackets_data:
+        # Update brackets in place by position; only extra or missing rows are inserted/deleted
+        existing = TaxBracket.query.filter_by(scheme_id=scheme.id).order_by(TaxBracket.min_amount, TaxBracket.id).all()
+        incoming = sorted(brackets_data, key=lambda b: float(b.get('min_amount') or 0))
+        for bracket, bracket_data in zip(existing, incoming):
+            for key in ('min_amount', 'max_amount', 'rate'):
+                if key in bracket_data and getattr(bracket, key) != bracket_data[key]:
+                    setattr(bracket, key, bracket_data[key])
+        for bracket in existing[len(incoming):]:
+            db.session.delete(bracket)
+        for bracket_data in incoming[len(existing):]:
             bracket_data.pop('id', None)
-            new_bracket = TaxBracket(scheme_id=scheme.id, **bracket_data)
-            db.session.add(new_bracket)
+            db.session.add(TaxBracket(scheme_id=scheme.id, **bracket_data))
             
         db.session.commit()
         log_action("تحديث مخطط ضريبي", f"تم تحديث المخطط الضريبي: {scheme.name}.")
         return jsonify(scheme.to_dict(include_brackets=True))
 
 
+@app.route('/api/tax-schemes/<int:id>/simulate', methods=['POST'])
+@jwt_required()
+def simulate_tax_scheme(id):
+    """What-if tax over the whole active workforce.
+
+    Body (all optional): brackets and method to try instead of the stored
+    ones, and salary_increase_percent applied to base salary + allowances.
+    The result is compared with the stored scheme.
+    """
+    if get_jwt().get('role') not in ['Admin', 'HR']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    scheme = TaxScheme.query.get_or_404(id)
+    data = request.get_json(silent=True) or {}
+
+    current = get_compiled_tax_scheme(scheme.id)
+    candidate = current
+    if 'brackets' in data or 'method' in data:
+        try:
+            brackets = [(float(b['min_amount']), float(b['max_amount']) if b.get('max_amount') not in (None, '') else None, float(b['rate']))
+                        for b in data.get('brackets', [])] or list(zip(current.thresholds, current.caps, [r * 100 for r in current.rates]))
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"message": "شرائح ضريبية غير صالحة"}), 400
+        candidate = CompiledTaxScheme(None, data.get('method', scheme.method), brackets)
+
+    try:
+        increase = float(data.get('salary_increase_percent') or 0)
+    except (TypeError, ValueError):
+        increase = None
+    if increase is None or not math.isfinite(increase) or increase <= -100:
+        return jsonify({"message": "نسبة زيادة الراتب غير صالحة"}), 400
+    factor = 1 + increase / 100
+    employees = db.session.query(Employee.id, Employee.base_salary, Employee.allowances).filter(Employee.status == 'Active').all()
+    annual_income = [((e.base_salary or 0) + (e.allowances or 0)) * factor * 12 for e in employees]
+
+    current_tax = current.tax_many(annual_income)
+    candidate_tax = candidate.tax_many(annual_income)
+    by_bracket = defaultdict(int)
+    for amount in annual_income:
+        by_bracket[candidate.bracket_index(amount)] += 1
+
+    total_income = sum(annual_income)
+    total_current, total_candidate = sum(current_tax), sum(candidate_tax)
+    return jsonify({
+        'employees': len(employees),
+        'annual_income': round(total_income, 2),
+        'current': {'annual_tax': round(total_current, 2), 'effective_rate': round(total_current / total_income * 100, 2) if total_income else 0},
+        'simulated': {'annual_tax': round(total_candidate, 2), 'effective_rate': round(total_candidate / total_income * 100, 2) if total_income else 0},
+        'difference': round(total_candidate - total_current, 2),
+        'employees_by_bracket': [
+            {'min_amount': candidate.thresholds[i], 'max_amount': candidate.caps[i], 'rate': round(candidate.rates[i] * 100, 4), 'employees': by_bracket.get(i, 0)}
+            for i in range(len(candidate.thresholds))
+        ],
+        'untaxed_employees': by_bracket.get(-1, 0),
+    })
+
+
 # --- Documents API ---
 @app.route('/api/documents/types', methods=['GET', 'POST'])
 @jwt_required()
@@ -2188,6 +4746,7 @@ def get_employee_checklist(employee_id):
     employee_docs = EmployeeDocument.query.filter_by(employee_id=employee_id).all()
     
     docs_map = {doc.doc_type_id: doc for doc in employee_docs}
+    today_iso, warn_until = _expiry_window(date.today())
     
     checklist = []
     for dt in doc_types:
@@ -2198,6 +4757,7 @@ def get_employee_checklist(employee_id):
             'mime_type': None,
             'expiry_date': None,
             'note': None,
+            'thumbnail_url': None,
             'status': 'Missing'
         }
         if dt.id in docs_map:
@@ -2208,13 +4768,408 @@ def get_employee_checklist(employee_id):
                 'mime_type': doc.mime_type,
                 'expiry_date': doc.expiry_date,
                 'note': doc.note,
+                'thumbnail_url': sign_url(f"/api/documents/thumbnails/{doc.blob_hash}") if doc.blob_hash and thumbnail_supported(doc.mime_type) else None,
                 'status': doc.status or 'Uploaded'
             })
+            # Reflect the dates even before the next scan has run
+            if item['status'] in ACTIVE_DOCUMENT_STATUSES and doc.expiry_date:
+                if doc.expiry_date < today_iso:
+                    item['status'] = 'Expired'
+                elif doc.expiry_date <= warn_until:
+                    item['status'] = 'Expiring'
         checklist.append(item)
         
     return jsonify({'checklist': checklist})
 
 
+# --- Blob Store ---
+# Uploaded files are kept once per content under uploads/blobs/ab/cd/<sha256>;
+# records store the hash plus the blob's relative path in their usual path
+# column, so existing links keep working. FileBlob.ref_count follows the
+# referencing columns through a flush listener. collect_garbage_blobs() removes
+# blobs nothing points at once they are older than a grace period, which
+# covers the gap between storing a blob and committing the record that uses it.
+BLOB_DIR = 'blobs'
+BLOB_IO_BLOCK_BYTES = 1024 * 1024
+BLOB_GC_GRACE_HOURS = 1
+BLOB_REFERENCES = ((EmployeeDocument, 'blob_hash'), (Applicant, 'cv_blob_hash'))
+
+def blob_relative_path(sha256):
+    return os.path.join(BLOB_DIR, sha256[:2], sha256[2:4], sha256)
+
+def _blob_full_path(sha256):
+    return os.path.join(app.config['UPLOAD_FOLDER'], blob_relative_path(sha256))
+
+def _register_blob(sha256, size, mime_type, source_path):
+    """Moves source_path into the store, or drops it if the content is already there."""
+    # Claim the row first: the write lock it takes keeps a concurrent garbage
+    # collection from deleting the file between the check below and our commit.
+    db.session.execute(
+        sqlite_insert(FileBlob).values(sha256=sha256, size=size, mime_type=mime_type, ref_count=0, stored_at=datetime.utcnow())
+        .on_conflict_do_update(index_elements=['sha256'], set_={'stored_at': datetime.utcnow()})
+    )
+    full_path = _blob_full_path(sha256)
+    if os.path.exists(full_path):
+        os.remove(source_path)
+    else:
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        os.replace(source_path, full_path)
+        if thumbnail_supported(mime_type):
+            run_batch_job(generate_thumbnail, sha256, mime_type)
+    return sha256
+
+def store_blob_from_stream(stream, mime_type):
+    """Copies a stream into the store, hashing while it is written. Returns the hash."""
+    digest, size = hashlib.sha256(), 0
+    fd, temp_path = tempfile.mkstemp(dir=UPLOAD_PARTIAL_FOLDER, suffix='.blob')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            for block in iter(lambda: stream.read(BLOB_IO_BLOCK_BYTES), b''):
+                digest.update(block)
+                temp_file.write(block)
+                size += len(block)
+        return _register_blob(digest.hexdigest(), size, mime_type, temp_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def store_blob_from_file(path, mime_type):
+    """Moves a file that is already on disk (e.g. a finished chunked upload) into the store."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOB_IO_BLOCK_BYTES), b''):
+            digest.update(block)
+    return _register_blob(digest.hexdigest(), os.path.getsize(path), mime_type, path)
+
+@on_flush(*(model for model, _ in BLOB_REFERENCES))
+def _count_blob_references(session, changes):
+    deltas = defaultdict(int)
+    for obj, kind in changes:
+        attr = 'blob_hash' if isinstance(obj, EmployeeDocument) else 'cv_blob_hash'
+        before = previous_value(obj, attr) if kind != 'new' else None
+        after = getattr(obj, attr) if kind != 'deleted' else None
+        if before != after:
+            if before:
+                deltas[before] -= 1
+            if after:
+                deltas[after] += 1
+    params = [{'sha256': sha256, 'delta': delta} for sha256, delta in deltas.items() if delta]
+    if params:
+        session.connection().execute(text("UPDATE file_blobs SET ref_count = ref_count + :delta WHERE sha256 = :sha256"), params)
+
+def collect_garbage_blobs(grace_hours=BLOB_GC_GRACE_HOURS):
+    """Deletes blobs that nothing references. Returns (blobs removed, bytes freed)."""
+    # Recount from the referencing columns so rows removed outside the ORM are accounted for
+    counts = ' + '.join(
+        f"(SELECT COUNT(*) FROM {model.__tablename__} r WHERE r.{column} = file_blobs.sha256)"
+        for model, column in BLOB_REFERENCES
+    )
+    db.session.execute(text(f"UPDATE file_blobs SET ref_count = {counts}"))
+    cutoff = datetime.utcnow() - timedelta(hours=grace_hours)
+    removed = db.session.execute(
+        db.delete(FileBlob).where(FileBlob.ref_count == 0, FileBlob.stored_at < cutoff).returning(FileBlob.sha256, FileBlob.size)
+    ).all()
+    # Files go while the delete still holds the write lock, so a concurrent upload of the same content waits and rewrites it
+    for sha256, _ in removed:
+        for path in (_blob_full_path(sha256), _thumbnail_path(sha256)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    db.session.commit()
+
+    # Files whose storing transaction never committed have no row at all
+    known = {sha256 for (sha256,) in db.session.query(FileBlob.sha256)}
+    orphans, freed = 0, sum(size for _, size in removed)
+    for root, _, files in os.walk(os.path.join(app.config['UPLOAD_FOLDER'], BLOB_DIR)):
+        for name in files:
+            path = os.path.join(root, name)
+            # Thumbnails and temporary files are named after their blob: <sha256>.<suffix>
+            if name.split('.')[0] not in known and datetime.utcfromtimestamp(os.path.getmtime(path)) < cutoff:
+                freed += os.path.getsize(path)
+                os.remove(path)
+                orphans += 1
+    return len(removed) + orphans, freed
+
+@app.route('/api/documents/blobs/gc', methods=['POST'])
+@jwt_required()
+def run_blob_garbage_collection():
+    if get_jwt().get('role') != 'Admin':
+        return jsonify({'message': 'Forbidden'}), 403
+    removed, freed = collect_garbage_blobs()
+    log_action("تنظيف الملفات", f"تم حذف {removed} ملف غير مستخدم ({freed} بايت)", username=get_jwt().get('username'))
+    return jsonify({'removed': removed, 'bytes_freed': freed})
+
+@app.route('/api/documents/blobs/stats', methods=['GET'])
+@jwt_required()
+def get_blob_stats():
+    if get_jwt().get('role') not in ['Admin', 'HR']:
+        return jsonify({'message': 'Forbidden'}), 403
+    blobs, stored_bytes, bytes_saved = db.session.query(
+        func.count(FileBlob.sha256), func.coalesce(func.sum(FileBlob.size), 0),
+        func.coalesce(func.sum(FileBlob.size * func.max(FileBlob.ref_count - 1, 0)), 0)
+    ).one()
+    return jsonify({
+        'blobs': blobs,
+        'stored_bytes': stored_bytes,
+        'bytes_saved': bytes_saved,
+        'unreferenced': FileBlob.query.filter(FileBlob.ref_count == 0).count(),
+    })
+
+
+# --- Upload Limits & Resumable Uploads ---
+# Large files are sent as a session: POST /api/upload-sessions declares the
+# file, then PUTs with a Content-Range header append chunks. Each chunk is
+# streamed to a partial file in small blocks, so memory per upload stays
+# constant; size is checked as bytes arrive and the type is checked against
+# the file's leading bytes. After an interruption the client asks the session
+# for received_size and continues from there.
+UPLOAD_STREAM_BLOCK_BYTES = 64 * 1024
+UPLOAD_CHUNK_MAX_BYTES = 8 * 1024 * 1024
+UPLOAD_SESSION_TTL_HOURS = 24
+APPLICANT_CV_MAX_SIZE_MB = 10
+APPLICANT_CV_ALLOWED_MIME = 'application/pdf,application/msword,application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+MIME_SIGNATURES = [
+    (b'%PDF', 'application/pdf'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF8', 'image/gif'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\xd0\xcf\x11\xe0', 'application/x-ole-storage'),
+]
+ZIP_CONTAINER_MIMES = {
+    'application/zip',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+}
+OLE_CONTAINER_MIMES = {'application/msword', 'application/vnd.ms-excel', 'application/vnd.ms-powerpoint'}
+
+def sniff_mime(head):
+    for signature, mime in MIME_SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    return None
+
+def mime_allowed(declared, head, allowed_mime):
+    """Checks the declared type against the allowed list and against the file's leading bytes."""
+    allowed = {m.strip() for m in (allowed_mime or '').split(',') if m.strip()}
+    if allowed and declared not in allowed:
+        return False
+    detected = sniff_mime(head)
+    if detected == 'application/zip':
+        return declared in ZIP_CONTAINER_MIMES
+    if detected == 'application/x-ole-storage':
+        return declared in OLE_CONTAINER_MIMES
+    if detected is None:
+        # Types we can recognise must actually look like themselves
+        return declared not in {mime for _, mime in MIME_SIGNATURES} | ZIP_CONTAINER_MIMES | OLE_CONTAINER_MIMES
+    return detected == declared
+
+def upload_limits(purpose, doc_type=None):
+    """(max bytes, allowed mime list) for an upload."""
+    if purpose == 'employee_document':
+        return (doc_type.max_size_mb or 10) * 1024 * 1024, doc_type.allowed_mime
+    return APPLICANT_CV_MAX_SIZE_MB * 1024 * 1024, APPLICANT_CV_ALLOWED_MIME
+
+def check_uploaded_file(file, max_bytes, allowed_mime):
+    """Validates a multipart upload against size and type limits; returns an error message or None."""
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+    if size > max_bytes:
+        return f"حجم الملف يتجاوز الحد المسموح ({max_bytes // (1024 * 1024)} ميجابايت)"
+    head = file.stream.read(16)
+    file.stream.seek(0)
+    if not mime_allowed(file.mimetype, head, allowed_mime):
+        return "نوع الملف غير مسموح به"
+    return None
+
+def attach_employee_document(employee_id, doc_type_id, blob_hash, filename, mime_type, expiry_date=None, user_id=None):
+    # Check if a document of this type already exists for the employee
+    existing_doc = EmployeeDocument.query.filter_by(employee_id=employee_id, doc_type_id=doc_type_id).first()
+
+    if existing_doc:
+        # Update existing document
+        existing_doc.file_path = blob_relative_path(blob_hash)
+        existing_doc.blob_hash = blob_hash
+        existing_doc.file_name = filename
+        existing_doc.mime_type = mime_type
+        existing_doc.expiry_date = expiry_date or None
+        existing_doc.expiry_warned_on = None
+        existing_doc.status = 'Uploaded' # Reset status on new upload
+        existing_doc.uploaded_by = user_id
+        existing_doc.uploaded_at = datetime.utcnow()
+        return existing_doc
+
+    # Create new document record
+    new_doc = EmployeeDocument(
+        employee_id=employee_id,
+        doc_type_id=doc_type_id,
+        file_path=blob_relative_path(blob_hash),
+        blob_hash=blob_hash,
+        file_name=filename,
+        mime_type=mime_type,
+        expiry_date=expiry_date or None,
+        uploaded_by=user_id,
+        status='Uploaded'
+    )
+    db.session.add(new_doc)
+    return new_doc
+
+def _upload_partial_path(upload_id):
+    return os.path.join(UPLOAD_PARTIAL_FOLDER, f"{upload_id}.part")
+
+def purge_stale_upload_sessions():
+    cutoff = datetime.utcnow() - timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+    stale = UploadSession.query.filter(UploadSession.status == 'Uploading', UploadSession.updated_at < cutoff).all()
+    for upload in stale:
+        upload.status = 'Aborted'
+        if os.path.exists(_upload_partial_path(upload.id)):
+            os.remove(_upload_partial_path(upload.id))
+    if stale:
+        db.session.commit()
+
+def finalize_upload_session(upload, blob_hash=None):
+    """Moves a fully received upload into the blob store and links it to its record.
+
+    blob_hash is given when the content is already stored and nothing was transferred.
+    """
+    if blob_hash is None:
+        blob_hash = store_blob_from_file(_upload_partial_path(upload.id), upload.mime_type)
+    filename = secure_filename(upload.file_name) or upload.id
+    if upload.purpose == 'employee_document':
+        attach_employee_document(upload.employee_id, upload.doc_type_id, blob_hash, filename, upload.mime_type,
+                                 upload.expiry_date, upload.created_by)
+    else:
+        applicant = db.session.get(Applicant, upload.applicant_id)
+        applicant.cv_path = blob_relative_path(blob_hash)
+        applicant.cv_blob_hash = blob_hash
+        applicant.cv_file_name = filename
+    upload.status = 'Completed'
+    upload.result_path = blob_relative_path(blob_hash)
+    db.session.commit()
+
+@app.route('/api/upload-sessions', methods=['POST'])
+@jwt_required()
+def create_upload_session():
+    data = request.get_json() or {}
+    purpose = data.get('purpose', 'employee_document')
+    try:
+        total_size = int(data.get('total_size'))
+    except (TypeError, ValueError):
+        return jsonify({'message': 'يجب تحديد حجم الملف'}), 400
+    if not data.get('file_name') or not data.get('mime_type') or total_size <= 0:
+        return jsonify({'message': 'بيانات الملف غير مكتملة'}), 400
+
+    doc_type = None
+    if purpose == 'employee_document':
+        doc_type = DocumentType.query.get(data.get('doc_type_id'))
+        if not doc_type or not db.session.get(Employee, data.get('employee_id') or 0):
+            return jsonify({'message': 'Invalid document type'}), 400
+    elif purpose == 'applicant_cv':
+        if not db.session.get(Applicant, data.get('applicant_id') or 0):
+            return jsonify({'message': 'المتقدم غير موجود'}), 400
+    else:
+        return jsonify({'message': 'نوع الرفع غير معروف'}), 400
+
+    max_bytes, allowed_mime = upload_limits(purpose, doc_type)
+    if total_size > max_bytes:
+        return jsonify({'message': f"حجم الملف يتجاوز الحد المسموح ({max_bytes // (1024 * 1024)} ميجابايت)"}), 413
+    allowed = {m.strip() for m in (allowed_mime or '').split(',') if m.strip()}
+    if allowed and data['mime_type'] not in allowed:
+        return jsonify({'message': 'نوع الملف غير مسموح به'}), 415
+
+    purge_stale_upload_sessions()
+    upload = UploadSession(
+        id=secrets.token_hex(16), purpose=purpose, employee_id=data.get('employee_id'), doc_type_id=data.get('doc_type_id'),
+        applicant_id=data.get('applicant_id'), expiry_date=data.get('expiry_date') or None, file_name=data['file_name'],
+        mime_type=data['mime_type'], total_size=total_size, created_by=int(get_jwt_identity()))
+    db.session.add(upload)
+
+    # Content we already hold (the client sends its SHA-256) is linked without transferring it again
+    known_blob = db.session.get(FileBlob, str(data['sha256']).lower()) if data.get('sha256') else None
+    if known_blob and known_blob.size == total_size and os.path.exists(_blob_full_path(known_blob.sha256)):
+        with open(_blob_full_path(known_blob.sha256), 'rb') as f:
+            head = f.read(16)
+        if mime_allowed(upload.mime_type, head, allowed_mime):
+            upload.received_size = total_size
+            finalize_upload_session(upload, blob_hash=known_blob.sha256)
+            return jsonify({**upload.to_dict(), 'chunk_size': UPLOAD_CHUNK_MAX_BYTES}), 201
+
+    db.session.commit()
+    open(_upload_partial_path(upload.id), 'wb').close()
+    return jsonify({**upload.to_dict(), 'chunk_size': UPLOAD_CHUNK_MAX_BYTES}), 201
+
+@app.route('/api/upload-sessions/<session_id>', methods=['GET', 'PUT', 'DELETE'])
+@jwt_required()
+def handle_upload_session(session_id):
+    upload = UploadSession.query.get_or_404(session_id)
+    if upload.created_by != int(get_jwt_identity()) and get_jwt().get('role') != 'Admin':
+        return jsonify({'message': 'Forbidden'}), 403
+
+    if request.method == 'GET':
+        return jsonify(upload.to_dict())
+
+    if request.method == 'DELETE':
+        if upload.status == 'Uploading':
+            upload.status = 'Aborted'
+            if os.path.exists(_upload_partial_path(upload.id)):
+                os.remove(_upload_partial_path(upload.id))
+            db.session.commit()
+        return jsonify(upload.to_dict())
+
+    if upload.status != 'Uploading':
+        return jsonify({'message': 'جلسة الرفع غير نشطة', **upload.to_dict()}), 409
+    length = request.content_length
+    if length is None or length > UPLOAD_CHUNK_MAX_BYTES:
+        return jsonify({'message': 'حجم الجزء غير صالح'}), 413
+
+    content_range = re.match(r'bytes (\d+)-(\d+)/(\d+)$', request.headers.get('Content-Range', ''))
+    start = int(content_range.group(1)) if content_range else upload.received_size
+    if content_range and (int(content_range.group(3)) != upload.total_size or int(content_range.group(2)) - start + 1 != length):
+        return jsonify({'message': 'Content-Range غير متطابق'}), 400
+    if start != upload.received_size:
+        # The client is out of step (e.g. a retried chunk); tell it where to resume
+        return jsonify({'message': 'موضع الجزء غير متطابق', 'received_size': upload.received_size}), 409
+    if start + length > upload.total_size:
+        return jsonify({'message': 'البيانات تتجاوز حجم الملف المعلن'}), 413
+
+    max_bytes, allowed_mime = upload_limits(upload.purpose, db.session.get(DocumentType, upload.doc_type_id) if upload.doc_type_id else None)
+    written, rejected = 0, False
+    with open(_upload_partial_path(upload.id), 'r+b') as partial:
+        partial.seek(start)
+        partial.truncate()
+        while written < length:
+            block = request.stream.read(min(UPLOAD_STREAM_BLOCK_BYTES, length - written))
+            if not block:
+                break
+            if start == 0 and written == 0 and not mime_allowed(upload.mime_type, block[:16], allowed_mime):
+                rejected = True
+                break
+            if start + written + len(block) > min(upload.total_size, max_bytes):
+                partial.truncate(start + written)
+                return jsonify({'message': 'البيانات تتجاوز حجم الملف المعلن'}), 413
+            partial.write(block)
+            written += len(block)
+    if rejected:
+        upload.status = 'Aborted'
+        db.session.commit()
+        os.remove(_upload_partial_path(upload.id))
+        return jsonify({'message': 'محتوى الملف لا يطابق نوعه المسموح'}), 415
+
+    # Whatever arrived is kept, so an interrupted chunk resumes from its last block
+    upload.received_size = start + written
+    db.session.commit()
+    if written < length:
+        return jsonify({'message': 'انقطع رفع الجزء', 'received_size': upload.received_size}), 400
+    if upload.received_size == upload.total_size:
+        finalize_upload_session(upload)
+        return jsonify(upload.to_dict()), 201
+    return jsonify(upload.to_dict())
+
+
 @app.route('/api/documents/employee/<int:employee_id>/upload', methods=['POST'])
 @jwt_required()
 def upload_employee_document(employee_id):
@@ -2229,119 +5184,631 @@ def upload_employee_document(employee_id):
     if not doc_type:
         return jsonify({'message': 'Invalid document type'}), 400
 
-    filename = secure_filename(file.filename)
-    
-    # Create a subdirectory for the employee if it doesn't exist
-    employee_upload_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'employees', str(employee_id))
-    os.makedirs(employee_upload_folder, exist_ok=True)
-    
-    file_path = os.path.join(employee_upload_folder, filename)
-    file.save(file_path)
-    
-    # Use a relative path for the database
-    db_file_path = os.path.join('employees', str(employee_id), filename)
+    error = check_uploaded_file(file, *upload_limits('employee_document', doc_type))
+    if error:
+        return jsonify({'message': error}), 400
 
-    # Check if a document of this type already exists for the employee
-    existing_doc = EmployeeDocument.query.filter_by(employee_id=employee_id, doc_type_id=doc_type_id).first()
-    
-    if existing_doc:
-        # Update existing document
-        existing_doc.file_path = db_file_path
-        existing_doc.file_name = filename
-        existing_doc.mime_type = file.mimetype
-        existing_doc.expiry_date = request.form.get('expiry_date') or None
-        existing_doc.status = 'Uploaded' # Reset status on new upload
-        existing_doc.uploaded_at = datetime.utcnow()
-    else:
-        # Create new document record
-        new_doc = EmployeeDocument(
-            employee_id=employee_id,
-            doc_type_id=doc_type_id,
-            file_path=db_file_path,
-            file_name=filename,
-            mime_type=file.mimetype,
-            expiry_date=request.form.get('expiry_date') or None,
-            status='Uploaded'
-        )
-        db.session.add(new_doc)
-        
+    filename = secure_filename(file.filename)
+    blob_hash = store_blob_from_stream(file.stream, file.mimetype)
+    attach_employee_document(employee_id, doc_type.id, blob_hash, filename, file.mimetype,
+                             request.form.get('expiry_date'), int(get_jwt_identity()))
     db.session.commit()
     
-    return jsonify({'message': 'File uploaded successfully', 'path': db_file_path}), 201
+    return jsonify({'message': 'File uploaded successfully', 'path': blob_relative_path(blob_hash)}), 201
+
 
+# Files are served with conditional and partial responses (ETag/Last-Modified
+# with 304s, Range with 206s). Blobs never change under their hash, so they are
+# cached privately for a long time; other files (payslips) are revalidated.
+# With FILE_SERVING_OFFLOAD=x-accel (nginx) or x-sendfile (Apache/lighttpd) the
+# app only does the access check and the front server sends the bytes; for
+# nginx, FILE_SERVING_ACCEL_PREFIX must be an internal location aliased to the
+# uploads folder.
+FILE_SERVING_OFFLOAD = os.environ.get('FILE_SERVING_OFFLOAD', '').lower()
+FILE_SERVING_ACCEL_PREFIX = os.environ.get('FILE_SERVING_ACCEL_PREFIX', '/protected-uploads/')
+BLOB_CACHE_MAX_AGE = 365 * 24 * 3600
 
 @app.route('/api/uploads/<path:filepath>')
-@jwt_required()
+@signed_url_or_jwt
 def serve_uploaded_file(filepath):
-    # This is a basic security measure. In a real app, you'd check
-    # if the current user has permission to see this file.
-    
-    # Clean up path to prevent directory traversal
-    filepath = filepath.replace('../', '')
-    
-    # Determine the base directory (e.g., 'applicants', 'employees')
-    parts = filepath.split('/')
-    if not parts:
-        return jsonify({"message": "Invalid file path"}), 400
-    
-    base_dir = parts[0]
-    # Reconstruct path relative to the specific upload folder
-    safe_path = os.path.join(app.config['UPLOAD_FOLDER'], base_dir, *parts[1:])
-    
-    # Further security: ensure the resolved path is within the UPLOAD_FOLDER
-    if not os.path.abspath(safe_path).startswith(os.path.abspath(app.config['UPLOAD_FOLDER'])):
+    """Serves a stored file. Previews use a signed URL so the browser can fetch ranges itself."""
+    # safe_join refuses anything that would escape the uploads folder
+    full_path = safe_join(app.config['UPLOAD_FOLDER'], filepath)
+    if full_path is None:
         return jsonify({"message": "Forbidden"}), 403
+    # Checked against the normalised path so 'blobs/../payslips/...' or './payslips/...' can't slip past
+    parts = os.path.relpath(full_path, app.config['UPLOAD_FOLDER']).split(os.sep)
+
+    # Payslips are personal: other than Admin/HR, users only get their own ('payslips/YYYY-MM/<employee_id>.html')
+    if parts[0] == 'payslips' and g.url_claims['role'] not in ['Admin', 'HR']:
+        user = db.session.get(User, int(g.url_claims['sub']))
+        if not user or not user.employee_id or len(parts) != 3 or parts[2] != f"{user.employee_id}.html":
+            return jsonify({"message": "Forbidden"}), 403
 
-    if not os.path.exists(safe_path):
-        # Fallback for old paths that might have '..'
-        fallback_path = os.path.join(app.config['UPLOAD_FOLDER'], *filepath.split('/'))
-        if os.path.exists(fallback_path) and os.path.abspath(fallback_path).startswith(os.path.abspath(app.config['UPLOAD_FOLDER'])):
-            directory = os.path.dirname(fallback_path)
-            filename = os.path.basename(fallback_path)
-            return send_from_directory(directory, filename)
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        return jsonify({"message": "File not found"}), 404
+    if not os.path.isfile(full_path):
         return jsonify({"message": "File not found"}), 404
 
-    directory = os.path.dirname(safe_path)
-    filename = os.path.basename(safe_path)
-    return send_from_directory(directory, filename)
+    is_blob = parts[0] == BLOB_DIR
+    etag, mimetype = None, None
+    if is_blob:
+        # Blob files have no extension; the type comes from the blob record and the hash is a strong validator
+        blob = db.session.get(FileBlob, parts[-1])
+        mimetype = blob.mime_type if blob and blob.mime_type else 'application/octet-stream'
+        etag = parts[-1]
+    mimetype = mimetype or mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+
+    if FILE_SERVING_OFFLOAD in ('x-accel', 'x-sendfile'):
+        response = Response(mimetype=mimetype)
+        if FILE_SERVING_OFFLOAD == 'x-accel':
+            response.headers['X-Accel-Redirect'] = FILE_SERVING_ACCEL_PREFIX.rstrip('/') + '/' + url_quote('/'.join(parts))
+        else:
+            response.headers['X-Sendfile'] = full_path
+        response.set_etag(etag or f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+        response.last_modified = datetime.utcfromtimestamp(stat.st_mtime)
+        # Revalidations are answered here; Range is left to the front server
+        response.make_conditional(request)
+    else:
+        response = send_file(full_path, mimetype=mimetype, conditional=True, etag=etag or True,
+                             last_modified=stat.st_mtime, max_age=BLOB_CACHE_MAX_AGE if is_blob else None)
+
+    return _set_private_caching(response, immutable=is_blob)
+
+def _set_private_caching(response, immutable):
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.max_age = BLOB_CACHE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+# --- Document Thumbnails ---
+# Small JPEG previews live next to their blob as <sha256>.thumb.jpg. They are
+# rendered in the background when new content is stored, and on first request
+# for blobs stored before that. Images need Pillow; PDFs need pdftoppm
+# (poppler-utils), which renders the first page straight at thumbnail size.
+THUMBNAIL_MAX_PX = 320
+THUMBNAIL_JPEG_QUALITY = 80
+THUMBNAIL_SUFFIX = '.thumb.jpg'
+PDFTOPPM = shutil.which('pdftoppm')
+
+def thumbnail_supported(mime_type):
+    if mime_type == 'application/pdf':
+        return PDFTOPPM is not None
+    return Image is not None and bool(mime_type) and mime_type.startswith('image/')
+
+def _thumbnail_path(sha256):
+    return _blob_full_path(sha256) + THUMBNAIL_SUFFIX
+
+def generate_thumbnail(sha256, mime_type):
+    """Renders the blob's thumbnail unless it exists. Returns its path, or None if none can be made."""
+    target = _thumbnail_path(sha256)
+    if os.path.exists(target):
+        return target
+    source = _blob_full_path(sha256)
+    if not thumbnail_supported(mime_type) or not os.path.exists(source):
+        return None
+    # Rendered under a temporary name and renamed, so concurrent requests never see a partial file
+    temp_path = f"{target}.{secrets.token_hex(4)}.tmp"
+    try:
+        if mime_type == 'application/pdf':
+            subprocess.run(
+                [PDFTOPPM, '-jpeg', '-jpegopt', f'quality={THUMBNAIL_JPEG_QUALITY}', '-f', '1', '-l', '1',
+                 '-scale-to', str(THUMBNAIL_MAX_PX), '-singlefile', source, temp_path],
+                check=True, capture_output=True, timeout=30,
+            )
+            os.replace(temp_path + '.jpg', target)
+        else:
+            with Image.open(source) as image:
+                image.draft('RGB', (THUMBNAIL_MAX_PX, THUMBNAIL_MAX_PX)) # JPEGs decode at reduced scale
+                thumbnail = ImageOps.exif_transpose(image)
+                thumbnail.thumbnail((THUMBNAIL_MAX_PX, THUMBNAIL_MAX_PX))
+                thumbnail.convert('RGB').save(temp_path, 'JPEG', quality=THUMBNAIL_JPEG_QUALITY)
+            os.replace(temp_path, target)
+        return target
+    except Exception as e:
+        app.logger.warning(f"Could not render thumbnail for {sha256}: {e}")
+        return None
+    finally:
+        for leftover in (temp_path, temp_path + '.jpg'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+@app.route('/api/documents/thumbnails/<sha256>')
+@signed_url_or_jwt
+def serve_document_thumbnail(sha256):
+    blob = db.session.get(FileBlob, sha256)
+    if not blob:
+        return jsonify({"message": "File not found"}), 404
+    path = generate_thumbnail(blob.sha256, blob.mime_type)
+    if not path:
+        return jsonify({"message": "لا تتوفر معاينة لهذا الملف"}), 404
+    response = send_file(path, mimetype='image/jpeg', conditional=True, etag=f"{blob.sha256}-thumb", max_age=BLOB_CACHE_MAX_AGE)
+    return _set_private_caching(response, immutable=True)
+
+# --- Document Expiry ---
+# scan_document_expiry() runs on a scheduler thread (see run.py). It flips lapsed
+# documents to Expired and marks the ones entering the warning window, both as
+# indexed bulk UPDATEs that return only the rows they changed, so each document
+# is reported once even if scans overlap. employee_document_stats holds
+# per-employee counts for the compliance overview; the flush listener refreshes
+# the employees whose documents change and each scan refreshes everyone, since
+# the expiring window moves with the date.
+DOCUMENT_EXPIRY_WARNING_DAYS = int(os.environ.get('DOCUMENT_EXPIRY_WARNING_DAYS', 30))
+DOCUMENT_EXPIRY_SCAN_HOURS = float(os.environ.get('DOCUMENT_EXPIRY_SCAN_HOURS', 6))
+# Set DOCUMENT_EXPIRY_SCHEDULER=false on all but one process when running several
+app.config['DOCUMENT_EXPIRY_SCHEDULER'] = os.environ.get('DOCUMENT_EXPIRY_SCHEDULER', 'true').lower() == 'true'
+ACTIVE_DOCUMENT_STATUSES = ('Uploaded', 'Verified')
+
+DOCUMENT_STATS_SQL = """
+    INSERT OR REPLACE INTO employee_document_stats
+        (employee_id, documents_count, required_count, expiring_count, expired_count, last_uploaded_at, refreshed_on)
+    SELECT e.id,
+           COUNT(d.id),
+           COALESCE(SUM(t.active = 1 AND t.default_required = 1 AND d.status IN ('Uploaded', 'Verified')), 0),
+           COALESCE(SUM(d.status IN ('Uploaded', 'Verified') AND d.expiry_date >= :today AND d.expiry_date <= :warn_until), 0),
+           COALESCE(SUM(d.status = 'Expired' OR (d.status IN ('Uploaded', 'Verified') AND d.expiry_date < :today AND d.expiry_date != '')), 0),
+           MAX(d.uploaded_at),
+           :today
+    FROM employees e
+    LEFT JOIN employee_documents d ON d.employee_id = e.id
+    LEFT JOIN document_types t ON t.id = d.doc_type_id
+"""
+
+def _expiry_window(today):
+    return today.isoformat(), (today + timedelta(days=DOCUMENT_EXPIRY_WARNING_DAYS)).isoformat()
+
+def refresh_document_stats(employee_ids=None, connection=None, today=None):
+    """Recomputes the counters of the given employees (all if None); the caller commits."""
+    today_iso, warn_until = _expiry_window(today or date.today())
+    params = {'today': today_iso, 'warn_until': warn_until}
+    if employee_ids is None:
+        statement = text(DOCUMENT_STATS_SQL + " GROUP BY e.id")
+    else:
+        employee_ids = [eid for eid in employee_ids if eid is not None]
+        if not employee_ids:
+            return
+        statement = text(DOCUMENT_STATS_SQL + " WHERE e.id IN :ids GROUP BY e.id").bindparams(db.bindparam('ids', expanding=True))
+        params['ids'] = employee_ids
+    (connection or db.session).execute(statement, params)
+
+@on_flush(EmployeeDocument)
+def _refresh_touched_document_stats(session, changes):
+    employee_ids = set()
+    for obj, kind in changes:
+        employee_ids.add(obj.employee_id)
+        if kind == 'dirty':
+            employee_ids.add(previous_value(obj, 'employee_id'))
+    refresh_document_stats(employee_ids, session.connection())
+
+def _refresh_all_document_stats():
+    refresh_document_stats()
+    db.session.commit()
+
+@on_tables_changed('document_types')
+def _document_types_changed(changed_tables):
+    # Making a type required (or inactive) changes everyone's required_count
+    run_batch_job(_refresh_all_document_stats)
+
+def ensure_document_stats_current():
+    """Refreshes the counters if no scan has run today, so the expiring window is never stale."""
+    oldest = db.session.query(func.min(EmployeeDocumentStats.refreshed_on)).scalar()
+    if oldest is None or oldest < date.today().isoformat():
+        _refresh_all_document_stats()
+
+def scan_document_expiry(today=None):
+    """Expires lapsed documents, warns about expiring ones and refreshes the counters."""
+    today = today or date.today()
+    today_iso, warn_until = _expiry_window(today)
+    active = db.or_(EmployeeDocument.status.is_(None), EmployeeDocument.status.in_(ACTIVE_DOCUMENT_STATUSES))
+    expired = db.session.execute(
+        db.update(EmployeeDocument)
+        .where(EmployeeDocument.expiry_date < today_iso, EmployeeDocument.expiry_date != '', active)
+        .values(status='Expired')
+        .returning(EmployeeDocument.employee_id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    expiring = db.session.execute(
+        db.update(EmployeeDocument)
+        .where(EmployeeDocument.expiry_date >= today_iso, EmployeeDocument.expiry_date <= warn_until,
+               EmployeeDocument.expiry_warned_on.is_(None), active)
+        .values(expiry_warned_on=today_iso)
+        .returning(EmployeeDocument.employee_id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    refresh_document_stats(today=today)
+    db.session.commit()
+
+    if expired or expiring:
+        per_employee = defaultdict(lambda: [0, 0])
+        for employee_id in expired:
+            per_employee[employee_id][0] += 1
+        for employee_id in expiring:
+            per_employee[employee_id][1] += 1
+        notifications = []
+        for batch in chunked(per_employee, 500):
+            for user_id, employee_id in db.session.query(User.id, User.employee_id).filter(
+                    User.employee_id.in_(batch), User.account_status == 'Active'):
+                expired_count, expiring_count = per_employee[employee_id]
+                notifications.append({
+                    'recipient_user_id': user_id,
+                    'title': 'تنبيه صلاحية المستندات',
+                    'message': f"مستنداتك: {expired_count} انتهت صلاحيتها، {expiring_count} ستنتهي خلال {DOCUMENT_EXPIRY_WARNING_DAYS} يومًا.",
+                    'type': 'DocumentExpiry',
+                    'related_link': f"/documents/{employee_id}",
+                })
+        for user_id in resolve_notification_audience(roles=['Admin', 'HR']):
+            notifications.append({
+                'recipient_user_id': user_id,
+                'title': 'تنبيه صلاحية المستندات',
+                'message': f"انتهت صلاحية {len(expired)} مستند، و{len(expiring)} مستند ستنتهي صلاحيته خلال {DOCUMENT_EXPIRY_WARNING_DAYS} يومًا.",
+                'type': 'DocumentExpiry',
+                'related_link': '/documents',
+            })
+        deliver_notifications(notifications)
+    return {'expired': len(expired), 'expiring': len(expiring), 'employees': len(set(expired) | set(expiring))}
+
+def start_document_expiry_scheduler(interval_hours=DOCUMENT_EXPIRY_SCAN_HOURS):
+    """Scans now and then every interval_hours on a daemon thread; only the first call starts it."""
+    return start_periodic_task('document-expiry', scan_document_expiry, interval_hours)
+
+@app.route('/api/documents/expiry/scan', methods=['POST'])
+@jwt_required()
+def run_document_expiry_scan():
+    if get_jwt().get('role') not in ['Admin', 'HR']:
+        return jsonify({'message': 'Forbidden'}), 403
+    result = scan_document_expiry()
+    log_action("فحص صلاحية المستندات", f"مستندات منتهية: {result['expired']}، قاربت على الانتهاء: {result['expiring']}", username=get_jwt().get('username'))
+    return jsonify(result)
 
 @app.route('/api/documents/overview', methods=['GET'])
 @jwt_required()
 def get_documents_overview():
-    employees = Employee.query.filter_by(status='Active').all()
-    doc_types = DocumentType.query.filter_by(active=True, default_required=True).all()
-    
-    required_doc_count = len(doc_types)
-    overview = []
-    
-    for emp in employees:
-        uploaded_docs = EmployeeDocument.query.filter_by(employee_id=emp.id).count()
-        expiring_docs_count = 0 # Placeholder for now
-        last_updated_doc = EmployeeDocument.query.filter_by(employee_id=emp.id).order_by(EmployeeDocument.uploaded_at.desc()).first()
+    ensure_document_stats_current()
+    required_doc_count = DocumentType.query.filter_by(active=True, default_required=True).count()
+    rows = db.session.query(Employee, EmployeeDocumentStats).outerjoin(
+        EmployeeDocumentStats, EmployeeDocumentStats.employee_id == Employee.id
+    ).filter(Employee.status == 'Active').all()
 
-        compliance_percent = (uploaded_docs / required_doc_count * 100) if required_doc_count > 0 else 100
-        
+    overview = []
+    for emp, stats in rows:
+        required_uploaded = stats.required_count if stats else 0
+        compliance_percent = (required_uploaded / required_doc_count * 100) if required_doc_count > 0 else 100
         overview.append({
             **emp.to_dict(),
-            'compliance_percent': round(compliance_percent),
-            'missing_docs_count': max(0, required_doc_count - uploaded_docs),
-            'expiring_docs_count': expiring_docs_count,
-            'last_updated': last_updated_doc.uploaded_at.isoformat() if last_updated_doc else "لم يحدث"
+            'compliance_percent': round(min(compliance_percent, 100)),
+            'missing_docs_count': max(0, required_doc_count - required_uploaded),
+            'expiring_docs_count': stats.expiring_count if stats else 0,
+            'expired_docs_count': stats.expired_count if stats else 0,
+            'last_updated': stats.last_uploaded_at.isoformat() if stats and stats.last_uploaded_at else "لم يحدث"
         })
         
     return jsonify({'employees_compliance': overview})
 
 
+# --- Document Archive Export ---
+# Exports stream a ZIP straight into the response: zipfile writes to a sink that
+# cannot seek (so it emits data descriptors instead of rewinding), and the
+# generator hands over whatever the sink holds after every block. Files are
+# read from the store in BLOB_IO_BLOCK_BYTES blocks and stored uncompressed, as
+# scans and PDFs barely compress, so memory stays at about one block per export.
+class _ZipStreamSink(io.RawIOBase):
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+def _archive_entry_name(text_value):
+    # Keeps Arabic names readable while removing path separators and control characters
+    return re.sub(r'[\\/:*?"<>|\x00-\x1f]+', '_', text_value or '').strip() or '_'
+
+def stream_document_archive(documents, manifest_extra):
+    """Yields a ZIP of the given document rows followed by manifest.json."""
+    sink = _ZipStreamSink()
+    manifest, used_names = [], set()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+        for doc in documents:
+            entry = {
+                'employee_id': doc.employee_id, 'employee_name': doc.full_name, 'department': doc.department,
+                'document_type': doc.code, 'document_title': doc.title_ar, 'file_name': doc.file_name,
+                'mime_type': doc.mime_type, 'sha256': doc.blob_hash, 'status': doc.status, 'expiry_date': doc.expiry_date,
+                'uploaded_at': doc.uploaded_at.isoformat() if doc.uploaded_at else None,
+            }
+            full_path = safe_join(app.config['UPLOAD_FOLDER'], doc.file_path)
+            if not full_path or not os.path.isfile(full_path):
+                manifest.append({**entry, 'path': None, 'missing': True})
+                continue
+
+            folder = _archive_entry_name(f"{doc.employee_id} - {doc.full_name}")
+            name = f"{folder}/{_archive_entry_name(doc.code)} - {_archive_entry_name(doc.file_name or doc.blob_hash)}"
+            if name in used_names:
+                name = f"{name}.{doc.id}"
+            used_names.add(name)
+            info = zipfile.ZipInfo(name, date_time=(doc.uploaded_at or datetime.utcnow()).timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.file_size = os.path.getsize(full_path) # lets zipfile decide on ZIP64 up front
+            with open(full_path, 'rb') as source, archive.open(info, 'w') as target:
+                for block in iter(lambda: source.read(BLOB_IO_BLOCK_BYTES), b''):
+                    target.write(block)
+                    yield sink.drain()
+            manifest.append({**entry, 'path': name, 'size': info.file_size})
+            yield sink.drain()
+
+        archive.writestr('manifest.json', json.dumps({
+            **manifest_extra,
+            'documents_count': sum(1 for entry in manifest if not entry.get('missing')),
+            'missing_count': sum(1 for entry in manifest if entry.get('missing')),
+            'documents': manifest,
+        }, ensure_ascii=False, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+    yield sink.drain()
+
+@app.route('/api/documents/export', methods=['GET'])
+@signed_url_or_jwt
+def export_documents_archive():
+    """ZIP of the documents selected by employee_id, department_id and/or doc_type_id (all if none)."""
+    if g.url_claims['role'] not in ['Admin', 'HR']:
+        return jsonify({'message': 'Forbidden'}), 403
+    filters = {key: request.args.get(key, type=int) for key in ('employee_id', 'department_id', 'doc_type_id')}
+
+    query = db.session.query(
+        EmployeeDocument.id, EmployeeDocument.employee_id, EmployeeDocument.file_path, EmployeeDocument.file_name,
+        EmployeeDocument.mime_type, EmployeeDocument.blob_hash, EmployeeDocument.status, EmployeeDocument.expiry_date,
+        EmployeeDocument.uploaded_at, Employee.full_name, Department.name_ar.label('department'),
+        DocumentType.code, DocumentType.title_ar,
+    ).join(Employee, Employee.id == EmployeeDocument.employee_id
+    ).join(DocumentType, DocumentType.id == EmployeeDocument.doc_type_id
+    ).outerjoin(Department, Department.id == Employee.department_id)
+    if filters['employee_id']:
+        query = query.filter(EmployeeDocument.employee_id == filters['employee_id'])
+    if filters['department_id']:
+        query = query.filter(Employee.department_id == filters['department_id'])
+    if filters['doc_type_id']:
+        query = query.filter(EmployeeDocument.doc_type_id == filters['doc_type_id'])
+    # Rows are read up front so the stream itself needs no database session
+    documents = query.order_by(EmployeeDocument.employee_id, DocumentType.code).all()
+    if not documents:
+        return jsonify({'message': 'لا توجد مستندات مطابقة للتصدير'}), 404
+
+    log_action("تصدير المستندات", f"تصدير {len(documents)} مستند ({json.dumps({k: v for k, v in filters.items() if v})})",
+               username=g.url_claims['username'])
+    manifest_extra = {
+        'generated_at': datetime.utcnow().isoformat(),
+        'generated_by': g.url_claims['username'],
+        'filters': {k: v for k, v in filters.items() if v},
+    }
+    filename = f"documents-{date.today().isoformat()}.zip"
+    return Response(stream_document_archive(documents, manifest_extra), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+# --- Reporting Engine ---
+# report_facts is a pre-aggregated store of monthly facts per department x
+# location. Writes to employees, leaves and attendance mark the months they
+# affect as dirty; refresh_report_facts() recomputes only those months with a
+# few GROUP BY queries each. Queries run over an in-memory columnar copy of the
+# facts, which stays small (months x departments x locations).
+REPORT_DIMENSIONS = ('month', 'year', 'department_id', 'location_id')
+REPORT_MEASURES = ('headcount', 'hires', 'separations', 'leave_days',
+                   'attendance_present', 'attendance_late', 'attendance_absent')
+REPORT_DERIVED_MEASURES = ('turnover_rate', 'attendance_rate', 'leave_days_per_employee')
+SEPARATED_STATUSES = ('Terminated', 'Resigned')
+
+ISO_MONTH_PREFIX = re.compile(r'^\d{4}-(0[1-9]|1[0-2])')
+
+def _month_of(value):
+    """'YYYY-MM' of an ISO date string, or None for empty or malformed input (so a bad
+    date in a flushed row skips month marking instead of failing the transaction)."""
+    match = ISO_MONTH_PREFIX.match(str(value)) if value else None
+    return match.group(0) if match else None
+
+def _month_bounds(month):
+    year, mon = int(month[:4]), int(month[5:7])
+    first = date(year, mon, 1)
+    last = (date(year + (mon == 12), mon % 12 + 1, 1) - timedelta(days=1))
+    return first.isoformat(), last.isoformat()
+
+def _months_between(first_month, last_month):
+    year, mon = int(first_month[:4]), int(first_month[5:7])
+    months = []
+    while f"{year:04d}-{mon:02d}" <= last_month:
+        months.append(f"{year:04d}-{mon:02d}")
+        year, mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return months
+
+def mark_report_months(months, connection=None):
+    months = [m for m in set(months) if m]
+    if not months:
+        return
+    stmt = sqlite_insert(ReportDirtyMonth.__table__).on_conflict_do_nothing()
+    (connection or db.session).execute(stmt, [{'month': m} for m in months])
+
+@on_flush(Employee, LeaveRequest, Attendance)
+def _mark_dirty_report_months(session, changes):
+    current_month = date.today().strftime('%Y-%m')
+    months = set()
+    for obj, kind in changes:
+        if isinstance(obj, Attendance):
+            months.update({_month_of(obj.date), _month_of(previous_value(obj, 'date'))})
+        elif isinstance(obj, LeaveRequest):
+            starts = [_month_of(obj.start_date), _month_of(previous_value(obj, 'start_date'))]
+            ends = [_month_of(obj.end_date), _month_of(previous_value(obj, 'end_date'))]
+            if all(starts) and all(ends):
+                months.update(_months_between(min(starts), max(ends)))
+        elif isinstance(obj, Employee):
+            if kind == 'dirty' and obj.status not in SEPARATED_STATUSES and not any(
+                    inspect(obj).attrs[attr].history.has_changes()
+                    for attr in ('department_id', 'location_id', 'hire_date', 'status')):
+                continue
+            # Headcount is a running figure, so every month from hiring onwards is affected
+            hire_months = [m for m in (_month_of(obj.hire_date), _month_of(previous_value(obj, 'hire_date'))) if m]
+            months.update(_months_between(min(hire_months), current_month) if hire_months else [current_month])
+    mark_report_months(months, session.connection())
+
+def compute_month_facts(month):
+    """Aggregates one month of facts keyed by (department_id, location_id)."""
+    month_start, month_end = _month_bounds(month)
+    dept = func.coalesce(Employee.department_id, 0)
+    loc = func.coalesce(Employee.location_id, 0)
+    facts = defaultdict(lambda: dict.fromkeys(REPORT_MEASURES, 0))
+
+    # Separation dates are not stored; the last update of a separated record stands in for it
+    separated_by = db.and_(Employee.status.in_(SEPARATED_STATUSES), func.date(Employee.updated_at) <= month_end)
+    headcount = db.session.query(dept, loc, func.count(Employee.id)).filter(
+        func.coalesce(Employee.hire_date, func.date(Employee.created_at)) <= month_end,
+        db.not_(separated_by)
+    ).group_by(dept, loc)
+    hires = db.session.query(dept, loc, func.count(Employee.id)).filter(
+        Employee.hire_date.between(month_start, month_end)
+    ).group_by(dept, loc)
+    separations = db.session.query(dept, loc, func.count(Employee.id)).filter(
+        Employee.status.in_(SEPARATED_STATUSES),
+        func.date(Employee.updated_at).between(month_start, month_end)
+    ).group_by(dept, loc)
+    overlap_days = (func.julianday(func.min(LeaveRequest.end_date, month_end))
+                    - func.julianday(func.max(LeaveRequest.start_date, month_start)) + 1)
+    leave_days = db.session.query(dept, loc, func.sum(overlap_days)).join(Employee, LeaveRequest.employee_id == Employee.id).filter(
+        LeaveRequest.status.in_(['Approved', 'HRApproved']),
+        LeaveRequest.start_date <= month_end,
+        LeaveRequest.end_date >= month_start
+    ).group_by(dept, loc)
+    attendance = db.session.query(dept, loc, Attendance.status, func.count(Attendance.id)).join(Employee, Attendance.employee_id == Employee.id).filter(
+        Attendance.date.between(month_start, month_end)
+    ).group_by(dept, loc, Attendance.status)
+
+    for measure, query in (('headcount', headcount), ('hires', hires), ('separations', separations), ('leave_days', leave_days)):
+        for department_id, location_id, value in query:
+            facts[(department_id, location_id)][measure] = value or 0
+    status_measures = {'Present': 'attendance_present', 'Late': 'attendance_late', 'Absent': 'attendance_absent'}
+    for department_id, location_id, status, value in attendance:
+        if status in status_measures:
+            facts[(department_id, location_id)][status_measures[status]] += value
+    return facts
+
+_report_refresh_lock = threading.Lock()
+_report_cube = None
+
+def refresh_report_facts(full=False):
+    """Recomputes dirty months (or the whole history) and returns how many months were rebuilt."""
+    global _report_cube
+    with _report_refresh_lock:
+        if full or ReportFact.query.first() is None:
+            first_month = min(filter(None, [
+                _month_of(db.session.query(func.min(Employee.hire_date)).scalar()),
+                _month_of(db.session.query(func.min(LeaveRequest.start_date)).scalar()),
+                _month_of(db.session.query(func.min(Attendance.date)).scalar()),
+            ]), default=None)
+            months = _months_between(first_month, date.today().strftime('%Y-%m')) if first_month else []
+            ReportFact.query.delete()
+        else:
+            months = [m for (m,) in db.session.query(ReportDirtyMonth.month)]
+        if not months:
+            return 0
+
+        for month in months:
+            ReportFact.query.filter_by(month=month).delete()
+            rows = [{'month': month, 'department_id': department_id, 'location_id': location_id, **values}
+                    for (department_id, location_id), values in compute_month_facts(month).items()]
+            if rows:
+                db.session.execute(ReportFact.__table__.insert(), rows)
+        ReportDirtyMonth.query.filter(ReportDirtyMonth.month.in_(months)).delete(synchronize_session=False)
+        db.session.commit()
+        _report_cube = None
+        return len(months)
+
+@on_tables_changed('employees', 'leave_requests', 'attendance')
+def _schedule_report_refresh(changed_tables):
+    run_batch_job(refresh_report_facts)
+
+class ReportCube:
+    """Column-oriented copy of report_facts answering group-by/filter queries."""
+
+    def __init__(self, facts):
+        self.columns = {name: [] for name in REPORT_DIMENSIONS + REPORT_MEASURES}
+        for fact in facts:
+            self.columns['month'].append(fact.month)
+            self.columns['year'].append(fact.month[:4])
+            self.columns['department_id'].append(fact.department_id)
+            self.columns['location_id'].append(fact.location_id)
+            for measure in REPORT_MEASURES:
+                self.columns[measure].append(getattr(fact, measure) or 0)
+        self.size = len(self.columns['month'])
+
+    def query(self, group_by=(), filters=None, month_from=None, month_to=None):
+        months = self.columns['month']
+        selected = range(self.size)
+        if month_from:
+            selected = [i for i in selected if months[i] >= month_from]
+        if month_to:
+            selected = [i for i in selected if months[i] <= month_to]
+        for dimension, values in (filters or {}).items():
+            column, allowed = self.columns[dimension], set(values)
+            selected = [i for i in selected if column[i] in allowed]
+
+        key_columns = [self.columns[d] for d in group_by]
+        groups = defaultdict(lambda: {'sums': dict.fromkeys(REPORT_MEASURES, 0), 'months': set()})
+        for i in selected:
+            group = groups[tuple(column[i] for column in key_columns)]
+            group['months'].add(months[i])
+            sums = group['sums']
+            for measure in REPORT_MEASURES:
+                sums[measure] += self.columns[measure][i]
+
+        results = []
+        for key, group in groups.items():
+            values = group['sums']
+            # Headcount is a stock: report the monthly average rather than the sum
+            values['headcount'] = round(values['headcount'] / len(group['months']), 2)
+            attended = values['attendance_present'] + values['attendance_late']
+            recorded = attended + values['attendance_absent']
+            values['turnover_rate'] = round(values['separations'] / values['headcount'] * 100, 2) if values['headcount'] else 0
+            values['attendance_rate'] = round(attended / recorded * 100, 2) if recorded else 0
+            values['leave_days_per_employee'] = round(values['leave_days'] / values['headcount'], 2) if values['headcount'] else 0
+            results.append({**dict(zip(group_by, key)), **values})
+        results.sort(key=lambda row: tuple(row[d] for d in group_by))
+        return results
+
+def get_report_cube():
+    global _report_cube
+    if ReportDirtyMonth.query.first() is not None or (_report_cube is None and ReportFact.query.first() is None):
+        refresh_report_facts()
+    cube = _report_cube
+    if cube is None:
+        cube = _report_cube = ReportCube(ReportFact.query.all())
+    return cube
+
 # --- Reports API ---
 @app.route("/api/reports", methods=['GET'])
 @jwt_required()
 def get_reports_data():
     active_employees_count = Employee.query.filter_by(status='Active').count()
-    on_leave_today_count = 0 # Placeholder
+    today_str = date.today().isoformat()
+    on_leave_today_count = db.session.query(func.count(func.distinct(LeaveRequest.employee_id))).filter(
+        LeaveRequest.start_date <= today_str,
+        LeaveRequest.end_date >= today_str,
+        LeaveRequest.status.in_(['Approved', 'HRApproved'])
+    ).scalar()
     open_positions_count = Job.query.filter_by(status='Open').count()
     avg_performance_score = db.session.query(func.avg(PerformanceReview.score)).scalar() or 0
 
-    employees_by_dept_raw = db.session.query(Department.name_ar, func.count(Employee.id)).join(Employee).group_by(Department.name_ar).all()
+    employees_by_dept_raw = db.session.query(Department.name_ar, func.count(Employee.id)).join(Employee, Employee.department_id == Department.id).group_by(Department.name_ar).all()
     leaves_by_type_raw = db.session.query(LeaveRequest.leave_type, func.count(LeaveRequest.id)).group_by(LeaveRequest.leave_type).all()
     
     all_employees = Employee.query.options(
@@ -2363,6 +5830,50 @@ def get_reports_data():
     return jsonify(report_data)
 
 
+@app.route("/api/reports/cube", methods=['GET'])
+@jwt_required()
+def query_report_cube():
+    """Slice-and-dice over the monthly fact store.
+
+    Query args: group_by (comma-separated dimensions), measures, from/to (YYYY-MM)
+    and department_id / location_id filters (comma-separated ids).
+    """
+    group_by = [d for d in request.args.get('group_by', '').split(',') if d]
+    measures = [m for m in request.args.get('measures', '').split(',') if m] or list(REPORT_MEASURES + REPORT_DERIVED_MEASURES)
+    invalid = [d for d in group_by if d not in REPORT_DIMENSIONS] + \
+              [m for m in measures if m not in REPORT_MEASURES + REPORT_DERIVED_MEASURES]
+    if invalid:
+        return jsonify({"message": f"أبعاد أو مقاييس غير معروفة: {', '.join(invalid)}"}), 400
+
+    filters = {}
+    for dimension in ('department_id', 'location_id'):
+        if request.args.get(dimension):
+            try:
+                filters[dimension] = [int(v) for v in request.args[dimension].split(',')]
+            except ValueError:
+                return jsonify({"message": "معرفات غير صالحة"}), 400
+
+    rows = get_report_cube().query(group_by, filters, request.args.get('from'), request.args.get('to'))
+    rows = [{**{d: row[d] for d in group_by}, **{m: row[m] for m in measures}} for row in rows]
+
+    labels = {}
+    if 'department_id' in group_by:
+        labels['department_id'] = {d.id: d.name_ar for d in Department.query.all()}
+    if 'location_id' in group_by:
+        labels['location_id'] = {l.id: l.name_ar for l in Location.query.all()}
+
+    return jsonify({'group_by': group_by, 'measures': measures, 'rows': rows, 'labels': labels})
+
+
+@app.route("/api/reports/cube/refresh", methods=['POST'])
+@jwt_required()
+def refresh_report_cube():
+    if get_jwt().get('role') not in ['Admin', 'HR']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    months = refresh_report_facts(full=request.args.get('full') == 'true')
+    return jsonify({"message": f"تم تحديث {months} شهر/أشهر من بيانات التقارير."})
+
+
 # --- Work Schedules API ---
 
 @app.route('/api/work-schedules', methods=['GET', 'POST'])
@@ -2455,6 +5966,695 @@ def assign_employee_schedules():
     log_action("تسكين موظفين على وردية", f"تم تسكين {len(employee_ids)} موظف/موظفين على الوردية ID {schedule_id}")
     return jsonify({"message": "تم تسكين الموظفين بنجاح."}), 201
 
+# --- Rostering API ---
+ROSTER_BATCH_SIZE = 5000
+
+def _parse_iso_date(value):
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+def roster_scope_employee_ids(scope, scope_id):
+    query = db.session.query(Employee.id).filter(Employee.status == 'Active')
+    if scope == 'department' and scope_id:
+        query = query.filter(Employee.department_id == scope_id)
+    elif scope == 'location' and scope_id:
+        query = query.filter(Employee.location_id == scope_id)
+    return [eid for (eid,) in query.order_by(Employee.id)]
+
+def _roster_unavailable_days(employee_ids, start, end):
+    """Per employee, the ISO dates in [start, end] that are approved leave or weekly off-days."""
+    start_str, end_str = start.isoformat(), end.isoformat()
+    unavailable = defaultdict(set)
+    for eid_chunk in chunked(employee_ids, 900):
+        leaves = db.session.query(LeaveRequest.employee_id, LeaveRequest.start_date, LeaveRequest.end_date).filter(
+            LeaveRequest.employee_id.in_(eid_chunk),
+            LeaveRequest.status.in_(APPROVED_LEAVE_STATUSES),
+            LeaveRequest.start_date <= end_str,
+            LeaveRequest.end_date >= start_str)
+        for employee_id, leave_start, leave_end in leaves:
+            first, last = _parse_iso_date(max(leave_start, start_str)), _parse_iso_date(min(leave_end, end_str))
+            if first and last:
+                unavailable[employee_id].update((first + timedelta(days=n)).isoformat() for n in range((last - first).days + 1))
+
+        assignments = db.session.query(EmployeeWorkSchedule.employee_id, EmployeeWorkSchedule.effective_from,
+                                       EmployeeWorkSchedule.effective_to, WorkSchedule.weekly_off_days).join(
+            WorkSchedule, EmployeeWorkSchedule.schedule_id == WorkSchedule.id).filter(
+            EmployeeWorkSchedule.employee_id.in_(eid_chunk),
+            EmployeeWorkSchedule.effective_from <= end_str,
+            db.or_(EmployeeWorkSchedule.effective_to.is_(None), EmployeeWorkSchedule.effective_to >= start_str)
+        ).order_by(EmployeeWorkSchedule.effective_from.desc())
+        covered = defaultdict(set)
+        for employee_id, effective_from, effective_to, weekly_off_days in assignments:
+            try:
+                off_days = set(json.loads(weekly_off_days or '[]'))
+            except (json.JSONDecodeError, TypeError):
+                off_days = set()
+            day = max(_parse_iso_date(effective_from) or start, start)
+            last = min(_parse_iso_date(effective_to) or end, end)
+            while day <= last:
+                day_str = day.isoformat()
+                # The most recent assignment wins where assignments overlap
+                if day_str not in covered[employee_id]:
+                    covered[employee_id].add(day_str)
+                    if WEEKDAY_MAP[day.weekday()] in off_days:
+                        unavailable[employee_id].add(day_str)
+                day += timedelta(days=1)
+    return unavailable
+
+def generate_rotation_roster(period, pattern, employee_ids, start_offset=0, stagger=False, user_id=None):
+    """Expands a rotation pattern over the period and bulk-inserts the resulting slots.
+    Dates that already have a slot, approved leave or a weekly off-day are left empty."""
+    start, end = _parse_iso_date(period.start_date), _parse_iso_date(period.end_date)
+    cycle = {line.day_index % pattern.cycle_days: line.shift_id for line in pattern.lines if line.shift_id}
+    days = [(start + timedelta(days=n)).isoformat() for n in range((end - start).days + 1)]
+    unavailable = _roster_unavailable_days(employee_ids, start, end)
+
+    slots = RosterSlot.__table__
+    stmt = sqlite_insert(slots).on_conflict_do_nothing(index_elements=['period_id', 'date', 'employee_id'])
+    rows, created, skipped = [], 0, 0
+
+    def flush_rows():
+        nonlocal created
+        if rows:
+            created += db.session.execute(stmt, rows).rowcount
+            rows.clear()
+
+    for position, employee_id in enumerate(employee_ids):
+        offset = start_offset + (position if stagger else 0)
+        blocked = unavailable.get(employee_id, ())
+        for n, day_str in enumerate(days):
+            shift_id = cycle.get((n + offset) % pattern.cycle_days)
+            if not shift_id:
+                continue
+            if day_str in blocked:
+                skipped += 1
+                continue
+            rows.append({'period_id': period.id, 'date': day_str, 'shift_id': shift_id, 'employee_id': employee_id,
+                         'assigned_by': user_id, 'source': 'rotation', 'status': 'Draft'})
+            if len(rows) >= ROSTER_BATCH_SIZE:
+                flush_rows()
+    flush_rows()
+    db.session.commit()
+    return {'created': created, 'skipped_unavailable': skipped, 'employees': len(employee_ids), 'days': len(days)}
+
+# Auto-rostering fills each day's required_headcount (from the pattern lines)
+# greedily: days are processed in order and every (day, shift) demand takes the
+# eligible employees with the fewest assignments so far (night shifts rank by
+# nights worked first). Hard rules are approved leave/off-days, one shift per
+# day, minimum rest between shifts and a cap on consecutive working days. A
+# swap pass then evens out night shifts until the time budget runs out.
+ROSTER_DEFAULT_FLEX_START = time(9, 0)
+ROSTER_MIN_REST_HOURS = 11
+ROSTER_MAX_CONSECUTIVE_DAYS = 6
+ROSTER_TIME_BUDGET_SECONDS = 30
+
+def shift_window(shift):
+    """(start, end) of a shift in minutes from the midnight of its roster date; end may pass 1440."""
+    if shift.type == 'split':
+        periods = list(shift.periods)
+        if periods:
+            start = min(p.start_time.hour * 60 + p.start_time.minute for p in periods)
+            end = max(p.end_time.hour * 60 + p.end_time.minute for p in periods)
+            return start, end if end > start else end + 1440
+    if shift.start_time and shift.end_time:
+        start = shift.start_time.hour * 60 + shift.start_time.minute
+        end = shift.end_time.hour * 60 + shift.end_time.minute
+        return start, end if end > start else end + 1440 # overnight
+    start = ROSTER_DEFAULT_FLEX_START.hour * 60 + ROSTER_DEFAULT_FLEX_START.minute
+    return start, start + int((shift.total_hours or 8) * 60)
+
+def _is_night_shift(shift, window):
+    return shift.type == 'night' or window[1] > 1440
+
+def auto_roster(period, pattern, employee_ids, start_offset=0, min_rest_hours=ROSTER_MIN_REST_HOURS,
+                max_consecutive_days=ROSTER_MAX_CONSECUTIVE_DAYS, time_budget=ROSTER_TIME_BUDGET_SECONDS, user_id=None):
+    deadline = _time.monotonic() + time_budget
+    start, end = _parse_iso_date(period.start_date), _parse_iso_date(period.end_date)
+    days = [(start + timedelta(days=n)).isoformat() for n in range((end - start).days + 1)]
+    day_index = {d: n for n, d in enumerate(days)}
+
+    demand_by_cycle_day = defaultdict(list)
+    for line in pattern.lines:
+        if line.shift_id and (line.required_headcount or 0) > 0:
+            demand_by_cycle_day[line.day_index % pattern.cycle_days].append((line.shift_id, line.required_headcount))
+    shift_ids = {sid for lines in demand_by_cycle_day.values() for sid, _ in lines}
+    shift_ids.update(sid for (sid,) in db.session.query(RosterSlot.shift_id).filter_by(period_id=period.id).distinct())
+    shifts = {s.id: s for s in Shift.query.filter(Shift.id.in_(shift_ids))}
+    windows = {sid: shift_window(s) for sid, s in shifts.items()}
+    nights = {sid for sid, s in shifts.items() if _is_night_shift(s, windows[sid])}
+    min_rest = min_rest_hours * 60
+
+    # Existing slots are kept: they count towards demand and constrain the employees they belong to
+    assigned = defaultdict(dict) # employee_id -> {day number: shift_id}
+    filled = defaultdict(int) # (day number, shift_id) -> headcount
+    existing = db.session.query(RosterSlot.employee_id, RosterSlot.date, RosterSlot.shift_id).filter(
+        RosterSlot.period_id == period.id, RosterSlot.status != 'Cancelled')
+    for employee_id, day_str, shift_id in existing:
+        if day_str in day_index:
+            assigned[employee_id][day_index[day_str]] = shift_id
+            filled[(day_index[day_str], shift_id)] += 1
+    total_count = {eid: len(assigned[eid]) for eid in employee_ids}
+    night_count = {eid: sum(1 for sid in assigned[eid].values() if sid in nights) for eid in employee_ids}
+    unavailable = _roster_unavailable_days(employee_ids, start, end)
+    blocked = {eid: {day_index[d] for d in unavailable.get(eid, ())} for eid in employee_ids}
+
+    def rest_ok(eid, n, shift_id):
+        shift_start, shift_end = windows[shift_id]
+        previous, following = assigned[eid].get(n - 1), assigned[eid].get(n + 1)
+        if previous and shift_start + 1440 - windows[previous][1] < min_rest:
+            return False
+        return not following or windows[following][0] + 1440 - shift_end >= min_rest
+
+    def consecutive_ok(eid, n):
+        worked = assigned[eid]
+        run = 1
+        k = n - 1
+        while k in worked:
+            run, k = run + 1, k - 1
+        k = n + 1
+        while k in worked:
+            run, k = run + 1, k + 1
+        return run <= max_consecutive_days
+
+    def eligible(eid, n, shift_id):
+        return n not in assigned[eid] and n not in blocked[eid] and rest_ok(eid, n, shift_id) and consecutive_ok(eid, n)
+
+    new_slots = {} # (employee_id, day number) -> shift_id
+    unmet, timed_out = [], False
+    for n, day_str in enumerate(days):
+        demands = sorted(demand_by_cycle_day.get((n + start_offset) % pattern.cycle_days, []), key=lambda d: windows[d[0]][0])
+        for shift_id, required in demands:
+            missing = required - filled[(n, shift_id)]
+            if missing <= 0:
+                continue
+            if timed_out or _time.monotonic() > deadline:
+                timed_out = True
+                unmet.append({'date': day_str, 'shift_id': shift_id, 'required': required, 'assigned': filled[(n, shift_id)], 'missing': missing})
+                continue
+            is_night = shift_id in nights
+            candidates = [eid for eid in employee_ids if eligible(eid, n, shift_id)]
+            candidates.sort(key=lambda eid: (night_count[eid] if is_night else 0, total_count[eid], eid))
+            for eid in candidates[:missing]:
+                assigned[eid][n] = shift_id
+                new_slots[(eid, n)] = shift_id
+                total_count[eid] += 1
+                night_count[eid] += is_night
+            filled[(n, shift_id)] += min(missing, len(candidates))
+            if len(candidates) < missing:
+                unmet.append({'date': day_str, 'shift_id': shift_id, 'required': required,
+                              'assigned': filled[(n, shift_id)], 'missing': missing - len(candidates)})
+
+    # Balance nights: hand a night slot from a busy night worker to one with fewer
+    # nights, exchanging it for the receiver's day shift on that date if they have one
+    def move_night(giver, ranked):
+        for n, shift_id in sorted(assigned[giver].items()):
+            if shift_id not in nights or (giver, n) not in new_slots:
+                continue
+            for receiver in ranked:
+                if night_count[receiver] >= night_count[giver] - 1 or _time.monotonic() > deadline:
+                    break
+                other = assigned[receiver].get(n)
+                if other is not None and (other in nights or (receiver, n) not in new_slots):
+                    continue
+                del assigned[giver][n]
+                if other is not None:
+                    del assigned[receiver][n]
+                if eligible(receiver, n, shift_id) and (other is None or eligible(giver, n, other)):
+                    assigned[receiver][n] = new_slots[(receiver, n)] = shift_id
+                    del new_slots[(giver, n)]
+                    if other is not None:
+                        assigned[giver][n] = new_slots[(giver, n)] = other
+                    else:
+                        total_count[giver] -= 1
+                        total_count[receiver] += 1
+                    night_count[giver] -= 1
+                    night_count[receiver] += 1
+                    return True
+                assigned[giver][n] = shift_id
+                if other is not None:
+                    assigned[receiver][n] = other
+        return False
+
+    swaps = 0
+    while nights and not timed_out and _time.monotonic() < deadline:
+        ranked = sorted(employee_ids, key=lambda eid: night_count[eid])
+        if not any(move_night(giver, ranked) for giver in reversed(ranked)
+                   if night_count[giver] - night_count[ranked[0]] > 1 and _time.monotonic() < deadline):
+            break
+        swaps += 1
+
+    rows = [{'period_id': period.id, 'date': days[n], 'shift_id': shift_id, 'employee_id': eid,
+             'assigned_by': user_id, 'source': 'auto', 'status': 'Draft'} for (eid, n), shift_id in new_slots.items()]
+    stmt = sqlite_insert(RosterSlot.__table__).on_conflict_do_nothing(index_elements=['period_id', 'date', 'employee_id'])
+    for batch in chunked(rows, ROSTER_BATCH_SIZE):
+        db.session.execute(stmt, batch)
+    db.session.commit()
+
+    assigned_nights = [night_count[eid] for eid in employee_ids]
+    return {
+        'created': len(rows),
+        'unmet': unmet,
+        'unmet_total': sum(u['missing'] for u in unmet),
+        'timed_out': timed_out,
+        'fairness': {
+            'night_swaps': swaps,
+            'min_nights': min(assigned_nights, default=0),
+            'max_nights': max(assigned_nights, default=0),
+        },
+    }
+
+# Each roster period gets an in-memory coverage index, built on first use: the
+# headcount per (day, shift) and, per employee and day, any conflicts (leave
+# overlap, a booking in another period, too little rest after the previous
+# shift). Slot writes through the ORM update it incrementally after commit;
+# bulk writes and changes to leaves or shifts drop it so it is rebuilt.
+class RosterCoverageIndex:
+    def __init__(self, period, min_rest_hours=ROSTER_MIN_REST_HOURS):
+        self.period_id = period.id
+        self.start = _parse_iso_date(period.start_date)
+        end = _parse_iso_date(period.end_date)
+        self.days = [(self.start + timedelta(days=n)).isoformat() for n in range((end - self.start).days + 1)]
+        self.day_numbers = {d: n for n, d in enumerate(self.days)}
+        self.min_rest = min_rest_hours * 60
+        self.windows = {s.id: shift_window(s) for s in Shift.query.all()}
+        self.coverage = defaultdict(int) # (day number, shift_id) -> headcount
+        self.slots = defaultdict(dict) # employee_id -> {day number: shift_id}
+        self.conflicts = {} # (employee_id, day number) -> [conflict types]
+
+        # Neighbouring days are loaded too so rest checks work across period edges
+        outer_from = (self.start - timedelta(days=1)).isoformat()
+        outer_to = (end + timedelta(days=1)).isoformat()
+        self.external = defaultdict(dict) # employee_id -> {day number: shift_id} from other periods
+        for employee_id, day_str, shift_id, period_id in db.session.query(
+                RosterSlot.employee_id, RosterSlot.date, RosterSlot.shift_id, RosterSlot.period_id).filter(
+                RosterSlot.date.between(outer_from, outer_to), RosterSlot.status != 'Cancelled'):
+            n = self._day_number(day_str)
+            if period_id == self.period_id:
+                self.slots[employee_id][n] = shift_id
+                self.coverage[(n, shift_id)] += 1
+            else:
+                self.external[employee_id][n] = shift_id
+
+        self.leave_days = defaultdict(set)
+        for employee_id, leave_start, leave_end in db.session.query(LeaveRequest.employee_id, LeaveRequest.start_date, LeaveRequest.end_date).filter(
+                LeaveRequest.status.in_(APPROVED_LEAVE_STATUSES), LeaveRequest.start_date <= period.end_date, LeaveRequest.end_date >= period.start_date):
+            first, last = self._day_number(max(leave_start, period.start_date)), self._day_number(min(leave_end, period.end_date))
+            self.leave_days[employee_id].update(range(first, last + 1))
+
+        for employee_id, days in self.slots.items():
+            for n in days:
+                self._check(employee_id, n)
+
+    def _day_number(self, day_str):
+        n = self.day_numbers.get(day_str)
+        return n if n is not None else (_parse_iso_date(day_str) - self.start).days
+
+    def _shift_on(self, employee_id, n):
+        return self.slots[employee_id].get(n) or self.external[employee_id].get(n)
+
+    def _check(self, employee_id, n):
+        shift_id = self.slots[employee_id].get(n)
+        found = []
+        if shift_id is not None and shift_id in self.windows:
+            if n in self.leave_days.get(employee_id, ()):
+                found.append('leave_overlap')
+            if n in self.external[employee_id]:
+                found.append('double_booking')
+            previous = self._shift_on(employee_id, n - 1)
+            if previous in self.windows and self.windows[shift_id][0] + 1440 - self.windows[previous][1] < self.min_rest:
+                found.append('rest_violation')
+        if found:
+            self.conflicts[(employee_id, n)] = found
+        else:
+            self.conflicts.pop((employee_id, n), None)
+
+    def apply(self, employee_id, day_str, shift_id):
+        """Sets (or clears, with shift_id None) an employee's slot for a day and rechecks around it."""
+        n = self.day_numbers.get(day_str)
+        if n is None:
+            return
+        current = self.slots[employee_id].pop(n, None)
+        if current is not None:
+            self.coverage[(n, current)] -= 1
+        if shift_id is not None:
+            self.slots[employee_id][n] = shift_id
+            self.coverage[(n, shift_id)] += 1
+        self._check(employee_id, n)
+        if n + 1 < len(self.days):
+            self._check(employee_id, n + 1)
+
+    def coverage_by_day(self, date_from=None, date_to=None):
+        result = defaultdict(dict)
+        for (n, shift_id), count in self.coverage.items():
+            day_str = self.days[n]
+            if count and (not date_from or day_str >= date_from) and (not date_to or day_str <= date_to):
+                result[day_str][shift_id] = count
+        return dict(sorted(result.items()))
+
+    def conflict_list(self, employee_id=None):
+        return [{'employee_id': eid, 'date': self.days[n], 'shift_id': self.slots[eid].get(n), 'types': types}
+                for (eid, n), types in sorted(self.conflicts.items(), key=lambda item: (item[0][1], item[0][0]))
+                if employee_id is None or eid == employee_id]
+
+_roster_indexes = {}
+_roster_index_lock = threading.RLock()
+
+def get_roster_index(period):
+    with _roster_index_lock:
+        index = _roster_indexes.get(period.id)
+        if index is None:
+            index = _roster_indexes[period.id] = RosterCoverageIndex(period)
+        return index
+
+def invalidate_roster_index(period_id=None):
+    with _roster_index_lock:
+        if period_id is None:
+            _roster_indexes.clear()
+        else:
+            _roster_indexes.pop(period_id, None)
+
+@on_flush(RosterSlot)
+def _collect_roster_slot_changes(session, changes):
+    deltas = session.info.setdefault('roster_slot_deltas', [])
+    for slot, kind in changes:
+        if kind != 'new':
+            deltas.append((previous_value(slot, 'period_id'), previous_value(slot, 'employee_id'), previous_value(slot, 'date'), None))
+        if kind != 'deleted' and slot.status != 'Cancelled':
+            deltas.append((slot.period_id, slot.employee_id, slot.date, slot.shift_id))
+
+@event.listens_for(SASession, 'after_commit')
+def _apply_roster_slot_changes(session):
+    deltas = session.info.pop('roster_slot_deltas', None)
+    if not deltas:
+        return
+    with _roster_index_lock:
+        for period_id, employee_id, day_str, shift_id in deltas:
+            index = _roster_indexes.get(period_id)
+            if index is not None:
+                index.apply(employee_id, day_str, shift_id)
+        # A booking also shows up as an external one in overlapping periods; rebuild those
+        touched = {d[0] for d in deltas}
+        for period_id in [pid for pid in _roster_indexes if pid not in touched]:
+            index = _roster_indexes[period_id]
+            if any(day_str in index.day_numbers for _, _, day_str, _ in deltas):
+                del _roster_indexes[period_id]
+
+@event.listens_for(SASession, 'after_soft_rollback')
+def _discard_roster_slot_changes(session, previous_transaction):
+    session.info.pop('roster_slot_deltas', None)
+
+@on_tables_changed('leave_requests', 'shifts', 'shift_periods', 'roster_periods')
+def _invalidate_roster_indexes(changed_tables):
+    invalidate_roster_index()
+
+@app.route('/api/rotation-patterns', methods=['GET', 'POST'])
+@jwt_required()
+def handle_rotation_patterns():
+    if request.method == 'POST':
+        if get_jwt().get('role') not in ['Admin', 'HR', 'Manager']:
+            return jsonify({"message": "صلاحيات غير كافية"}), 403
+        data = request.get_json() or {}
+        if not data.get('name') or not int(data.get('cycle_days') or 0) > 0:
+            return jsonify({"message": "الاسم وطول الدورة مطلوبان"}), 400
+        pattern = RotationPattern(name=data['name'], description=data.get('description'),
+                                  cycle_days=int(data['cycle_days']), active=data.get('active', True))
+        db.session.add(pattern)
+        db.session.flush()
+        for line in data.get('lines', []):
+            db.session.add(RotationPatternLine(pattern_id=pattern.id, day_index=int(line['day_index']) % pattern.cycle_days,
+                                               shift_id=line.get('shift_id'), required_headcount=line.get('required_headcount')))
+        db.session.commit()
+        return jsonify(pattern.to_dict(include_lines=True)), 201
+
+    patterns = RotationPattern.query.order_by(RotationPattern.name).all()
+    return jsonify({"patterns": [p.to_dict(include_lines=True) for p in patterns]})
+
+@app.route('/api/rotation-patterns/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+@jwt_required()
+def handle_rotation_pattern(id):
+    pattern = RotationPattern.query.get_or_404(id)
+    if request.method == 'GET':
+        return jsonify(pattern.to_dict(include_lines=True))
+
+    if get_jwt().get('role') not in ['Admin', 'HR', 'Manager']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+
+    if request.method == 'PUT':
+        data = request.get_json() or {}
+        pattern.name = data.get('name', pattern.name)
+        pattern.description = data.get('description', pattern.description)
+        pattern.cycle_days = int(data.get('cycle_days', pattern.cycle_days))
+        pattern.active = data.get('active', pattern.active)
+        if 'lines' in data:
+            RotationPatternLine.query.filter_by(pattern_id=id).delete()
+            for line in data['lines']:
+                db.session.add(RotationPatternLine(pattern_id=id, day_index=int(line['day_index']) % pattern.cycle_days,
+                                                   shift_id=line.get('shift_id'), required_headcount=line.get('required_headcount')))
+        db.session.commit()
+        return jsonify(pattern.to_dict(include_lines=True))
+
+    db.session.delete(pattern)
+    db.session.commit()
+    return jsonify({"message": "تم حذف النمط بنجاح"})
+
+@app.route('/api/roster-periods', methods=['GET', 'POST'])
+@jwt_required()
+def handle_roster_periods():
+    if request.method == 'POST':
+        if get_jwt().get('role') not in ['Admin', 'HR', 'Manager']:
+            return jsonify({"message": "صلاحيات غير كافية"}), 403
+        data = request.get_json() or {}
+        start, end = _parse_iso_date(data.get('start_date')), _parse_iso_date(data.get('end_date'))
+        if not start or not end or end < start:
+            return jsonify({"message": "تواريخ الفترة غير صالحة"}), 400
+        period = RosterPeriod(start_date=start.isoformat(), end_date=end.isoformat(), scope=data.get('scope', 'company'),
+                              scope_id=data.get('scope_id'), created_by=int(get_jwt_identity()))
+        db.session.add(period)
+        db.session.commit()
+        return jsonify(period.to_dict()), 201
+
+    periods = RosterPeriod.query.order_by(RosterPeriod.start_date.desc()).all()
+    slot_counts = dict(db.session.query(RosterSlot.period_id, func.count(RosterSlot.id)).group_by(RosterSlot.period_id).all())
+    return jsonify({"periods": [{**p.to_dict(), 'slots_count': slot_counts.get(p.id, 0)} for p in periods]})
+
+@app.route('/api/roster-periods/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+@jwt_required()
+def handle_roster_period(id):
+    period = RosterPeriod.query.get_or_404(id)
+    if request.method == 'GET':
+        return jsonify({**period.to_dict(), 'slots_count': RosterSlot.query.filter_by(period_id=id).count()})
+
+    if get_jwt().get('role') not in ['Admin', 'HR', 'Manager']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    if period.status == 'Locked':
+        return jsonify({"message": "الفترة مقفلة ولا يمكن تعديلها"}), 409
+
+    if request.method == 'PUT':
+        data = request.get_json() or {}
+        period.scope = data.get('scope', period.scope)
+        period.scope_id = data.get('scope_id', period.scope_id)
+        db.session.commit()
+        return jsonify(period.to_dict())
+
+    RosterSlot.query.filter_by(period_id=id).delete()
+    db.session.delete(period)
+    db.session.commit()
+    return jsonify({"message": "تم حذف الفترة بنجاح"})
+
+@app.route('/api/roster-periods/<int:id>/generate', methods=['POST'])
+@jwt_required()
+def generate_roster_endpoint(id):
+    claims = get_jwt()
+    if claims.get('role') not in ['Admin', 'HR', 'Manager']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    period = RosterPeriod.query.get_or_404(id)
+    if period.status == 'Locked':
+        return jsonify({"message": "الفترة مقفلة ولا يمكن تعديلها"}), 409
+
+    data = request.get_json() or {}
+    pattern = RotationPattern.query.get(data.get('pattern_id'))
+    if not pattern or not pattern.cycle_days:
+        return jsonify({"message": "نمط التدوير غير موجود"}), 400
+    employee_ids = data.get('employee_ids') or roster_scope_employee_ids(period.scope, period.scope_id)
+
+    if data.get('replace'):
+        # Only drafts created by a previous generation are regenerated; manual edits are kept
+        for eid_chunk in chunked(employee_ids, 900):
+            RosterSlot.query.filter(RosterSlot.period_id == id, RosterSlot.source == 'rotation',
+                                    RosterSlot.status == 'Draft', RosterSlot.employee_id.in_(eid_chunk)).delete(synchronize_session=False)
+
+    result = generate_rotation_roster(period, pattern, employee_ids, start_offset=int(data.get('start_offset', 0)),
+                                      stagger=bool(data.get('stagger')), user_id=int(get_jwt_identity()))
+    invalidate_roster_index()
+    log_action("توليد الجدول", f"تم توليد {result['created']} مناوبة للفترة {period.start_date} - {period.end_date} بنمط '{pattern.name}'.",
+               username=claims.get('username'), user_id=int(get_jwt_identity()))
+    return jsonify(result), 201
+
+@app.route('/api/roster-periods/<int:id>/auto', methods=['POST'])
+@jwt_required()
+def auto_roster_endpoint(id):
+    claims = get_jwt()
+    if claims.get('role') not in ['Admin', 'HR', 'Manager']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    period = RosterPeriod.query.get_or_404(id)
+    if period.status == 'Locked':
+        return jsonify({"message": "الفترة مقفلة ولا يمكن تعديلها"}), 409
+
+    data = request.get_json() or {}
+    pattern = RotationPattern.query.get(data.get('pattern_id'))
+    if not pattern or not pattern.cycle_days:
+        return jsonify({"message": "نمط التدوير غير موجود"}), 400
+    employee_ids = data.get('employee_ids') or roster_scope_employee_ids(period.scope, period.scope_id)
+
+    if data.get('replace'):
+        RosterSlot.query.filter_by(period_id=id, source='auto', status='Draft').delete(synchronize_session=False)
+
+    result = auto_roster(
+        period, pattern, employee_ids,
+        start_offset=int(data.get('start_offset', 0)),
+        min_rest_hours=float(data.get('min_rest_hours', ROSTER_MIN_REST_HOURS)),
+        max_consecutive_days=int(data.get('max_consecutive_days', ROSTER_MAX_CONSECUTIVE_DAYS)),
+        time_budget=min(float(data.get('time_budget_seconds', ROSTER_TIME_BUDGET_SECONDS)), 60),
+        user_id=int(get_jwt_identity()))
+    invalidate_roster_index()
+    log_action("الجدولة التلقائية", f"تم إسناد {result['created']} مناوبة تلقائيًا للفترة {period.start_date} - {period.end_date}، العجز: {result['unmet_total']}.",
+               username=claims.get('username'), user_id=int(get_jwt_identity()))
+    return jsonify(result), 201
+
+@app.route('/api/roster-periods/<int:id>/coverage', methods=['GET'])
+@jwt_required()
+def get_roster_coverage(id):
+    period = RosterPeriod.query.get_or_404(id)
+    index = get_roster_index(period)
+    with _roster_index_lock:
+        coverage = index.coverage_by_day(request.args.get('date_from'), request.args.get('date_to'))
+        conflicts_count = len(index.conflicts)
+
+    pattern = RotationPattern.query.get(request.args.get('pattern_id', type=int)) if request.args.get('pattern_id') else None
+    required = {}
+    if pattern:
+        offset = request.args.get('start_offset', 0, type=int)
+        by_cycle_day = defaultdict(dict)
+        for line in pattern.lines:
+            if line.shift_id and line.required_headcount:
+                by_cycle_day[line.day_index % pattern.cycle_days][line.shift_id] = line.required_headcount
+        required = {day: by_cycle_day.get((n + offset) % pattern.cycle_days, {}) for n, day in enumerate(index.days)}
+    return jsonify({
+        'period_id': id,
+        'coverage': coverage,
+        'required': {day: req for day, req in required.items() if req and
+                     (not request.args.get('date_from') or day >= request.args['date_from']) and
+                     (not request.args.get('date_to') or day <= request.args['date_to'])},
+        'conflicts_count': conflicts_count,
+    })
+
+@app.route('/api/roster-periods/<int:id>/conflicts', methods=['GET'])
+@jwt_required()
+def get_roster_conflicts(id):
+    period = RosterPeriod.query.get_or_404(id)
+    index = get_roster_index(period)
+    with _roster_index_lock:
+        conflicts = index.conflict_list(request.args.get('employee_id', type=int))
+    return jsonify({'conflicts': conflicts, 'total': len(conflicts)})
+
+@app.route('/api/roster-periods/<int:id>/<action>', methods=['POST'])
+@jwt_required()
+def transition_roster_period(id, action):
+    claims = get_jwt()
+    if claims.get('role') not in ['Admin', 'HR', 'Manager']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    if action not in ['publish', 'lock']:
+        return jsonify({"message": "إجراء غير معروف"}), 404
+    period = RosterPeriod.query.get_or_404(id)
+    if period.status == 'Locked':
+        return jsonify({"message": "الفترة مقفلة بالفعل"}), 409
+
+    data = request.get_json(silent=True) or {}
+    index = get_roster_index(period)
+    with _roster_index_lock:
+        conflicts_count = len(index.conflicts)
+    if conflicts_count and not data.get('force'):
+        return jsonify({"message": f"يوجد {conflicts_count} تعارض في الجدول، يرجى حلها أولاً", "conflicts_count": conflicts_count}), 409
+
+    # One set-based transition for the whole period
+    slots = RosterSlot.__table__
+    published = db.session.execute(slots.update().where(
+        slots.c.period_id == id, slots.c.status.in_(['Draft', 'Changed'])).values(status='Published')).rowcount
+    period.status = 'Locked' if action == 'lock' else 'Published'
+    if action == 'lock':
+        period.locked_at = datetime.utcnow()
+    db.session.commit()
+
+    log_action("نشر الجدول" if action == 'publish' else "قفل الجدول",
+               f"الفترة {period.start_date} - {period.end_date}: تم نشر {published} مناوبة.",
+               username=claims.get('username'), user_id=int(get_jwt_identity()))
+    return jsonify({**period.to_dict(), 'published_slots': published})
+
+@app.route('/api/roster-periods/<int:id>/slots', methods=['GET', 'POST'])
+@jwt_required()
+def handle_roster_slots(id):
+    period = RosterPeriod.query.get_or_404(id)
+    if request.method == 'POST':
+        if get_jwt().get('role') not in ['Admin', 'HR', 'Manager']:
+            return jsonify({"message": "صلاحيات غير كافية"}), 403
+        if period.status == 'Locked':
+            return jsonify({"message": "الفترة مقفلة ولا يمكن تعديلها"}), 409
+        data = request.get_json() or {}
+        if not (period.start_date <= (data.get('date') or '') <= period.end_date) or not data.get('employee_id') or not data.get('shift_id'):
+            return jsonify({"message": "بيانات المناوبة غير صالحة"}), 400
+        if RosterSlot.query.filter_by(period_id=id, date=data['date'], employee_id=data['employee_id']).first():
+            return jsonify({"message": "الموظف لديه مناوبة في هذا اليوم بالفعل"}), 409
+        slot = RosterSlot(period_id=id, date=data['date'], employee_id=data['employee_id'], shift_id=data['shift_id'],
+                          assigned_by=int(get_jwt_identity()), source='manual', note=data.get('note'))
+        db.session.add(slot)
+        db.session.commit()
+        index = get_roster_index(period)
+        with _roster_index_lock:
+            conflicts = index.conflict_list(slot.employee_id)
+        return jsonify({**slot.to_dict(), 'conflicts': conflicts}), 201
+
+    query = RosterSlot.query.filter_by(period_id=id)
+    if request.args.get('employee_id'):
+        query = query.filter(RosterSlot.employee_id == request.args.get('employee_id', type=int))
+    if request.args.get('date_from'):
+        query = query.filter(RosterSlot.date >= request.args['date_from'])
+    if request.args.get('date_to'):
+        query = query.filter(RosterSlot.date <= request.args['date_to'])
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 500, type=int), 5000)
+    paginated = query.order_by(RosterSlot.date, RosterSlot.employee_id).paginate(page=page, per_page=per_page, error_out=False)
+    return jsonify({"slots": [s.to_dict() for s in paginated.items], "total": paginated.total, "page": page})
+
+@app.route('/api/roster-slots/<int:id>', methods=['PUT', 'DELETE'])
+@jwt_required()
+def handle_roster_slot(id):
+    if get_jwt().get('role') not in ['Admin', 'HR', 'Manager']:
+        return jsonify({"message": "صلاحيات غير كافية"}), 403
+    slot = RosterSlot.query.get_or_404(id)
+    period = db.session.get(RosterPeriod, slot.period_id)
+    if period.status == 'Locked':
+        return jsonify({"message": "الفترة مقفلة ولا يمكن تعديلها"}), 409
+
+    if request.method == 'DELETE':
+        db.session.delete(slot)
+        db.session.commit()
+        return jsonify({"message": "تم حذف المناوبة بنجاح"})
+
+    data = request.get_json() or {}
+    slot.shift_id = data.get('shift_id', slot.shift_id)
+    slot.note = data.get('note', slot.note)
+    if data.get('status') == 'Cancelled':
+        slot.status = 'Cancelled'
+    elif slot.status == 'Published':
+        slot.status = 'Changed'
+    db.session.commit()
+    index = get_roster_index(period)
+    with _roster_index_lock:
+        conflicts = index.conflict_list(slot.employee_id)
+    return jsonify({**slot.to_dict(), 'conflicts': conflicts})
+
 # --- App Context and DB Initialization ---
 def create_initial_admin_user():
     with app.app_context():
@@ -2471,6 +6671,54 @@ def create_initial_admin_user():
             app.logger.info("Initial admin user created with username 'admin' and password 'admin'.")
 
 
+def backfill_notification_counters():
+    """Creates the unread counter for users that predate notification_counters."""
+    with app.app_context():
+        db.session.execute(text(
+            "INSERT OR IGNORE INTO notification_counters (user_id, unread_count) "
+            "SELECT u.id, (SELECT COUNT(*) FROM in_app_notifications n "
+            "              WHERE n.recipient_user_id = u.id AND n.status = 'Unread') "
+            "FROM users u WHERE u.id NOT IN (SELECT user_id FROM notification_counters)"
+        ))
+        db.session.commit()
+
+
+def migrate_uploads_to_blob_store():
+    """Moves files uploaded before the blob store into it and points their records at the blobs."""
+    with app.app_context():
+        docs = EmployeeDocument.query.filter(EmployeeDocument.blob_hash.is_(None)).all()
+        applicants = Applicant.query.filter(Applicant.cv_path.isnot(None), Applicant.cv_blob_hash.is_(None)).all()
+        if not docs and not applicants:
+            return
+        stored, legacy_files = {}, set()
+
+        def to_blob(relative_path, mime_type):
+            # Hired applicants share their CV path with an employee document; store each file once
+            if relative_path not in stored:
+                full_path = os.path.join(UPLOAD_FOLDER, relative_path)
+                stored[relative_path] = None
+                if os.path.isfile(full_path):
+                    with open(full_path, 'rb') as f:
+                        stored[relative_path] = store_blob_from_stream(f, mime_type or mimetypes.guess_type(full_path)[0])
+                    legacy_files.add(full_path)
+            return stored[relative_path]
+
+        for doc in docs:
+            blob_hash = to_blob(doc.file_path, doc.mime_type)
+            if blob_hash:
+                doc.blob_hash, doc.file_path = blob_hash, blob_relative_path(blob_hash)
+        for applicant in applicants:
+            blob_hash = to_blob(applicant.cv_path, None)
+            if blob_hash:
+                applicant.cv_file_name = applicant.cv_file_name or os.path.basename(applicant.cv_path)
+                applicant.cv_blob_hash, applicant.cv_path = blob_hash, blob_relative_path(blob_hash)
+        db.session.commit()
+        # The originals are only removed once the records point at their copies
+        for full_path in legacy_files:
+            os.remove(full_path)
+        app.logger.info(f"Moved {len(legacy_files)} uploaded files into the blob store.")
+
+
 def init_db():
     with app.app_context():
         # This will create tables that don't exist yet, without dropping existing ones.
@@ -2480,13 +6728,30 @@ def init_db():
         
         # Now, run migrations and seeding
         migrate_db()
+        backfill_notification_counters()
+        ensure_employee_search_index()
+        ensure_applicant_search_index()
+        ensure_identity_keys()
+        ensure_job_stage_counts()
+        migrate_uploads_to_blob_store()
         create_initial_admin_user()
         app.logger.info("Database initialization complete.")
 
 
-init_db()
+def start_schedulers():
+    """Starts the periodic background tasks; call it from the process that serves requests."""
+    if app.config['DOCUMENT_EXPIRY_SCHEDULER']:
+        start_document_expiry_scheduler()
+    if JOB_STAGE_RECOUNT_HOURS > 0:
+        start_periodic_task('job-stage-recount', recount_all_job_stage_counts, JOB_STAGE_RECOUNT_HOURS)
+
+
+# Spawned payroll workers import this module too; they only need the models and the engine
+if multiprocessing.current_process().name == 'MainProcess':
+    init_db()
 
 if __name__ == '__main__':
+    start_schedulers()
     app.run(host='0.0.0.0', port=5000, debug=True)
 
     
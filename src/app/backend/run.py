@@ -1,6 +1,7 @@
-from app import app, init_db
+from app import app, init_db, start_schedulers
 
 if __name__ == "__main__":
     init_db()
+    start_schedulers()
     # Explicitly setting host to '0.0.0.0' ensures it's accessible from the Next.js proxy.
     app.run(host='0.0.0.0', port=5000, debug=True)
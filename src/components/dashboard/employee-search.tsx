@@ -0,0 +1,115 @@
+"use client";
+
+import { useState, useEffect, useRef } from 'react';
+import { useRouter } from 'next/navigation';
+import { Search, Loader2 } from 'lucide-react';
+import { Input } from '@/components/ui/input';
+import { Avatar, AvatarFallback, AvatarImage } from '@/components/ui/avatar';
+
+type EmployeeResult = {
+  id: number;
+  full_name: string;
+  employee_code: string | null;
+  department: string | null;
+  job_title: string | null;
+  avatar: string | null;
+};
+
+export function EmployeeSearch() {
+  const router = useRouter();
+  const [query, setQuery] = useState('');
+  const [results, setResults] = useState<EmployeeResult[]>([]);
+  const [isOpen, setIsOpen] = useState(false);
+  const [isLoading, setIsLoading] = useState(false);
+  const containerRef = useRef<HTMLDivElement>(null);
+
+  useEffect(() => {
+    if (!query.trim()) {
+      setResults([]);
+      return;
+    }
+    // Debounced, and each keystroke cancels the previous request
+    const controller = new AbortController();
+    const timer = setTimeout(async () => {
+      setIsLoading(true);
+      try {
+        const token = localStorage.getItem('authToken');
+        const response = await fetch(`/api/employees/search?q=${encodeURIComponent(query)}&limit=8`, {
+          headers: { 'Authorization': `Bearer ${token}` },
+          signal: controller.signal,
+        });
+        if (response.ok) {
+          const data = await response.json();
+          setResults(data.employees);
+          setIsOpen(true);
+        }
+      } catch (error: any) {
+        if (error.name !== 'AbortError') console.error("Employee search failed:", error);
+      } finally {
+        setIsLoading(false);
+      }
+    }, 150);
+    return () => {
+      clearTimeout(timer);
+      controller.abort();
+    };
+  }, [query]);
+
+  useEffect(() => {
+    const handleClickOutside = (event: MouseEvent) => {
+      if (containerRef.current && !containerRef.current.contains(event.target as Node)) setIsOpen(false);
+    };
+    document.addEventListener('mousedown', handleClickOutside);
+    return () => document.removeEventListener('mousedown', handleClickOutside);
+  }, []);
+
+  const handleSelect = (employee: EmployeeResult) => {
+    setIsOpen(false);
+    setQuery('');
+    router.push(`/employees/${employee.id}`);
+  };
+
+  return (
+    <div ref={containerRef} className="relative w-full max-w-md">
+      <Search className="absolute right-2.5 top-2.5 h-4 w-4 text-muted-foreground" />
+      <Input
+        type="search"
+        placeholder="ابحث عن موظف بالاسم أو الرقم أو الهاتف..."
+        className="w-full bg-background pr-8"
+        value={query}
+        onChange={(e) => setQuery(e.target.value)}
+        onFocus={() => results.length > 0 && setIsOpen(true)}
+        onKeyDown={(e) => {
+          if (e.key === 'Enter' && results[0]) handleSelect(results[0]);
+          if (e.key === 'Escape') setIsOpen(false);
+        }}
+      />
+      {isLoading && <Loader2 className="absolute left-2.5 top-2.5 h-4 w-4 animate-spin text-muted-foreground" />}
+      {isOpen && query.trim() && (
+        <div className="absolute z-50 mt-1 w-full rounded-md border bg-popover p-1 shadow-md">
+          {results.length > 0 ? results.map(employee => (
+            <button
+              key={employee.id}
+              type="button"
+              className="flex w-full items-center gap-3 rounded-sm p-2 text-right hover:bg-accent"
+              onClick={() => handleSelect(employee)}
+            >
+              <Avatar className="h-8 w-8">
+                <AvatarImage src={employee.avatar || undefined} alt={employee.full_name} />
+                <AvatarFallback>{employee.full_name.charAt(0)}</AvatarFallback>
+              </Avatar>
+              <div className="min-w-0 flex-1">
+                <div className="truncate text-sm font-medium">{employee.full_name}</div>
+                <div className="truncate text-xs text-muted-foreground">
+                  {[employee.employee_code, employee.job_title, employee.department].filter(Boolean).join(' · ')}
+                </div>
+              </div>
+            </button>
+          )) : (
+            <div className="p-3 text-center text-sm text-muted-foreground">لا توجد نتائج</div>
+          )}
+        </div>
+      )}
+    </div>
+  );
+}
@@ -16,6 +16,8 @@ import { Button } from '@/components/ui/button';
 import { SidebarTrigger } from '../ui/sidebar';
 import { Avatar, AvatarFallback, AvatarImage } from '@/components/ui/avatar';
 import { useToast } from '@/components/ui/use-toast';
+import { EmployeeSearch } from './employee-search';
+import { openEventStream } from '@/lib/event-stream';
 
 type User = {
   id: number;
@@ -60,7 +62,7 @@ export function Header() {
     if (!token) return;
 
     try {
-      const response = await fetch('/api/notifications', {
+      const response = await fetch('/api/notifications/summary?limit=20', {
         headers: { 'Authorization': `Bearer ${token}` }
       });
       if (response.ok) {
@@ -80,8 +82,21 @@ export function Header() {
     }
     fetchNotifications();
 
-    const interval = setInterval(fetchNotifications, 60000); // Poll every minute
-    return () => clearInterval(interval);
+    // Live updates are pushed over SSE; polling is only used if the stream is unavailable.
+    let interval: ReturnType<typeof setInterval> | null = null;
+    const startPolling = () => {
+      if (!interval) interval = setInterval(fetchNotifications, 60000); // Poll every minute
+    };
+    const closeStream = localStorage.getItem('authToken') ? openEventStream({
+      notification: () => fetchNotifications(),
+      unread_count: (data) => setUnreadCount(data.unread_count),
+    }, startPolling) : null;
+    if (!closeStream) startPolling();
+
+    return () => {
+      closeStream?.();
+      if (interval) clearInterval(interval);
+    };
   }, []);
 
   const handleLogout = () => {
@@ -128,7 +143,7 @@ export function Header() {
     <header className="flex h-14 items-center gap-4 border-b bg-card px-4 lg:h-[60px] lg:px-6">
       <SidebarTrigger className="shrink-0 md:hidden" />
       <div className="w-full flex-1">
-        {/* Search form can be enabled later */}
+        <EmployeeSearch />
       </div>
       
       <DropdownMenu>
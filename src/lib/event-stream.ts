@@ -0,0 +1,38 @@
+import { getSignedUrl } from '@/lib/utils';
+
+type StreamHandlers = Record<string, (data: any) => void>;
+
+// EventSource can't send the Authorization header, so every connection uses a fresh short-lived
+// signed URL. On errors the stream is reopened with a new URL rather than letting the browser
+// retry the old (possibly expired) one. onUnavailable is called if no URL can be obtained.
+export function openEventStream(handlers: StreamHandlers, onUnavailable?: () => void): () => void {
+  let source: EventSource | null = null;
+  let retry: ReturnType<typeof setTimeout> | null = null;
+  let closed = false;
+
+  const connect = async () => {
+    let url: string;
+    try {
+      url = await getSignedUrl('/api/stream');
+    } catch {
+      if (!closed) onUnavailable?.();
+      return;
+    }
+    if (closed) return;
+    source = new EventSource(url);
+    for (const [event, handler] of Object.entries(handlers)) {
+      source.addEventListener(event, (e) => handler(JSON.parse((e as MessageEvent).data)));
+    }
+    source.onerror = () => {
+      source?.close();
+      if (!closed) retry = setTimeout(connect, 5000);
+    };
+  };
+
+  connect();
+  return () => {
+    closed = true;
+    source?.close();
+    if (retry) clearTimeout(retry);
+  };
+}
@@ -145,6 +145,7 @@ export type Job = {
   created_at: string;
   department?: { name_ar: string }; // For UI
   applicants_count?: number; // For UI
+  stage_counts?: Partial<Record<Applicant['stage'], number>>;
   close_reason?: string;
 };
 
@@ -158,6 +159,7 @@ export type Applicant = {
   source: string;
   stage: 'Applied' | 'Screening' | 'Interview' | 'Offer' | 'Hired' | 'Rejected';
   cv_path?: string | null;
+  cv_file_name?: string | null;
   rating?: number;
   notes?: string | null;
   created_at: string;
@@ -304,6 +306,7 @@ export type EmployeeWithCompliance = Employee & {
   compliance_percent: number;
   missing_docs_count: number;
   expiring_docs_count: number;
+  expired_docs_count: number;
   last_updated: string;
 };
 
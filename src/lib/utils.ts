@@ -4,3 +4,17 @@ import { twMerge } from "tailwind-merge"
 export function cn(...inputs: ClassValue[]) {
   return twMerge(clsx(inputs))
 }
+
+// Files the browser fetches on its own (previews, downloads) can't send the Authorization header,
+// so the API hands out short-lived signed URLs for them instead.
+export async function getSignedUrl(path: string, params: Record<string, string | number> = {}): Promise<string> {
+  const token = localStorage.getItem('authToken') || ''
+  const response = await fetch('/api/signed-urls', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', Authorization: `Bearer ${token}` },
+    body: JSON.stringify({ path, params }),
+  })
+  const data = await response.json()
+  if (!response.ok) throw new Error(data.message || 'فشل في تجهيز رابط الملف')
+  return data.url
+}